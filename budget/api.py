@@ -0,0 +1,192 @@
+"""
+REST API for sync clients
+
+Lists are paged with an opaque ``cursor`` (the ``next`` link of the
+previous page) in primary key order and can be limited to some fields
+with ``fields``. Every GET carries an ETag and Last-Modified date derived
+from the data version of the user, so polling clients get a 304 without
+the list being queried as long as nothing changed.
+"""
+import calendar
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import Q
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status, viewsets
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import ParseError, PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.templatetags.rest_framework import replace_query_param
+
+from budget import models, serializers
+
+def dump_cursor(pk):
+    return signing.dumps(pk, salt="budget.api")
+
+def load_cursor(cursor):
+    try:
+        return signing.loads(cursor, salt="budget.api")
+    except signing.BadSignature:
+        raise ParseError("Invalid cursor")
+
+class BudgetAPIMixin(object):
+    permission_classes = (IsAuthenticated,)
+
+    def initial(self, request, *args, **kwargs):
+        super(BudgetAPIMixin, self).initial(request, *args, **kwargs)
+        try:
+            request.user.budget_profile
+        except models.UserProfile.DoesNotExist:
+            request.user.budget_profile = models.UserProfile.objects.create(
+                    user=request.user)
+        self.profile = request.user.budget_profile
+
+    def not_modified(self, request):
+        """
+        Sets the ETag and Last-Modified headers of the response and tells
+        whether the client already has the current version.
+        """
+        etag = '"{}"'.format(hashlib.md5("{}:{}:{}:{}".format(
+                self.profile.pk, self.profile.data_version,
+                request.get_full_path(),
+                request.META.get('HTTP_ACCEPT', ''))).hexdigest())
+        modified = calendar.timegm(self.profile.data_modified.utctimetuple())
+        self.headers['ETag'] = etag
+        self.headers['Last-Modified'] = http_date(modified)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return etag in [tag.strip() for tag in if_none_match.split(',')]
+        since = parse_http_date_safe(request.META.get(
+                'HTTP_IF_MODIFIED_SINCE', ''))
+        return since is not None and modified <= since
+
+    def list(self, request, *args, **kwargs):
+        if self.not_modified(request):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        queryset = self.filter_queryset(self.get_queryset()).order_by('pk')
+        cursor = request.QUERY_PARAMS.get('cursor')
+        if cursor:
+            queryset = queryset.filter(pk__gt=load_cursor(cursor))
+        page_size = getattr(settings, 'BUDGET_API_PAGE_SIZE', 100)
+        try:
+            limit = min(int(request.QUERY_PARAMS.get('limit', page_size)),
+                        getattr(settings, 'BUDGET_API_MAX_PAGE_SIZE', 1000))
+        except ValueError:
+            raise ParseError("Invalid limit")
+        rows = list(queryset[:max(limit, 1) + 1])
+        next = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next = replace_query_param(request.build_absolute_uri(), 'cursor',
+                                       dump_cursor(rows[-1].pk))
+        return Response({'next': next,
+                         'results': self.get_serializer(rows, many=True).data})
+
+    def retrieve(self, request, *args, **kwargs):
+        if self.not_modified(request):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super(BudgetAPIMixin, self).retrieve(request, *args, **kwargs)
+
+    def pre_save(self, obj):
+        super(BudgetAPIMixin, self).pre_save(obj)
+        if hasattr(obj, 'user_id'):
+            obj.user = self.profile
+
+class BudgetViewSet(BudgetAPIMixin, viewsets.ModelViewSet):
+    pass
+
+class AccountViewSet(BudgetViewSet):
+    serializer_class = serializers.AccountSerializer
+
+    def get_queryset(self):
+        return self.profile.accounts.all()
+
+class ReconciledLockMixin(object):
+    """Reconciled rows only take a new category and cannot be deleted"""
+    def pre_save(self, obj):
+        super(ReconciledLockMixin, self).pre_save(obj)
+        changed = models.reconciled_changes(obj)
+        if changed:
+            raise PermissionDenied(u"Reconciled transactions only take a new "
+                                   u"category, not {}".format(
+                                           u", ".join(changed)))
+
+    def pre_delete(self, obj):
+        super(ReconciledLockMixin, self).pre_delete(obj)
+        if obj.reconciled:
+            raise PermissionDenied("Reconciled transactions cannot be deleted")
+
+class TransactionViewSet(ReconciledLockMixin, BudgetViewSet):
+    """
+    The transactions of the user's accounts, without transfers. Filter by
+    account with ``account``. POST a list to ``bulk/`` to create many
+    transactions at once.
+    """
+    serializer_class = serializers.TransactionSerializer
+
+    def get_queryset(self):
+        transactions = models.Transaction.objects.filter(
+                account__user=self.profile, transfer__isnull=True)
+        account = self.request.QUERY_PARAMS.get('account')
+        if account:
+            transactions = transactions.filter(account=account)
+        return transactions
+
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        serializer = self.get_serializer(data=request.DATA, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            models.bulk_create_transactions(serializer.object)
+        return Response({'created': len(serializer.object)},
+                        status=status.HTTP_201_CREATED)
+
+class TransferViewSet(ReconciledLockMixin, BudgetViewSet):
+    """The transfers from or, with ``account``, to the user's accounts"""
+    serializer_class = serializers.TransferSerializer
+
+    def get_queryset(self):
+        transfers = models.Transfer.objects.filter(account__user=self.profile)
+        account = self.request.QUERY_PARAMS.get('account')
+        if account:
+            transfers = transfers.filter(Q(account=account) |
+                                         Q(to_account=account))
+        return transfers
+
+class ScheduledTransactionViewSet(BudgetViewSet):
+    serializer_class = serializers.ScheduledTransactionSerializer
+
+    def get_queryset(self):
+        return models.ScheduledTransaction.objects.filter(
+                account__user=self.profile)
+
+class CategoryViewSet(BudgetAPIMixin, viewsets.ReadOnlyModelViewSet):
+    serializer_class = serializers.CategorySerializer
+
+    def get_queryset(self):
+        return serializers.user_categories(self.profile).select_related(
+                'group')
+
+class BudgetMonthViewSet(BudgetViewSet):
+    serializer_class = serializers.BudgetMonthSerializer
+
+    def get_queryset(self):
+        return self.profile.budgets.all()
+
+class CategoryBudgetViewSet(BudgetViewSet):
+    """The budgeted amounts per category, filter by ``budget``"""
+    serializer_class = serializers.CategoryBudgetSerializer
+
+    def get_queryset(self):
+        amounts = models.CategoryBudget.objects.filter(
+                budget__user=self.profile)
+        budget = self.request.QUERY_PARAMS.get('budget')
+        if budget:
+            amounts = amounts.filter(budget=budget)
+        return amounts
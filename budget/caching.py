@@ -0,0 +1,89 @@
+"""
+Per-user cache of the rendered sidebar, the budget grid and form choices
+
+Entries are keyed on the data version of the user, which the signal
+handlers in budget.models bump whenever accounts, transactions or budgets
+change, or on its choices version for the account and category choice
+lists. Outdated entries are therefore never read again and simply
+expire. The exchange rates, which all users share, are keyed on a
+generation that changes whenever rates are loaded; entries with amounts
+converted by them add the generation to their parts. The cache is the one
+named by the BUDGET_CACHE setting, any backend shared by the worker
+processes (e.g. locmem for a single process or the file based cache)
+works.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+HITS = 'budget:stats:hits'
+MISSES = 'budget:stats:misses'
+RATES_GENERATION = 'budget:rates:generation'
+COUNTER_TIMEOUT = 30 * 24 * 3600
+
+def budget_cache():
+    return get_cache(getattr(settings, 'BUDGET_CACHE', 'default'))
+
+def cache_key(user, name, *parts):
+    return u":".join([u"budget", unicode(user.pk), unicode(user.data_version),
+                      name] + [unicode(part) for part in parts])
+
+def count(cache, key):
+    cache.add(key, 0, COUNTER_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        pass
+
+def cached(user, name, compute, *parts):
+    """
+    Returns the value of ``compute()`` for the user, cached under ``name``
+    and ``parts`` until the user's data changes.
+    """
+    return cached_value(cache_key(user, name, *parts), compute)
+
+def cached_choices(user, name, compute):
+    """
+    Like cached(), but the value only goes out of date when the accounts
+    or categories of the user change, not with every transaction.
+    """
+    return cached_value(u"budget:{}:choices{}:{}".format(
+            user.pk, user.choices_version, name), compute)
+
+def cached_rates(compute, *parts):
+    """
+    Like cached(), for the exchange rates, until rates_changed() is called.
+    """
+    return cached_value(u":".join([u"budget:rates", rates_generation()] +
+                                  [unicode(part) for part in parts]), compute)
+
+def rates_generation():
+    """Returns the generation of the exchange rates in the cache"""
+    generation = budget_cache().get(RATES_GENERATION)
+    if generation is None:
+        # Evicted, a new generation leaves no outdated entry readable
+        generation = rates_changed()
+    return generation
+
+def rates_changed():
+    generation = uuid.uuid4().hex
+    budget_cache().set(RATES_GENERATION, generation, COUNTER_TIMEOUT)
+    return generation
+
+def cached_value(key, compute):
+    cache = budget_cache()
+    value = cache.get(key)
+    if value is None:
+        count(cache, MISSES)
+        value = compute()
+        cache.set(key, value, getattr(settings, 'BUDGET_CACHE_TIMEOUT', 3600))
+    else:
+        count(cache, HITS)
+    return value
+
+def stats():
+    """Returns the number of cache hits and misses since the last clear"""
+    values = budget_cache().get_many([HITS, MISSES])
+    return values.get(HITS, 0), values.get(MISSES, 0)
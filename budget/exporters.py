@@ -0,0 +1,137 @@
+"""
+Streaming export of transactions and budget months (CSV and JSON)
+
+The rows are read from the database in chunks of ``chunk_size``, each
+chunk starting after the last row of the previous one, and written out as
+they come. The export of an account merges its own rows and the
+transfers to it, read in date order each. Memory use does not depend on
+the length of the history.
+"""
+import csv
+import heapq
+import json
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from budget.models import CategoryMonth, Transaction
+
+CHUNK_SIZE = 500
+CENT = Decimal('0.01')
+
+TRANSACTION_FIELDS = ('date', 'account', 'payee', 'category', 'memo',
+                      'check_nr', 'inflow', 'outflow', 'cleared',
+                      'transfer_account')
+
+BUDGET_MONTH_FIELDS = ('month', 'category', 'budgeted', 'inflow', 'outflow',
+                       'carried_over', 'balance')
+
+def money(value):
+    return Decimal(value).quantize(CENT)
+
+def chunked(queryset, key, chunk_size=CHUNK_SIZE):
+    """
+    Iterates over the ``.values()`` rows of ``queryset`` in ``key`` order,
+    loading at most ``chunk_size`` rows at a time. ``key`` is a pair of
+    fields that is unique per row, e.g. ('date', 'id'). Every chunk is an
+    index range on the first field that skips the rows of the previous
+    chunk.
+    """
+    first, second = key
+    rows = queryset.order_by(first, second)
+    while True:
+        count = 0
+        for row in rows[:chunk_size].iterator():
+            count += 1
+            yield row
+        if count < chunk_size:
+            return
+        rows = queryset.order_by(first, second).filter(
+                **{first + '__gte': row[first]}).exclude(
+                **{first: row[first], second + '__lte': row[second]})
+
+def transaction_rows(user, account=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the implemented transactions of the user, or of one account
+    including the transfers to it, oldest first. Transfers between the
+    user's accounts appear once in the user's export, with their
+    ``transfer_account``.
+    """
+    fields = ('id', 'date', 'account_id', 'account__name', 'payee',
+              'category', 'memo', 'check_nr', 'inflow', 'outflow', 'cleared',
+              'transfer__to_account_id', 'transfer__to_account__name',
+              'transfer__to_date')
+    if account:
+        # The rows of the account and the transfers to it, each read along
+        # its own index and merged
+        legs = [chunked(Transaction.objects.filter(account=account,
+                        implemented=True).values(*fields), ('date', 'id'),
+                        chunk_size),
+                chunked(Transaction.objects.filter(
+                        transfer__to_account=account, implemented=True).\
+                        exclude(account=account).values(*fields),
+                        ('transfer__to_date', 'id'), chunk_size)]
+        rows = (row for _, row in heapq.merge(*[
+                (((row['date'], row['id']), row) for row in leg)
+                for leg in legs]))
+    else:
+        rows = chunked(Transaction.objects.filter(account__user=user,
+                implemented=True).values(*fields), ('date', 'id'), chunk_size)
+    for row in rows:
+        account_name = row['account__name']
+        transfer_account = row['transfer__to_account__name']
+        inflow, outflow = money(row['inflow']), money(row['outflow'])
+        if account and row['account_id'] != account.pk:
+            # Incoming transfer, seen from the receiving account
+            account_name, transfer_account = transfer_account, account_name
+            inflow, outflow = outflow, inflow
+        yield {'date': row['date'], 'account': account_name,
+               'payee': row['payee'], 'category': row['category'],
+               'memo': row['memo'], 'check_nr': row['check_nr'],
+               'inflow': inflow, 'outflow': outflow,
+               'cleared': row['cleared'], 'transfer_account': transfer_account}
+
+def budget_month_rows(user, chunk_size=CHUNK_SIZE):
+    """
+    Yields the budgeted amounts, inflows and outflows per category and
+    month, oldest month first. The category of the "to be budgeted" pool
+    is empty.
+    """
+    months = user.category_months.values('id', 'month', 'category',
+            'budgeted', 'inflow', 'outflow', 'carried_over')
+    for row in chunked(months, ('month', 'id'), chunk_size):
+        for field in ('budgeted', 'inflow', 'outflow', 'carried_over'):
+            row[field] = money(row[field])
+        row['balance'] = row['carried_over'] + CategoryMonth.balance_change(
+                row['category'], row['budgeted'], row['inflow'],
+                row['outflow'])
+        yield row
+
+class Echo(object):
+    """File-like object that hands back what is written to it"""
+    def write(self, value):
+        return value
+
+def write_csv(fields, rows):
+    """Yields the CSV lines of ``rows``, starting with a header line"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([u"" if row[field] is None else
+                               unicode(row[field]).encode('utf-8')
+                               for field in fields])
+
+def write_json(fields, rows):
+    """Yields ``rows`` as a JSON list of objects, one object per line"""
+    separator = "[\n"
+    for row in rows:
+        yield separator + json.dumps(dict((field, row[field])
+                                          for field in fields),
+                                     cls=DjangoJSONEncoder, sort_keys=True)
+        separator = ",\n"
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+WRITERS = {'csv': write_csv, 'json': write_json}
+
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8',
+                 'json': 'application/json'}
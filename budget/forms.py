@@ -1,6 +1,42 @@
-from django.forms import ModelForm, HiddenInput 
+from itertools import groupby
 
-from budget.models import Account, Transaction, Transfer
+from django.core.urlresolvers import reverse
+from django.forms import BooleanField, CharField, ChoiceField, DateField, \
+        DecimalField, FileField, Form, ModelForm, HiddenInput, IntegerField, \
+        ModelChoiceField, ValidationError
+
+from budget.caching import cached_choices
+from budget.importers import PARSERS
+from budget.models import Account, Category, Transaction, Transfer, \
+        user_categories
+from budget.widgets import PrefixedModelChoiceField
+
+def category_choices(user):
+    """Returns the user's categories grouped by category group, cached"""
+    def compute():
+        categories = user_categories(user).select_related('group').\
+                order_by('group__name', 'name')
+        return [(group, [(category.pk, category.name) for category in rows])
+                for group, rows in groupby(categories,
+                        lambda category: category.group.name)]
+    return cached_choices(user, 'categories', compute)
+
+def account_choices(user):
+    """Returns the (pk, name) pairs of the user's accounts, cached"""
+    return cached_choices(user, 'accounts', lambda: list(
+            user.accounts.order_by('name').values_list('pk', 'name')))
+
+def category_field(user, **kwargs):
+    return PrefixedModelChoiceField(queryset=user_categories(user),
+                                    choices=category_choices(user), **kwargs)
+
+def account_field(user, exclude=None, **kwargs):
+    accounts, choices = user.accounts.all(), account_choices(user)
+    if exclude is not None:
+        accounts = accounts.exclude(pk=exclude.pk)
+        choices = [choice for choice in choices if choice[0] != exclude.pk]
+    return PrefixedModelChoiceField(queryset=accounts, choices=choices,
+                                    **kwargs)
 
 class AccountForm(ModelForm):
     class Meta:
@@ -10,6 +46,21 @@ class AccountForm(ModelForm):
             }
 
 class TransactionForm(ModelForm):
+    """
+    Builds the account and category fields of each instance from the
+    cached choices of the ``user``, without querying them.
+    """
+    def __init__(self, user, *args, **kwargs):
+        super(TransactionForm, self).__init__(*args, **kwargs)
+        self.fields['account'] = account_field(user,
+                widget=self.fields['account'].widget)
+        self.fields['category'] = category_field(user)
+        if 'payee' in self.fields:
+            # Filled from budget.views.payees by register.js
+            self.fields['payee'].widget.attrs.update({
+                    'autocomplete': 'off', 'list': 'payee-suggestions',
+                    'data-suggestions': reverse('budget.views.payees')})
+
     class Meta:
         model = Transaction
         exclude = ['added']
@@ -23,15 +74,62 @@ class TransactionToAccountForm(TransactionForm):
             }
 
 class TransferForm(TransactionForm):
+    """Transfers from ``account``, which is no choice for ``to_account``"""
+    def __init__(self, user, *args, **kwargs):
+        account = kwargs.pop('account', None)
+        super(TransferForm, self).__init__(user, *args, **kwargs)
+        self.fields['to_account'] = account_field(user, exclude=account)
+
     class Meta:
         model = Transfer
         exclude = ['added', 'payee']
 
 class TransferToAccountForm(TransferForm):
     class Meta:
-        model = Transaction
-        exclude = ['added']
+        model = Transfer
+        exclude = ['added', 'payee']
         widgets = {
                 'account': HiddenInput()
             }
 
+class ImportForm(Form):
+    file = FileField(label="Statement")
+    format = ChoiceField(choices=[(name, name.upper())
+                                  for name in sorted(PARSERS)])
+    date_format = CharField(required=False, 
+                            help_text="e.g. %d.%m.%Y, guessed if empty")
+    encoding = CharField(initial='utf-8')
+
+class BulkActionForm(Form):
+    action = ChoiceField(choices=(('clear', "Clear"), ('unclear', "Unclear"),
+                                  ('categorize', "Set category"),
+                                  ('move', "Move to account"),
+                                  ('delete', "Delete")))
+    category = ModelChoiceField(queryset=Category.objects.none(),
+                                required=False)
+    account = ModelChoiceField(queryset=Account.objects.none(),
+                               required=False)
+    next = CharField(required=False)
+
+    def __init__(self, user, *args, **kwargs):
+        super(BulkActionForm, self).__init__(*args, **kwargs)
+        self.fields['category'] = category_field(user, required=False)
+        self.fields['account'] = account_field(user, required=False)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control input-sm'
+
+    def clean(self):
+        data = super(BulkActionForm, self).clean()
+        for action, field in (('categorize', 'category'), ('move', 'account')):
+            if data.get('action') == action and not data.get(field):
+                raise ValidationError("Choose the {} to use".format(field))
+        return data
+
+class ReconcileForm(Form):
+    date = DateField(label="Statement date")
+    balance = DecimalField(label="Statement balance", max_digits=20,
+                           decimal_places=2)
+
+class ReconcileToggleForm(ReconcileForm):
+    id = IntegerField(widget=HiddenInput)
+    cleared = BooleanField(required=False)
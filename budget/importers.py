@@ -0,0 +1,195 @@
+"""
+Streaming import of bank statements (CSV, QIF and OFX)
+
+The parsers read the statement line by line and yield one dict per
+transaction, import_transactions() writes them in batches. The rows are
+not kept, only a counter per distinct date, amount and payee that tells
+apart repeated rows, see statement_transactions(). Memory use thus grows
+with the number of distinct rows of a statement, by one small dict entry
+each, rather than with their contents.
+"""
+import csv
+import datetime
+import hashlib
+import re
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+
+from budget.models import Transaction, bulk_create_transactions
+
+CENT = Decimal('0.01')
+MAX_AMOUNT = Decimal(10) ** 18
+
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%m/%d/%Y', '%m/%d/%y', '%Y%m%d')
+
+class StatementError(Exception):
+    def __init__(self, line, message):
+        self.line = line
+        super(StatementError, self).__init__(u"Line {}: {}".format(line,
+                                                                  message))
+
+def parse_date(value, date_format=None):
+    value = value.strip().replace("'", "/")
+    for date_format in (date_format,) if date_format else DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(u"Invalid date '{}'".format(value))
+
+def parse_amount(value):
+    value = value.strip().replace(' ', '')
+    if ',' in value and '.' in value:
+        # Whichever comes last is the decimal separator
+        if value.rindex(',') > value.rindex('.'):
+            value = value.replace('.', '').replace(',', '.')
+        else:
+            value = value.replace(',', '')
+    elif value.count(',') == 1:
+        value = value.replace(',', '.')
+    else:
+        value = value.replace(',', '')
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError(u"Invalid amount '{}'".format(value))
+
+def parse_csv(lines, date_format=None, encoding='utf-8'):
+    """
+    Parses CSV statements with a header row. Known columns are date,
+    payee, memo, check_nr and either amount or inflow and outflow.
+    """
+    reader = csv.reader(lines)
+    header = [column.decode(encoding).strip().lower()
+              for column in next(reader, [])]
+    if 'date' not in header or 'amount' not in header and \
+            'inflow' not in header and 'outflow' not in header:
+        raise StatementError(1, "The header needs a date and an amount or "
+                                "inflow/outflow column")
+    for line, values in enumerate(reader, 2):
+        if not any(values):
+            continue
+        row = dict(zip(header, (value.decode(encoding) for value in values)))
+        try:
+            amount = parse_amount(row.get('amount') or '0') + \
+                    parse_amount(row.get('inflow') or '0') - \
+                    parse_amount(row.get('outflow') or '0')
+            yield line, {'date': parse_date(row['date'], date_format),
+                         'amount': amount, 'payee': row.get('payee', u""),
+                         'memo': row.get('memo', u""),
+                         'check_nr': row.get('check_nr') or None}
+        except ValueError as e:
+            raise StatementError(line, e)
+
+QIF_FIELDS = {'D': 'date', 'T': 'amount', 'U': 'amount', 'P': 'payee',
+              'M': 'memo', 'N': 'check_nr'}
+
+def parse_qif(lines, date_format=None, encoding='utf-8'):
+    row = {}
+    for line, text in enumerate(lines, 1):
+        text = text.decode(encoding).strip()
+        if not text or text.startswith('!'):
+            continue
+        if text == '^':
+            if row:
+                try:
+                    yield line, {'date': parse_date(row['date'], date_format),
+                                 'amount': parse_amount(row['amount']),
+                                 'payee': row.get('payee', u""),
+                                 'memo': row.get('memo', u""),
+                                 'check_nr': row.get('check_nr')}
+                except (KeyError, ValueError) as e:
+                    raise StatementError(line, e)
+            row = {}
+        elif text[0] in QIF_FIELDS:
+            row[QIF_FIELDS[text[0]]] = text[1:]
+
+OFX_TAG = re.compile(r'<(/?[A-Z0-9.]+)>([^<\r\n]*)')
+
+def parse_ofx(lines, date_format=None, encoding='utf-8'):
+    """
+    Parses the STMTTRN records of SGML (OFX 1) and XML (OFX 2) statements.
+    """
+    row = None
+    for line, text in enumerate(lines, 1):
+        for tag, value in OFX_TAG.findall(text.decode(encoding)):
+            if tag == 'STMTTRN':
+                row = {}
+            elif tag == '/STMTTRN' and row is not None:
+                try:
+                    yield line, {'date': parse_date(row['DTPOSTED'][:8],
+                                                    '%Y%m%d'),
+                                 'amount': parse_amount(row['TRNAMT']),
+                                 'payee': row.get('NAME', row.get('PAYEE', u"")),
+                                 'memo': row.get('MEMO', u""),
+                                 'check_nr': row.get('CHECKNUM')}
+                except (KeyError, ValueError) as e:
+                    raise StatementError(line, e)
+                row = None
+            elif row is not None and not tag.startswith('/'):
+                row[tag] = value.strip()
+
+PARSERS = {'csv': parse_csv, 'qif': parse_qif, 'ofx': parse_ofx}
+
+def import_hash(account, row, occurrence):
+    """
+    Hashes account, date, amount and payee. ``occurrence`` tells apart
+    identical rows of the same day, so that they are imported as often as
+    they appear in one statement, but not again from an overlapping one.
+    """
+    key = u"|".join((unicode(account.pk), row['date'].isoformat(),
+                     unicode(row['amount']), row['payee'],
+                     unicode(occurrence)))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def statement_transactions(account, rows):
+    """
+    Yields the unsaved transactions of the parsed statement ``rows``.
+
+    Identical rows are counted over the whole statement, as statements
+    need not be sorted by date, so the counters are kept until the end.
+    Resetting them per date would bound the memory but give two identical
+    rows around a row of another date the same import hash.
+    """
+    occurrences = defaultdict(int)
+    for line, row in rows:
+        amount = row['amount']
+        if amount != amount.quantize(CENT) or abs(amount) >= MAX_AMOUNT:
+            raise StatementError(line, u"Invalid amount {}".format(amount))
+        payee = (row['payee'] or row['memo'])[:32]
+        if not payee:
+            raise StatementError(line, u"Neither payee nor memo given")
+        key = (row['date'], unicode(amount), row['payee'])
+        occurrences[key] += 1
+        check_nr = row['check_nr']
+        yield Transaction(account=account, date=row['date'], payee=payee,
+                memo=row['memo'][:64] or None, inflow=max(amount, 0),
+                outflow=max(-amount, 0),
+                check_nr=int(check_nr) if check_nr and check_nr.isdigit()
+                         else None,
+                import_hash=import_hash(account, row, occurrences[key]))
+
+def import_transactions(account, rows, batch_size=500):
+    """
+    Imports the parsed statement ``rows`` into ``account`` in batches of
+    ``batch_size``, each validated and inserted in its own database
+    transaction. Rows imported before are skipped. Returns the number of
+    imported and skipped rows.
+    """
+    imported = skipped = 0
+    transactions = statement_transactions(account, rows)
+    while True:
+        batch = list(islice(transactions, batch_size))
+        if not batch:
+            return imported, skipped
+        existing = set(account.transactions.filter(import_hash__in=[
+                t.import_hash for t in batch]).values_list('import_hash',
+                                                           flat=True))
+        new = [t for t in batch if t.import_hash not in existing]
+        with transaction.atomic():
+            bulk_create_transactions(new)
+        imported += len(new)
+        skipped += len(batch) - len(new)
@@ -0,0 +1,183 @@
+"""
+Background jobs
+
+Work too slow for a request is queued as a Job row with enqueue() and
+run by the run_worker command on a pool of threads or processes. Jobs
+with the same task and arguments are coalesced: while one of them waits,
+enqueueing it again returns the waiting job. A running job does not
+count, as it may have read the data from before the change.
+
+A failing job is retried after 2, 4, 8... times BUDGET_JOB_BACKOFF
+seconds until it has been tried BUDGET_JOB_ATTEMPTS times. Jobs running
+longer than BUDGET_JOB_TIMEOUT seconds are taken to have lost their
+worker and are run again. With BUDGET_JOBS_EAGER the jobs run right
+away in the process enqueueing them, for setups without a worker.
+
+Tasks run outside of a transaction and commit their writes in short
+transactions of their own. On SQLite a worker thus holds the write lock
+only while writing, not while computing.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import traceback
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from budget import reports, search
+from budget.models import Job, UserProfile, rebuild_category_months, \
+        touch_users
+
+logger = logging.getLogger('budget.jobs')
+
+def recompute_user(user_id):
+    """
+    Recomputes the category months of the user from scratch, e.g. after
+    an account moved in or out of the budget.
+    """
+    rebuild_category_months([user_id])
+    touch_users(UserProfile.objects.filter(pk=user_id))
+
+def refresh_user(user_id):
+    """
+    Prepares what the next pages of the user need after a change: the
+    month end balance checkpoints that back-dated changes dropped, the
+    reports of the last twelve months and the payee suggestions. The
+    cached values only reach the web processes through a shared
+    BUDGET_CACHE.
+    """
+    user = UserProfile.objects.get(pk=user_id)
+    today = datetime.date.today()
+    # Each account in a short transaction of its own, see update_checkpoints()
+    for account in user.accounts.all():
+        account.update_checkpoints(today)
+    # Computed and cached without holding a transaction open
+    first, last = reports.month_range()
+    for name in reports.REPORTS:
+        options = {'by': 'category'} if name == 'spending' else {}
+        reports.cached_report(user, name, first, last, **options)
+    search.payee_index(user)
+
+TASKS = {'recompute_user': recompute_user, 'refresh_user': refresh_user}
+
+def job_key(name, arguments):
+    return u"{}:{}".format(name, hashlib.sha1(json.dumps(arguments,
+            sort_keys=True)).hexdigest())
+
+def enqueue(name, user_id=None, delay=0, **arguments):
+    """
+    Queues the task ``name`` with the keyword ``arguments`` (and
+    ``user_id``, whom the job is shown to) to run in ``delay`` seconds at
+    the earliest. Returns the job, which is the one waiting already if
+    the same job was queued before.
+    """
+    if name not in TASKS:
+        raise ValueError(u"Unknown task {}".format(name))
+    if user_id is not None:
+        arguments['user_id'] = user_id
+    key = job_key(name, arguments)
+    if getattr(settings, 'BUDGET_JOBS_EAGER', False):
+        return run_job(Job.objects.create(name=name, key=key,
+                arguments=json.dumps(arguments), user_id=user_id,
+                status=Job.RUNNING, started=timezone.now(), attempts=1))
+    # Should two requests queue the same job at once, it merely runs twice
+    waiting = Job.objects.filter(key=key, status=Job.PENDING).first()
+    if waiting is not None:
+        return waiting
+    return Job.objects.create(name=name, key=key,
+            arguments=json.dumps(arguments), user_id=user_id,
+            run_after=timezone.now() + datetime.timedelta(seconds=delay))
+
+def claim():
+    """
+    Marks the next due job as running and returns it, None if no job is
+    due. Several workers may race for a job, only one of them gets it.
+    """
+    now = timezone.now()
+    lost = now - datetime.timedelta(seconds=getattr(settings,
+            'BUDGET_JOB_TIMEOUT', 600))
+    due = Job.objects.filter(Q(status=Job.PENDING, run_after__lte=now) |
+                             Q(status=Job.RUNNING, started__lt=lost)).\
+            order_by('run_after', 'pk')
+    for job in due[:10]:
+        claimed = Job.objects.filter(pk=job.pk, status=job.status,
+                                     attempts=job.attempts).update(
+                status=Job.RUNNING, started=now, attempts=job.attempts + 1)
+        if claimed:
+            job.status, job.started = Job.RUNNING, now
+            job.attempts += 1
+            return job
+    return None
+
+def run_job(job):
+    """
+    Runs the claimed ``job`` and records how it went, queueing it again
+    after a failure while it has attempts left. Returns the job.
+    """
+    attempts = getattr(settings, 'BUDGET_JOB_ATTEMPTS', 3)
+    now = timezone.now
+    if job.attempts > attempts:
+        # Lost its worker on the last attempt
+        changes = {'status': Job.FAILED, 'finished': now()}
+    else:
+        try:
+            TASKS[job.name](**json.loads(job.arguments))
+        except Exception:
+            logger.exception(u"%s failed", job)
+            changes = {'error': traceback.format_exc()}
+            if job.attempts < attempts:
+                backoff = getattr(settings, 'BUDGET_JOB_BACKOFF', 30)
+                changes.update(status=Job.PENDING,
+                               run_after=now() + datetime.timedelta(
+                                       seconds=backoff * 2 ** job.attempts))
+            else:
+                changes.update(status=Job.FAILED, finished=now())
+        else:
+            changes = {'status': Job.DONE, 'finished': now(), 'error': u""}
+    # Unless another worker took the job over in the meantime
+    Job.objects.filter(pk=job.pk, attempts=job.attempts).update(**changes)
+    for name, value in changes.items():
+        setattr(job, name, value)
+    return job
+
+def work(stop, poll=1.0, drain=False):
+    """
+    Runs due jobs until the event ``stop`` is set, or with ``drain`` until
+    no job is due. Returns the number of jobs run.
+    """
+    count = 0
+    while not stop.is_set():
+        job = claim()
+        if job is None:
+            if drain:
+                break
+            stop.wait(poll)
+            continue
+        run_job(job)
+        count += 1
+    return count
+
+def run_pending():
+    """Runs the due jobs in this thread, see work()"""
+    return work(threading.Event(), drain=True)
+
+def purge(days):
+    """Deletes the jobs done more than ``days`` days ago"""
+    Job.objects.filter(status=Job.DONE, finished__lt=timezone.now() -
+                       datetime.timedelta(days=days)).delete()
+
+def describe(job):
+    """Returns the status of ``job`` for the status endpoint"""
+    return {'id': job.pk, 'name': job.name,
+            'status': Job.STATUS_NAMES[job.status],
+            'attempts': job.attempts,
+            'created': job.created.isoformat(),
+            'started': job.started and job.started.isoformat(),
+            'finished': job.finished and job.finished.isoformat(),
+            # The last line of the traceback
+            'error': job.error.strip().splitlines()[-1] if job.error
+                     else None}
@@ -0,0 +1,137 @@
+import datetime
+import json
+import logging
+import resource
+import sys
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext, override_settings, \
+        setup_test_environment, teardown_test_environment
+
+from budget.caching import budget_cache
+from budget.models import UserProfile
+
+VIEWS = ('budget', 'accounts', 'account', 'add_transaction', 'add_transfer')
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+def view_url(view, account):
+    if view == 'budget':
+        return reverse('index')
+    if view == 'account':
+        return reverse('budget.views.account', kwargs={'id': account.pk})
+    if view in ('add_transaction', 'add_transfer'):
+        return reverse('budget.views.' + view,
+                       kwargs={'account_id': account.pk})
+    return reverse('budget.views.' + view)
+
+def max_rss():
+    # Kilobytes on Linux, bytes on OS X
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+class Command(BaseCommand):
+    args = "[transactions per account ...]"
+    help = ("Generates data sets in a test database and times the budget, "
+            "accounts, account, add_transaction and add_transfer views for "
+            "each of them. Writes the p50/p95 latency, the queries and the "
+            "peak memory as JSON, compare two runs with --compare.")
+    option_list = BaseCommand.option_list + (
+        make_option('--accounts', dest='accounts', type='int', default=3),
+        make_option('--months', dest='months', type='int', default=24),
+        make_option('--transfer-ratio', dest='transfer_ratio', type='float',
+                    default=0.1),
+        make_option('--repeat', dest='repeat', type='int', default=20,
+                    help="Requests per view and data set."),
+        make_option('--cold', action='store_true', dest='cold',
+                    default=False,
+                    help="Clear the budget cache before every request."),
+        make_option('--output', '-o', dest='output',
+                    help="Write the results to this JSON file."),
+        make_option('--compare', dest='compare',
+                    help="Print the changes against an earlier result file."),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in args] or [100, 1000, 10000]
+        except ValueError:
+            raise CommandError("The sizes are numbers of transactions")
+        # The timings of every request would drown the report
+        logging.getLogger('budget.instrumentation').setLevel(logging.WARNING)
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(BUDGET_VIEW_BUDGETS={}, DEBUG=False):
+                results = [result for size in sizes
+                           for result in self.run(size, options)]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                           'repeat': options['repeat'],
+                           'cold': options['cold'],
+                           'accounts': options['accounts'],
+                           'months': options['months'],
+                           'transfer_ratio': options['transfer_ratio'],
+                           'database': settings.DATABASES['default']['ENGINE']},
+                  'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        else:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        if options['compare']:
+            with open(options['compare']) as previous:
+                self.compare(json.load(previous)['results'], results)
+
+    def run(self, size, options):
+        prefix = "bench{}x".format(size)
+        call_command('generate_data', users=1, accounts=options['accounts'],
+                     transactions=size, months=options['months'],
+                     transfer_ratio=options['transfer_ratio'], prefix=prefix,
+                     stdout=self.stderr)
+        profile = UserProfile.objects.get(user__username=prefix + "0")
+        account = profile.accounts.order_by('pk')[0]
+        client = Client()
+        client.login(username=profile.user.username,
+                     password=profile.user.username)
+        for view in VIEWS:
+            url = view_url(view, account)
+            timings, queries = [], 0
+            for _ in range(options['repeat']):
+                if options['cold']:
+                    budget_cache().clear()
+                with CaptureQueriesContext(connection) as context:
+                    start = time.time()
+                    response = client.get(url)
+                    timings.append((time.time() - start) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(u"{} answered {}".format(
+                            url, response.status_code))
+                queries = max(queries, len(context))
+            yield {'size': size, 'view': view,
+                   'p50_ms': round(percentile(timings, 0.5), 1),
+                   'p95_ms': round(percentile(timings, 0.95), 1),
+                   'queries': queries, 'max_rss_kb': max_rss()}
+
+    def compare(self, previous, results):
+        before = dict(((row['size'], row['view']), row) for row in previous)
+        for row in results:
+            old = before.get((row['size'], row['view']))
+            if old is None:
+                continue
+            self.stdout.write(u"{size:>7} {view:<16} p50 {:>+8.1f} ms  "
+                              u"p95 {:>+8.1f} ms  queries {:>+4}".format(
+                    row['p50_ms'] - old['p50_ms'],
+                    row['p95_ms'] - old['p95_ms'],
+                    row['queries'] - old['queries'], **row))
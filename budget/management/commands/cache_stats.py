@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from budget import caching
+
+class Command(BaseCommand):
+    help = "Shows the hits and misses of the sidebar and budget grid cache."
+    option_list = BaseCommand.option_list + (
+        make_option('--clear', action='store_true', dest='clear',
+                    default=False,
+                    help="Empty the cache, including the counters."),
+    )
+
+    def handle(self, *args, **options):
+        hits, misses = caching.stats()
+        total = hits + misses
+        self.stdout.write("{} hit(s), {} miss(es), hit rate {:.0%}".format(
+                hits, misses, float(hits) / total if total else 0))
+        if options['clear']:
+            caching.budget_cache().clear()
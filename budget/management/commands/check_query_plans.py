@@ -0,0 +1,99 @@
+import datetime
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from budget.models import Account, Budget, CategoryGroup, UserProfile, \
+        pending_occurrences
+from budget.views import register_querysets
+
+# "SCAN t", "SCAN TABLE t" in older SQLite versions, possibly followed by
+# "USING [COVERING] INDEX i" for a walk over a whole index
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+INDEX_SEARCH = re.compile(r'^SEARCH (?:TABLE )?(\w+) USING (?:COVERING )?'
+                          r'INDEX \w+ \((.*)\)$')
+# A search on nothing but flags still reads most of the table
+FLAGS = set(['implemented', 'cleared', 'reconciled', 'on_budget',
+             'budgeted', 'default'])
+# Sorting the rows instead of reading them in index order, which reads
+# all of them before a LIMIT
+SORT = re.compile(r'^USE TEMP B-TREE FOR (?:RIGHT PART OF |LAST TERM OF )?'
+                  r'ORDER BY')
+
+def scanned_table(step):
+    match = FULL_SCAN.match(step)
+    if match:
+        return match.group(1)
+    match = INDEX_SEARCH.match(step)
+    if match and set(re.findall(r'(\w+)[=<>]', match.group(2))) <= FLAGS:
+        return match.group(1)
+    return None
+
+def problems(plan):
+    """Returns the scanned tables and sorts of an EXPLAIN QUERY PLAN"""
+    found = filter(None, map(scanned_table, plan))
+    if any(SORT.match(step) for step in plan):
+        found.append("sort")
+    return found
+
+def critical_querysets():
+    """
+    Returns (name, queryset) pairs of the queries behind the register, the
+    balances, the budget grid and the schedules. The plans do not depend
+    on the data, so unsaved objects stand in for the user's.
+    """
+    user = UserProfile(pk=1)
+    account = Account(pk=1, user=user)
+    budget = Budget(pk=1, user=user)
+    day = datetime.date.today()
+    key = (day, timezone.now(), 1, 0)
+    # The user register runs the same per account queries
+    for suffix, cursor in (("", None), (" older page", key)):
+        for side, queryset in register_querysets(user, account, cursor, 51):
+            yield ("account register" + suffix +
+                   (" transfers" if side else "")), queryset
+    for name, queryset in (
+            ("account balance", account.implemented_transactions),
+            ("account transfer balance", account.implemented_transfers_to)):
+        for suffix, rows in (("", queryset),
+                             (" since", queryset.filter(date__gt=day))):
+            yield name + suffix, rows.order_by().values('cleared').annotate(
+                    Sum('inflow'), Sum('outflow'))
+    yield "category group budget", budget.categorybudget_set.filter(
+            category__group=CategoryGroup(pk=1)).values('budget').annotate(
+                    Sum('amount'))
+    yield "due occurrences", pending_occurrences(day)
+
+class Command(BaseCommand):
+    help = ("Runs EXPLAIN QUERY PLAN on the critical queries and fails when "
+            "any of them scans a whole table, searches it by flags only or "
+            "sorts the register instead of reading an index in order, "
+            "e.g. because an index is "
+            "missing. Databases created before an index was added get it "
+            "from the output of 'manage.py sqlindexes budget'.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("Only SQLite query plans can be checked")
+        verbosity = int(options['verbosity'])
+        cursor = connection.cursor()
+        scans = []
+        for name, queryset in critical_querysets():
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+            tables = problems(plan)
+            if tables:
+                scans.append(u"{}: {}".format(name, u", ".join(tables)))
+            if verbosity > 1 or tables:
+                self.stdout.write(name)
+                for step in plan:
+                    self.stdout.write(u"    " + step)
+        if scans:
+            raise CommandError(u"Full table scans or sorts in {}".format(
+                    u"; ".join(scans)))
+        if verbosity:
+            self.stdout.write("All query plans use indexes")
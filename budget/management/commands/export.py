@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from budget import exporters
+from budget.models import Account, UserProfile
+
+class Command(BaseCommand):
+    args = "transactions|budget"
+    help = ("Exports the transactions or budget months of a user, or the "
+            "transactions of one account, as CSV or JSON.")
+    option_list = BaseCommand.option_list + (
+        make_option('--user', dest='user',
+                    help="Username whose data is exported."),
+        make_option('--account', dest='account',
+                    help="Only export the transactions of this account id."),
+        make_option('--format', dest='format', default='csv',
+                    choices=sorted(exporters.WRITERS)),
+        make_option('--output', '-o', dest='output',
+                    help="File to write to, standard output if not given."),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=exporters.CHUNK_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ('transactions', 'budget'):
+            raise CommandError("Usage: export {}".format(self.args))
+        account = user = None
+        if options['account']:
+            try:
+                account = Account.objects.select_related('user').get(
+                        pk=options['account'])
+            except (Account.DoesNotExist, ValueError):
+                raise CommandError("No account with id {}".format(
+                        options['account']))
+            user = account.user
+        if options['user']:
+            try:
+                user = UserProfile.objects.get(
+                        user__username=options['user'])
+            except UserProfile.DoesNotExist:
+                raise CommandError("No user {}".format(options['user']))
+        if user is None or account and account.user_id != user.pk:
+            raise CommandError("Give the --user and/or the --account to "
+                               "export")
+        if args[0] == 'budget':
+            fields = exporters.BUDGET_MONTH_FIELDS
+            rows = exporters.budget_month_rows(user, options['chunk_size'])
+        else:
+            fields = exporters.TRANSACTION_FIELDS
+            rows = exporters.transaction_rows(user, account,
+                                              options['chunk_size'])
+        chunks = exporters.WRITERS[options['format']](fields, rows)
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
@@ -0,0 +1,107 @@
+import datetime
+import random
+from decimal import Decimal
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from budget.models import Account, Budget, Category, CategoryBudget, \
+        Transaction, UserProfile, add_months, index_new_transactions, \
+        insert_transfer_rows
+
+PAYEES = ("Supermarket", "Bakery", "Gas Station", "Pharmacy", "Restaurant",
+          "Online Shop", "Landlord", "Power Company", "Cinema", "Book Store",
+          "Hardware Store", "Insurance", "Phone Company", "Cafe", "Employer")
+
+class Command(BaseCommand):
+    help = ("Generates users with accounts, transactions, transfers and "
+            "budgets for benchmarks. Every generated user has the password "
+            "of its name.")
+    option_list = BaseCommand.option_list + (
+        make_option('--users', dest='users', type='int', default=1),
+        make_option('--accounts', dest='accounts', type='int', default=3,
+                    help="Accounts per user."),
+        make_option('--transactions', dest='transactions', type='int',
+                    default=1000, help="Transactions per account."),
+        make_option('--transfer-ratio', dest='transfer_ratio', type='float',
+                    default=0.1,
+                    help="Share of the transactions that are transfers."),
+        make_option('--months', dest='months', type='int', default=24,
+                    help="Months of history, all of them budgeted."),
+        make_option('--prefix', dest='prefix', default='bench',
+                    help="Prefix of the generated usernames."),
+        make_option('--seed', dest='seed', type='int', default=0),
+    )
+
+    def handle(self, *args, **options):
+        if options['accounts'] < 1 or options['months'] < 1:
+            raise CommandError("Every user needs an account and a month")
+        self.random = random.Random(options['seed'])
+        first = add_months(datetime.date.today(), 1 - options['months'])
+        self.days = (datetime.date.today() - first).days + 1
+        self.first = first
+        categories = list(Category.objects.filter(budgeted=True,
+                                                  group__budgeted=True))
+        if not categories:
+            raise CommandError("No budgeted categories, load the fixtures "
+                               "first")
+        existing = User.objects.filter(
+                username__startswith=options['prefix']).count()
+        with transaction.atomic():
+            for number in range(existing, existing + options['users']):
+                self.generate_user("{}{}".format(options['prefix'], number),
+                                   categories, options)
+        call_command('rebuild_balances', stdout=self.stdout)
+
+    def generate_user(self, name, categories, options):
+        user = User.objects.create_user(name, password=name)
+        profile = UserProfile.objects.create(user=user)
+        profile.categories.add(*categories)
+        accounts = [Account.objects.create(name="Account {}".format(i),
+                user=profile, type=Account.TYPE_CHECKING,
+                on_budget=i > 0 or options['accounts'] == 1,
+                starting_balance=Decimal(self.random.randint(0, 5000)))
+                for i in range(options['accounts'])]
+        for account in accounts:
+            self.generate_transactions(account, accounts, categories, options)
+        for i in range(options['months']):
+            budget = Budget.objects.create(user=profile,
+                                           month=add_months(self.first, i))
+            CategoryBudget.objects.bulk_create([CategoryBudget(budget=budget,
+                    category=category, amount=self.amount(50))
+                    for category in categories])
+        self.stdout.write("Generated {}".format(name))
+
+    def amount(self, mean):
+        return Decimal(int(self.random.expovariate(1.0 / mean) * 100)) / 100
+
+    def generate_transactions(self, account, accounts, categories, options):
+        others = [other for other in accounts if other != account]
+        for start in range(0, options['transactions'], 500):
+            rows, transfers = [], {}
+            for i in range(start, min(start + 500, options['transactions'])):
+                row = Transaction(account=account, cleared=self.random.random()
+                                  < 0.9, date=self.first + datetime.timedelta(
+                                      days=self.random.randrange(self.days)))
+                if others and self.random.random() < options['transfer_ratio']:
+                    row.memo = "Generated transfer {}".format(i)
+                    row.outflow = self.amount(200)
+                    transfers[row.memo] = self.random.choice(others).pk
+                elif self.random.random() < 0.05:
+                    row.payee, row.inflow = "Employer", self.amount(2000)
+                else:
+                    row.payee = self.random.choice(PAYEES[:-1])
+                    row.category = self.random.choice(categories)
+                    row.outflow = self.amount(40)
+                rows.append(row)
+            Transaction.objects.bulk_create(rows)
+            index_new_transactions()
+            # bulk_create does not return the ids, the transfer parents
+            # are found by their memo, unique within the account
+            insert_transfer_rows([(pk, transfers[memo]) for pk, memo in
+                    Transaction.objects.filter(account=account,
+                            memo__in=list(transfers)).\
+                    values_list('pk', 'memo')])
@@ -0,0 +1,43 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from budget.importers import PARSERS, StatementError, import_transactions
+from budget.models import Account
+
+class Command(BaseCommand):
+    args = "<account id> <statement file>"
+    help = "Imports the transactions of a CSV, QIF or OFX bank statement."
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=sorted(PARSERS),
+                    help="Statement format, guessed from the file extension "
+                         "if not given."),
+        make_option('--date-format', dest='date_format',
+                    help="strptime format of the dates, e.g. %d.%m.%Y"),
+        make_option('--encoding', dest='encoding', default='utf-8'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: import_transactions {}".format(self.args))
+        try:
+            account = Account.objects.get(pk=args[0])
+        except (Account.DoesNotExist, ValueError):
+            raise CommandError("No account with id {}".format(args[0]))
+        format = options['format'] or \
+                os.path.splitext(args[1])[1].lstrip('.').lower()
+        if format not in PARSERS:
+            raise CommandError("Unknown statement format '{}'".format(format))
+        with open(args[1], 'rb') as statement:
+            rows = PARSERS[format](statement, options['date_format'],
+                                   options['encoding'])
+            try:
+                imported, skipped = import_transactions(account, rows,
+                                                        options['batch_size'])
+            except (StatementError, LookupError, UnicodeDecodeError) as e:
+                raise CommandError(e)
+        self.stdout.write("Imported {} transaction(s), skipped {} already "
+                          "imported".format(imported, skipped))
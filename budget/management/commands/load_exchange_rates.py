@@ -0,0 +1,80 @@
+import csv
+from decimal import Decimal, InvalidOperation
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from budget.caching import rates_changed
+from budget.models import Currency, ExchangeRate
+
+def read_rates(lines, base):
+    """
+    Yields (currency code, date, rate) of a CSV file with a Date column
+    and one column of rates per currency, like the ECB reference rate
+    history; the ``base`` currency gets the rate 1 on every date.
+    """
+    reader = csv.reader(lines)
+    try:
+        header = [column.strip().upper() for column in next(reader)]
+    except StopIteration:
+        return
+    if not header or header[0] != 'DATE':
+        raise CommandError("The first column has to be the date")
+    for line, row in enumerate(reader, 2):
+        if not row or not row[0].strip():
+            continue
+        day = parse_date(row[0].strip())
+        if day is None:
+            raise CommandError(u"Line {}: invalid date '{}'".format(line,
+                                                                  row[0]))
+        yield base, day, Decimal(1)
+        for code, value in zip(header[1:], row[1:]):
+            value = value.strip()
+            # Trailing commas, and no rate on that date
+            if not code or not value or value == 'N/A':
+                continue
+            try:
+                yield code, day, Decimal(value)
+            except InvalidOperation:
+                raise CommandError(u"Line {}: invalid {} rate '{}'".format(
+                        line, code, value))
+
+class Command(BaseCommand):
+    args = "<rates file>"
+    help = ("Loads dated exchange rates from a CSV file with a Date column "
+            "and one column per currency code, e.g. the ECB reference rates "
+            "(eurofxref-hist.csv). Replaces the rates of its currencies in "
+            "its date range and creates missing currencies.")
+    option_list = BaseCommand.option_list + (
+        make_option('--base', dest='base', default='EUR',
+                    help="Currency the rates are quoted against."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: load_exchange_rates {}".format(
+                    self.args))
+        base = options['base'].upper()
+        with open(args[0], 'rb') as lines:
+            rates = list(read_rates(lines, base))
+        codes = set(code for code, _, _ in rates)
+        days = sorted(set(day for _, day, _ in rates))
+        with transaction.atomic():
+            existing = set(Currency.objects.filter(pk__in=codes).\
+                    values_list('pk', flat=True))
+            Currency.objects.bulk_create([Currency(code=code, name=code,
+                                                   symbol=code)
+                                          for code in codes - existing])
+            if days:
+                # Without signals, the cache is cleared once below
+                ExchangeRate.objects.filter(currency__in=codes,
+                        date__range=(days[0], days[-1]))._raw_delete(
+                                ExchangeRate.objects.db)
+            ExchangeRate.objects.bulk_create([ExchangeRate(currency_id=code,
+                    date=day, rate=rate) for code, day, rate in rates],
+                    batch_size=500)
+        rates_changed()
+        self.stdout.write("Loaded {} rate(s) of {} currencies on {} "
+                          "date(s)".format(len(rates), len(codes), len(days)))
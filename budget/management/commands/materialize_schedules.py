@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from budget.models import materialize_schedules
+
+class Command(BaseCommand):
+    help = ("Creates the due occurrences of the scheduled transactions and "
+            "implements pending occurrences whose date has come. Meant to "
+            "run daily.")
+    option_list = BaseCommand.option_list + (
+        make_option('--days-ahead', dest='days_ahead', type='int',
+                    default=getattr(settings, 'BUDGET_SCHEDULE_DAYS_AHEAD',
+                                    30),
+                    help="Also create pending occurrences up to this many "
+                         "days in the future."),
+    )
+
+    def handle(self, *args, **options):
+        created, implemented = materialize_schedules(
+                days_ahead=options['days_ahead'])
+        self.stdout.write("Created {} occurrence(s), implemented {} pending "
+                          "occurrence(s)".format(created, implemented))
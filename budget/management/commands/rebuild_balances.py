@@ -0,0 +1,68 @@
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from budget.models import Account, BalanceCheckpoint, CategoryMonth, \
+        UserProfile, compute_category_months, sync_transfer_copies, \
+        touch_users
+
+CENT = Decimal('0.01')
+
+def cents(value):
+    # SQLite keeps decimals as floats, sums drift below a cent
+    return Decimal(value).quantize(CENT)
+
+def category_month_key(row):
+    return (row.user_id, row.category_id, row.month, cents(row.budgeted),
+            cents(row.inflow), cents(row.outflow), cents(row.carried_over))
+
+class Command(BaseCommand):
+    help = ("Recomputes the stored account balances and category months "
+            "from the transactions and budgets, drops the balance "
+            "checkpoints and copies the transfer dates for the register.")
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check',
+                    default=False,
+                    help="Only report out of date balances and category months."),
+    )
+
+    def handle(self, *args, **options):
+        check = options['check']
+        wrong = 0
+        with transaction.atomic():
+            for account in Account.objects.select_for_update().order_by('pk'):
+                cleared, uncleared = account.compute_balances()
+                if cents(cleared) == cents(account.cleared_balance) and \
+                        cents(uncleared) == cents(account.uncleared_balance):
+                    continue
+                wrong += 1
+                self.stdout.write(u"{} (#{}): stored {:.2f}/{:.2f}, "
+                                  u"computed {:.2f}/{:.2f}".format(
+                        account, account.pk, account.cleared_balance,
+                        account.uncleared_balance, cleared, uncleared))
+                if not check:
+                    Account.objects.filter(pk=account.pk).update(
+                            cleared_balance=cleared,
+                            uncleared_balance=uncleared)
+            rows = compute_category_months()
+            stored = set(category_month_key(row) for row in 
+                         CategoryMonth.objects.select_for_update())
+            computed = set(category_month_key(row) for row in rows)
+            wrong_months = len(stored ^ computed)
+            if wrong_months and not check:
+                CategoryMonth.objects.all().delete()
+                CategoryMonth.objects.bulk_create(rows)
+            if not check:
+                # Checkpoints are recreated on demand
+                BalanceCheckpoint.objects.all().delete()
+                sync_transfer_copies()
+                if wrong or wrong_months:
+                    touch_users(UserProfile.objects.all())
+        if check and (wrong or wrong_months):
+            raise CommandError("{} account balance(s) and {} category month(s) "
+                               "out of date".format(wrong, wrong_months))
+        if not check:
+            self.stdout.write("Rebuilt {} account balance(s) and {} category "
+                              "month(s)".format(wrong, wrong_months))
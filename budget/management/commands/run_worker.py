@@ -0,0 +1,61 @@
+import multiprocessing
+import threading
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from budget.jobs import purge, work
+
+def serve(stop, poll, drain):
+    try:
+        work(stop, poll, drain)
+    finally:
+        # Every thread or process has a connection of its own
+        connection.close()
+
+class Command(BaseCommand):
+    help = ("Runs the queued background jobs on a pool of threads, or of "
+            "processes with --processes, until interrupted.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help="SQLite runs one writing job at a time, more "
+                         "workers mostly help other databases."),
+        make_option('--processes', action='store_true', dest='processes',
+                    default=False,
+                    help="Run the workers in processes instead of threads."),
+        make_option('--poll', dest='poll', type='float', default=1.0,
+                    help="Seconds between looks at an empty queue."),
+        make_option('--drain', action='store_true', dest='drain',
+                    default=False,
+                    help="Stop once no job is due."),
+        make_option('--keep-days', dest='keep_days', type='int', default=7,
+                    help="Delete the jobs done longer ago first."),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("At least one worker is needed")
+        purge(options['keep_days'])
+        # Forked processes must not share the connection of this one
+        connection.close()
+        if options['processes']:
+            Worker, stop = multiprocessing.Process, multiprocessing.Event()
+        else:
+            Worker, stop = threading.Thread, threading.Event()
+        workers = [Worker(target=serve, args=(stop, options['poll'],
+                                              options['drain']))
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                # A timeout keeps the main thread open to KeyboardInterrupt
+                for worker in workers:
+                    worker.join(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        self.stdout.write("Stopped {} worker(s)".format(len(workers)))
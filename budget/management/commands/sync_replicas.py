@@ -0,0 +1,41 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from budget.routers import copy_sqlite_database, replicas
+
+class Command(BaseCommand):
+    args = "[replica alias ...]"
+    help = ("Copies the SQLite primary database to the SQLite read "
+            "replicas, by default all of BUDGET_READ_REPLICAS. Other "
+            "databases replicate on their own.")
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', dest='interval', type='float',
+                    help="Copy again every this many seconds until "
+                         "interrupted, below BUDGET_PRIMARY_STICKINESS."),
+    )
+
+    def handle(self, *aliases, **options):
+        aliases = aliases or replicas()
+        if not aliases:
+            raise CommandError("No read replicas configured")
+        databases = connections.databases
+        for alias in (DEFAULT_DB_ALIAS,) + tuple(aliases):
+            if alias not in databases:
+                raise CommandError(u"No database '{}'".format(alias))
+            if not databases[alias]['ENGINE'].endswith('sqlite3'):
+                raise CommandError(u"'{}' is no SQLite database".format(alias))
+        while True:
+            for alias in aliases:
+                copy_sqlite_database(databases[DEFAULT_DB_ALIAS]['NAME'],
+                                     databases[alias]['NAME'])
+                # Connections to the replaced file would read the old one
+                connections[alias].close()
+            if int(options['verbosity']):
+                self.stdout.write(u"Copied the primary to {}".format(
+                        u", ".join(aliases)))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
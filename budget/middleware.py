@@ -0,0 +1,114 @@
+"""
+Optional instrumentation of the budget views
+
+InstrumentationMiddleware measures the SQL queries, the SQL time, the
+template rendering time and the total time of every view in the budget
+app. It sends them in a Server-Timing header and logs them as one JSON
+line to the "budget.instrumentation" logger. Counting the queries keeps
+them all in memory, so the middleware switches itself off unless
+BUDGET_INSTRUMENTATION (by default DEBUG) is set.
+
+BUDGET_VIEW_BUDGETS maps dotted view names (or "*" for all others) to
+limits, e.g. {'budget.views.account': {'queries': 10, 'ms': 300}}.
+Exceeding a limit logs a warning; with BUDGET_VIEW_BUDGETS_STRICT the
+query limits raise ViewBudgetExceeded instead, which fails the tests.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+logger = logging.getLogger('budget.instrumentation')
+
+local = threading.local()
+
+class ViewBudgetExceeded(AssertionError):
+    pass
+
+render_template = Template.render
+
+def timed_render(self, context):
+    # Only the outermost template is timed, included ones are part of it
+    if not getattr(local, 'timing', False):
+        return render_template(self, context)
+    local.timing = False
+    start = time.time()
+    try:
+        return render_template(self, context)
+    finally:
+        local.template_time += time.time() - start
+        local.timing = True
+
+def view_name(view):
+    return u"{}.{}".format(view.__module__, view.__name__)
+
+class InstrumentationMiddleware(object):
+    def __init__(self):
+        if not getattr(settings, 'BUDGET_INSTRUMENTATION', settings.DEBUG):
+            raise MiddlewareNotUsed
+        # Templates are only timed once the middleware is in use
+        if Template.__dict__['render'] is not timed_render:
+            Template.render = timed_render
+
+    def process_request(self, request):
+        request._instrumentation_start = time.time()
+
+    def process_view(self, request, view, args, kwargs):
+        if not view.__module__.startswith('budget.'):
+            return None
+        request._instrumentation = {'view': view_name(view),
+                                    'debug_cursors': {}, 'queries': {}}
+        for connection in connections.all():
+            request._instrumentation['debug_cursors'][connection.alias] = \
+                    connection.use_debug_cursor
+            request._instrumentation['queries'][connection.alias] = \
+                    len(connection.queries)
+            connection.use_debug_cursor = True
+        local.timing, local.template_time = True, 0.0
+        return None
+
+    def process_response(self, request, response):
+        state = getattr(request, '_instrumentation', None)
+        if state is None:
+            return response
+        local.timing = False
+        queries, sql_time = 0, 0.0
+        for connection in connections.all():
+            start = state['queries'].get(connection.alias, 0)
+            executed = connection.queries[start:]
+            queries += len(executed)
+            sql_time += sum(float(query['time']) for query in executed)
+            connection.use_debug_cursor = state['debug_cursors'].get(
+                    connection.alias)
+        stats = {'view': state['view'], 'method': request.method,
+                 'path': request.path, 'status': response.status_code,
+                 'queries': queries, 'sql_ms': round(sql_time * 1000, 1),
+                 'template_ms': round(local.template_time * 1000, 1),
+                 'total_ms': round((time.time() -
+                     request._instrumentation_start) * 1000, 1)}
+        response['Server-Timing'] = ('db;dur={sql_ms};desc="{queries} '
+                                     'queries", tpl;dur={template_ms}, '
+                                     'total;dur={total_ms}').format(**stats)
+        logger.info(json.dumps(stats, sort_keys=True))
+        self.check_budget(stats)
+        return response
+
+    def check_budget(self, stats):
+        budgets = getattr(settings, 'BUDGET_VIEW_BUDGETS', {})
+        budget = budgets.get(stats['view'], budgets.get('*'))
+        if not budget:
+            return
+        if stats['queries'] > budget.get('queries', stats['queries']):
+            message = u"{view} ran {queries} queries, the budget is {}".format(
+                    budget['queries'], **stats)
+            if getattr(settings, 'BUDGET_VIEW_BUDGETS_STRICT', False):
+                raise ViewBudgetExceeded(message)
+            logger.warning(message)
+        if stats['total_ms'] > budget.get('ms', stats['total_ms']):
+            logger.warning(u"{view} took {total_ms} ms, the budget is {} ms".\
+                           format(budget['ms'], **stats))
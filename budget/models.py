@@ -2,20 +2,51 @@
 Django models
 """
 import datetime
+from collections import defaultdict, namedtuple
+from decimal import Decimal
 
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import post_save, pre_save
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, \
+        connections, models, router, transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, \
+        post_syncdb, pre_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core import validators
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.utils.translation import get_language_info
 
+from budget.caching import cached_rates, rates_changed
+
 def money_field(*args, **kwargs):
     return models.DecimalField(max_digits=20, decimal_places=2, blank=False,
                                default=0, *args, **kwargs)
 
+class CopiedFieldMixin(object):
+    """
+    Repeats the field ``source`` of the same instance on save, so that a
+    child table of a multi-table model can index it.
+    """
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        super(CopiedFieldMixin, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        # The parent rows are saved first, with their auto_now_add values
+        value = getattr(model_instance, self.source)
+        setattr(model_instance, self.attname, value)
+        return value
+
+class CopiedDateField(CopiedFieldMixin, models.DateField):
+    pass
+
+class CopiedDateTimeField(CopiedFieldMixin, models.DateTimeField):
+    pass
+
 def today_is_the_day(weekday):
     return lambda: datetime.date().isoweekday() == weekday
 
@@ -32,13 +63,85 @@ def first_of_this_month():
     today = datetime.date(day=1, month=today.month, year=today.year)
     return today
 
+def add_months(day, months):
+    """Returns the first of the month ``months`` months after ``day``"""
+    years, month = divmod(day.month - 1 + months, 12)
+    return datetime.date(day.year + years, month + 1, 1)
+
+def month_end(day):
+    return add_months(day, 1) - datetime.timedelta(days=1)
+
 class Currency(models.Model):
     code = models.CharField(max_length=3, primary_key=True)
     name = models.CharField(max_length=32, blank=False)
     symbol = models.CharField(max_length=5, blank=False)
 
     def __unicode__(self):
-        return "{} ({})".format(sefl.name, self.code)
+        return u"{} ({})".format(self.name, self.code)
+
+class ExchangeRate(models.Model):
+    """
+    How many units of ``currency`` one unit of the reference currency
+    bought on ``date``. All rates share one reference currency, whose own
+    rate is 1, so any two currencies convert through it.
+    """
+    currency = models.ForeignKey(Currency, related_name="rates")
+    date = models.DateField()
+    rate = models.DecimalField(max_digits=20, decimal_places=10)
+
+    class Meta:
+        unique_together = ('currency', 'date')
+
+    def __unicode__(self):
+        return u"{} {} on {}".format(self.rate, self.currency_id, self.date)
+
+def exchange_rates(codes, day):
+    """
+    Returns {currency code: rate} of the latest rates of the currencies
+    ``codes`` on or before ``day``, loaded with one query and memoized in
+    the budget cache until rates are loaded again.
+    """
+    codes = sorted(codes)
+    def compute():
+        quote = connection.ops.quote_name
+        latest = ("{0}.{1} = (SELECT MAX(other.{1}) FROM {0} other "
+                  "WHERE other.{2} = {0}.{2} AND other.{1} <= %s)").format(
+                          quote(ExchangeRate._meta.db_table), quote('date'),
+                          quote('currency_id'))
+        return dict(ExchangeRate.objects.filter(currency__in=codes).extra(
+                where=[latest], params=[day]).values_list('currency', 'rate'))
+    return cached_rates(compute, day, *codes)
+
+CENT = Decimal('0.01')
+
+def currency_totals(groups, to, day=None):
+    """
+    Converts the {currency code: amount} dicts in ``groups`` to the
+    currency ``to`` with the rates of ``day`` (today by default) and
+    returns their totals, None for a total lacking a rate. Amounts without
+    a currency are in ``to`` already. The rates of all currencies are
+    looked up at once and every currency is converted once per total.
+    """
+    codes = set(code for sums in groups for code in sums if code)
+    if to is None and len(codes) == 1:
+        to = codes.pop()
+    codes.discard(to)
+    rates = {}
+    if codes:
+        rates = exchange_rates(codes | set([to]), day or datetime.date.today())
+    totals = []
+    for sums in groups:
+        total = Decimal(0)
+        for code, amount in sums.items():
+            if code is None or code == to:
+                total += amount
+            elif code in rates and to in rates:
+                total += amount * rates[to] / rates[code]
+            else:
+                total = None
+                break
+        totals.append(total if total is None else total.quantize(CENT))
+    return totals
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, related_name="budget_profile")
@@ -46,13 +149,120 @@ class UserProfile(models.Model):
                                 ("en", get_language_info("en")['name_local']), 
                                 ("de", get_language_info("de")['name_local'])),
                                 default="en")
+    # Bumped whenever the accounts, transactions or budgets of the user
+    # change, see touch_users()
+    data_version = models.PositiveIntegerField(default=0, editable=False)
+    data_modified = models.DateTimeField(default=timezone.now,
+                                         editable=False)
+    # Bumped only when the accounts or categories change, for the cached
+    # choices of the forms
+    choices_version = models.PositiveIntegerField(default=0, editable=False)
+    # The accounts without a currency of their own are in this one, and the
+    # totals are converted to it
+    currency = models.ForeignKey(Currency, null=True, blank=True,
+                                 related_name="+")
 
     def __unicode__(self):
         return self.user.username
 
+    def account_balances(self):
+        """
+        Returns the accounts of the user with their balances and the on
+        and off budget subtotals, loaded with a single query. The result is
+        kept on this instance, so it is computed once per request.
+
+        The subtotals are converted to the currency of the user, None if a
+        rate is missing. ``native_sum`` adds up the balances as they are,
+        like the rows of the register do.
+        """
+        balances = getattr(self, '_account_balances', None)
+        if balances is None:
+            balances = {'accounts': list(self.accounts.order_by('name')),
+                        'budget_accounts': [], 'off_budget_accounts': [],
+                        'currency': self.currency_id, 'native_sum': 0}
+            sums = {True: defaultdict(int), False: defaultdict(int)}
+            for account in balances['accounts']:
+                if account.on_budget:
+                    balances['budget_accounts'].append(account)
+                else:
+                    balances['off_budget_accounts'].append(account)
+                sums[account.on_budget][account.currency_id] += account.saldo
+                balances['native_sum'] += account.saldo
+            balances['budget_sum'], balances['off_budget_sum'] = \
+                    currency_totals([sums[True], sums[False]],
+                                    self.currency_id)
+            if None in (balances['budget_sum'], balances['off_budget_sum']):
+                balances['total_sum'] = None
+            else:
+                balances['total_sum'] = balances['budget_sum'] + \
+                        balances['off_budget_sum']
+            self._account_balances = balances
+        return balances
+
+    def category_months_between(self, first, last):
+        """
+        Returns the CategoryMonth rows of the user between the months
+        ``first`` and ``last`` together with the last row before ``first``
+        of every category, which carries its balance into the range.
+        """
+        table = connection.ops.quote_name(CategoryMonth._meta.db_table)
+        latest_before = ("{0}.month >= %s OR {0}.month = ("
+                         "SELECT MAX(previous.month) FROM {0} previous "
+                         "WHERE previous.user_id = {0}.user_id "
+                         "AND previous.category_id IS {0}.category_id "
+                         "AND previous.month < %s)").format(table)
+        return self.category_months.filter(month__lte=last).extra(
+                where=[latest_before], params=[first, first]).\
+                order_by('month')
+
+    def net_worth_by_month(self, first, last):
+        """
+        Returns a list of (month end, net worth) for the months ``first``
+        to ``last`` from the month end checkpoints of the accounts and the
+        monthly sums after the latest of them. Missing checkpoints are not
+        created here, so that reading never writes; the refresh_user job
+        creates them.
+        """
+        months = []
+        month = first.replace(day=1)
+        while month <= last:
+            months.append(month_end(month))
+            month = add_months(month, 1)
+        accounts = dict(self.accounts.values_list('pk', 'starting_balance'))
+        checkpoints = defaultdict(dict)
+        for account_id, day, amount in BalanceCheckpoint.objects.filter(
+                account__in=list(accounts), date__lte=months[-1]).\
+                values_list('account_id', 'date', 'amount'):
+            checkpoints[account_id][day] = amount
+        latest = dict((account_id, max(checkpoints[account_id]) if
+                       checkpoints[account_id] else None)
+                      for account_id in accounts)
+        # One query per table for all accounts, from the oldest checkpoint
+        after = None if None in latest.values() else min(latest.values() or
+                                                          [None])
+        changes = defaultdict(list)
+        for (account_id, month), amount in sorted(monthly_sums(
+                list(accounts), after, months[-1]).items()):
+            if latest[account_id] is None or month > latest[account_id]:
+                changes[account_id].append((month, amount))
+        net_worth = dict((day, sum(accounts.values())) for day in months)
+        for account_id, day in latest.items():
+            amount, index = checkpoints[account_id].get(day, 0), 0
+            for month in months:
+                if day and month <= day:
+                    # No checkpoint before the first month with transactions
+                    net_worth[month] += checkpoints[account_id].get(month, 0)
+                    continue
+                while index < len(changes[account_id]) and \
+                        changes[account_id][index][0] <= month:
+                    amount += changes[account_id][index][1]
+                    index += 1
+                net_worth[month] += amount
+        return [(day, net_worth[day]) for day in months]
+
     @property
     def total_accounts_sum(self):
-        return sum(account.saldo for account in self.accounts.all())
+        return self.account_balances()['total_sum']
 
     @property
     def budget_accounts(self):
@@ -60,7 +270,7 @@ class UserProfile(models.Model):
 
     @property
     def budget_accounts_sum(self):
-        return sum(account.saldo for account in self.budget_accounts)
+        return self.account_balances()['budget_sum']
 
     @property
     def off_budget_accounts(self):
@@ -68,7 +278,7 @@ class UserProfile(models.Model):
 
     @property
     def off_budget_accounts_sum(self):
-        return sum(account.saldo for account in self.off_budget_accounts)
+        return self.account_balances()['off_budget_sum']
 
 
 class Account(models.Model):
@@ -100,39 +310,218 @@ class Account(models.Model):
     line_of_credit = money_field()
     starting_balance = money_field() 
     on_budget = models.BooleanField(default=True, blank=False)
+    # Empty for the currency of the user
+    currency = models.ForeignKey(Currency, null=True, blank=True,
+                                 related_name="accounts")
+    # Sums over the account's transactions and incoming transfers, kept
+    # current by the signal handlers at the end of this module.
+    cleared_balance = money_field(editable=False)
+    uncleared_balance = money_field(editable=False)
 
     class Meta:
         unique_together = ('name','user')
 
     def __unicode__(self):
         return self.name
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        # Only the ledger writes the stored balances, this instance may
+        # have been loaded before the last change of them
+        if update_fields is None and not force_insert and \
+                not self._state.adding:
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name not in
+                             ('cleared_balance', 'uncleared_balance')]
+        super(Account, self).save(force_insert, force_update, using,
+                                  update_fields)
+
+    def delete(self, using=None):
+        # Without one delete signal per transaction: the transactions go
+        # with delete_transactions(), the transfers to the account lose
+        # their to_account
+        with transaction.atomic(using=using):
+            delete_transactions(ledger_rows(self.transactions.all()))
+            delta = LedgerDelta()
+            for pk, user_id, state in ledger_rows(Transaction.objects.filter(
+                    transfer__to_account=self)):
+                delta.remove(state)
+                delta.add(state and state._replace(to_account_id=None))
+            delta.apply()
+            super(Account, self).delete(using)
     
     @property
     def saldo(self):
-        saldo = self.starting_balance
-        transactions = self.implemented_transactions.aggregate(models.Sum('outflow'),
-                                                               models.Sum('inflow'))
-        saldo -= transactions['outflow__sum'] or 0
-        saldo += transactions['inflow__sum'] or 0
-        transfers_to = self.implemented_transfers_to.aggregate(models.Sum('outflow'), 
-                                                               models.Sum('inflow'))
-        saldo += transfers_to['outflow__sum'] or 0 
-        saldo -= transfers_to['inflow__sum'] or 0
-        return saldo
+        return self.starting_balance + self.cleared_balance + \
+                self.uncleared_balance
+
+    @property
+    def cleared_saldo(self):
+        return self.starting_balance + self.cleared_balance
+
+    def compute_balances(self):
+        """
+        Aggregates the cleared and uncleared balance from the transactions
+        instead of using the stored columns.
+        """
+        balances = {True: 0, False: 0}
+        transactions = self.implemented_transactions.order_by().\
+                values('cleared').annotate(models.Sum('outflow'),
+                                           models.Sum('inflow'))
+        for row in transactions:
+            balances[row['cleared']] += (row['inflow__sum'] or 0) - \
+                    (row['outflow__sum'] or 0)
+        transfers_to = self.implemented_transfers_to.order_by().\
+                values('cleared').annotate(models.Sum('outflow'),
+                                           models.Sum('inflow'))
+        for row in transfers_to:
+            balances[row['cleared']] += (row['outflow__sum'] or 0) - \
+                    (row['inflow__sum'] or 0)
+        return balances[True], balances[False]
+
+    def monthly_sums(self, after=None, until=None, using=None):
+        """
+        Returns how much the transactions dated after ``after`` up to and
+        including ``until`` changed the balance, summed per month, read
+        from the database ``using`` (the one for reading by default).
+        """
+        return dict((month, amount) for (_, month), amount in
+                    monthly_sums([self.pk], after, until, using).items())
+
+    def update_checkpoints(self, until):
+        """
+        Creates the missing checkpoints up to the last month end on or
+        before ``until`` and returns the latest of them, or None if the
+        account has no transactions until then.
+
+        The account row stays locked from reading the sums until the
+        checkpoints are written. Writes of transactions update it before
+        deleting the checkpoints after them, so they either wait for the
+        new checkpoints and delete them, or commit before the sums are
+        read.
+        """
+        if month_end(until) != until:
+            until = until.replace(day=1) - datetime.timedelta(days=1)
+        using = router.db_for_write(BalanceCheckpoint, instance=self)
+        latest = self.checkpoints.using(using).filter(date__lte=until).\
+                order_by('-date').first()
+        if latest and latest.date == until:
+            return latest
+        with transaction.atomic(using=using):
+            list(Account.objects.using(using).select_for_update().filter(
+                    pk=self.pk).values_list('pk'))
+            latest = self.checkpoints.using(using).filter(date__lte=until).\
+                    order_by('-date').first()
+            if latest and latest.date == until:
+                return latest
+            sums = self.monthly_sums(latest and latest.date, until, using)
+            if latest:
+                month, amount = add_months(latest.date, 1), latest.amount
+            elif sums:
+                month, amount = min(sums), 0
+            else:
+                return None
+            checkpoints = []
+            while month <= until:
+                amount += sums.get(month, 0)
+                checkpoints.append(BalanceCheckpoint(account=self,
+                        amount=amount, date=month_end(month)))
+                month = add_months(month, 1)
+            try:
+                with transaction.atomic(using=using):
+                    BalanceCheckpoint.objects.using(using).bulk_create(
+                            checkpoints)
+            except IntegrityError:
+                # Written meanwhile by another process, from the same sums
+                return self.checkpoints.using(using).filter(
+                        date__lte=until).order_by('-date').first()
+        return checkpoints[-1] if checkpoints else latest
+
+    def balance_at(self, day):
+        """
+        Returns the balance at the end of ``day``, computed from the last
+        month end checkpoint before it and the transactions since.
+        """
+        checkpoint = self.update_checkpoints(day)
+        balance = self.starting_balance
+        if checkpoint:
+            balance += checkpoint.amount
+        if not checkpoint or checkpoint.date < day:
+            balance += sum(self.monthly_sums(checkpoint and checkpoint.date,
+                                             day).values())
+        return balance
 
     @property
     def implemented_transactions(self):
-        return self.transactions.exclude(
-                Q(pk__in=ScheduledTransaction.objects.values_list('transaction_ptr_id', 
-                                                                  flat=True)) | \
-                Q(pk__in=ScheduledTransfer.objects.values_list('transaction_ptr_id',
-                                                               flat=True)))
+        return self.transactions.filter(implemented=True)
 
     @property
     def implemented_transfers_to(self):
-        return self.transfers_to.exclude(
-                Q(pk__in=ScheduledTransfer.objects.values_list('transfer_ptr_id',
-                                                               flat=True)))
+        return self.transfers_to.filter(implemented=True)
+
+class BalanceCheckpoint(models.Model):
+    """
+    How much the transactions up to and including ``date``, the last day
+    of a month, changed the balance of an account. Checkpoints are created
+    on demand by Account.update_checkpoints() and the signal handlers
+    delete the ones after a changed transaction.
+    """
+    account = models.ForeignKey(Account, related_name="checkpoints")
+    date = models.DateField()
+    amount = money_field()
+
+    class Meta:
+        unique_together = ('account', 'date')
+
+    def __unicode__(self):
+        return u"{}: {:.2f}".format(self.date, self.amount)
+
+def monthly_sums(account_ids, after=None, until=None, using=None):
+    """
+    Returns {(account id, first of month): change} of how much the
+    transactions dated after ``after`` up to and including ``until``
+    changed the balances of the accounts ``account_ids``, with one query
+    for the transactions and one for the incoming transfers.
+    """
+    month = connection.ops.date_trunc_sql('month', "{}.{}".format(
+            connection.ops.quote_name(Transaction._meta.db_table),
+            connection.ops.quote_name('date')))
+    sums = defaultdict(int)
+    for queryset, field, sign in (
+            (Transaction.objects.filter(account__in=account_ids), 'account',
+             1),
+            (Transfer.objects.filter(to_account__in=account_ids),
+             'to_account', -1)):
+        queryset = queryset.filter(implemented=True)
+        if after:
+            queryset = queryset.filter(date__gt=after)
+        if until:
+            queryset = queryset.filter(date__lte=until)
+        if using:
+            queryset = queryset.using(using)
+        rows = queryset.extra(select={'month': month}).values(field, 'month').\
+                annotate(models.Sum('inflow'), models.Sum('outflow')).\
+                order_by()
+        for row in rows:
+            day = row['month']
+            if not isinstance(day, datetime.date):
+                day = parse_date(day[:10])
+            sums[(row[field], day.replace(day=1))] += sign * (
+                    row['inflow__sum'] - row['outflow__sum'])
+    return sums
+
+class Reconciliation(models.Model):
+    """
+    A finished reconciliation of an account against a bank statement. All
+    cleared rows of the account were locked when it was finished.
+    """
+    account = models.ForeignKey(Account, related_name="reconciliations")
+    date = models.DateField()
+    balance = money_field()
+    finished = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u"{} {}".format(self.account, self.date)
 
 class CategoryGroup(models.Model):
     name = models.CharField(max_length=32, blank=False, unique=True)
@@ -154,6 +543,10 @@ class Category(models.Model):
     def __unicode__(self):
         return u"{}: {}".format(self.group, self.name)
 
+def user_categories(user):
+    """Returns the categories of the user and the default ones"""
+    return Category.objects.filter(Q(user=user) | Q(default=True)).distinct()
+
 class Budget(models.Model):
     month = models.DateField(validators=[is_first_of_month], blank=False,
                              default=first_of_this_month)
@@ -169,10 +562,10 @@ class Budget(models.Model):
 
     @property
     def amount(self):
-        return self.category_budget_set.aggregate(models.Sum('amount'))
+        return self.categorybudget_set.aggregate(models.Sum('amount'))
 
     def category_group_amount(self, category_group):
-        return self.category_budget_set.filter(category__group=category_group).\
+        return self.categorybudget_set.filter(category__group=category_group).\
                 aggregate(models.Sum('amount'))
 
 class CategoryBudget(models.Model):
@@ -186,6 +579,56 @@ class CategoryBudget(models.Model):
     def __unicode__(self):
         return u"0.02f".format(self.amount)
 
+    def save(self, *args, **kwargs):
+        # Together with the category months the signal handlers update
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super(CategoryBudget, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super(CategoryBudget, self).delete(*args, **kwargs)
+
+class CategoryMonth(models.Model):
+    """
+    Budgeted amount, inflows, outflows and the balance carried over from
+    the previous months of one category in one month. The row without a
+    category is the "to be budgeted" pool: it collects income and
+    uncategorized transactions, and everything budgeted is taken from it.
+
+    The rows are kept current by the signal handlers at the end of this
+    module and can be recomputed with rebuild_category_months().
+    """
+    user = models.ForeignKey(UserProfile, related_name="category_months")
+    month = models.DateField(validators=[is_first_of_month])
+    category = models.ForeignKey(Category, null=True, blank=True,
+                                 related_name="months")
+    budgeted = money_field()
+    inflow = money_field()
+    outflow = money_field()
+    carried_over = money_field()
+
+    class Meta:
+        unique_together = ('user', 'category', 'month')
+
+    def __unicode__(self):
+        return u"{} {}".format(self.category or "To be budgeted",
+                               self.month.strftime("%B %Y"))
+
+    @staticmethod
+    def balance_change(category_id, budgeted, inflow, outflow):
+        if category_id is None:
+            return inflow - outflow - budgeted
+        return budgeted + inflow - outflow
+
+    @property
+    def balance(self):
+        return self.carried_over + self.balance_change(self.category_id,
+                self.budgeted, self.inflow, self.outflow)
+
+    @property
+    def outflows(self):
+        return self.outflow - self.inflow
+
 class Transaction(models.Model):
     added = models.DateTimeField(auto_now_add=True)
     account = models.ForeignKey(Account, null=False, 
@@ -199,12 +642,48 @@ class Transaction(models.Model):
     inflow = money_field(validators=[validators.MinValueValidator(0)]) 
     outflow = money_field(validators=[validators.MinValueValidator(0)]) 
     cleared = models.BooleanField(default=False, blank=False)
+    # Identifies rows imported from a bank statement, see budget.importers
+    import_hash = models.CharField(max_length=40, null=True, blank=True,
+                                   editable=False)
+    # Occurrences of a schedule that are not due yet are pending; they do
+    # not count towards any balance until materialize_schedules()
+    # implements them.
+    implemented = models.BooleanField(default=True, editable=False)
+    # Set when a reconciliation locks the cleared row
+    reconciled = models.BooleanField(default=False, editable=False)
+    schedule = models.ForeignKey('ScheduledTransaction', null=True,
+                                 blank=True, editable=False,
+                                 related_name="occurrences",
+                                 on_delete=models.SET_NULL)
+
+    class Meta:
+        # The register pages and balances of an account are read in
+        # (date, added) order, pending occurrences per schedule. Check the
+        # plans with the check_query_plans command after changing these.
+        index_together = [('account', 'import_hash'),
+                          ('account', 'implemented', 'date', 'added'),
+                          ('schedule', 'implemented', 'date')]
+
+    def save(self, *args, **kwargs):
+        # The row commits together with the ledger changes of the signal
+        # handlers, or neither does. Within a transaction, a failure rolls
+        # back the enclosing one.
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super(Transaction, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super(Transaction, self).delete(*args, **kwargs)
 
     def is_transfer(self):
-        return Transfer.objects.filter(pk=self.pk).exists()
+        try:
+            self.transfer
+        except Transfer.DoesNotExist:
+            return False
+        return True
 
     def as_transfer(self):
-        return Transfer.objects.get(pk=self.pk)
+        return self.transfer
 
     def __unicode__(self):
         return u"Transaction : {} <=> {}".format(self.account, self.payee)
@@ -213,6 +692,794 @@ class Transfer(Transaction):
     to_account = models.ForeignKey(Account, null=True,
                                    related_name="transfers_to",
                                    on_delete=models.SET_NULL)
+    # The register order of the receiving account, which an index cannot
+    # take from the transaction table. Saving a Transfer instance updates
+    # them, see sync_transfer_copies() for the other writes.
+    to_date = CopiedDateField('date')
+    to_added = CopiedDateTimeField('added')
+
+    class Meta:
+        index_together = [('to_account', 'to_date', 'to_added')]
+
+    def is_transfer(self):
+        return True
+
+    def as_transfer(self):
+        return self
 
     def __unicode__(self):
         return u"Transfer : {} <=> {}".format(self.account, self.to_account)
+
+class ScheduledTransaction(models.Model):
+    """
+    Repeats a transaction, or a transfer if ``to_account`` is set, every
+    ``interval`` days, weeks, months or years from ``start`` on, until
+    ``end`` if given. The occurrences are created by
+    materialize_schedules().
+    """
+    DAYS   = 0
+    WEEKS  = 1
+    MONTHS = 2
+    YEARS  = 3
+
+    account = models.ForeignKey(Account, related_name="schedules")
+    to_account = models.ForeignKey(Account, null=True, blank=True,
+                                   related_name="schedules_to",
+                                   on_delete=models.SET_NULL)
+    payee = models.CharField(max_length=32, blank=True)
+    category = models.ForeignKey(Category, null=True, blank=True,
+                                 related_name="schedules")
+    memo = models.CharField(max_length=64, null=True, blank=True)
+    inflow = money_field(validators=[validators.MinValueValidator(0)])
+    outflow = money_field(validators=[validators.MinValueValidator(0)])
+    unit = models.IntegerField(default=MONTHS, choices=((DAYS, "Days"),
+            (WEEKS, "Weeks"), (MONTHS, "Months"), (YEARS, "Years")))
+    interval = models.PositiveIntegerField(default=1,
+            validators=[validators.MinValueValidator(1)])
+    start = models.DateField()
+    end = models.DateField(null=True, blank=True)
+    # The first occurrence that was not created yet
+    next_number = models.PositiveIntegerField(default=0, editable=False)
+    next_date = models.DateField(editable=False, db_index=True)
+
+    def __unicode__(self):
+        return u"Schedule : {} <=> {}".format(self.account,
+                                              self.to_account or self.payee)
+
+    def occurrence(self, number):
+        """Returns the date of the occurrence ``number``, counted from 0"""
+        steps = number * self.interval
+        if self.unit == self.DAYS:
+            return self.start + datetime.timedelta(days=steps)
+        if self.unit == self.WEEKS:
+            return self.start + datetime.timedelta(weeks=steps)
+        if self.unit == self.YEARS:
+            steps *= 12
+        month = add_months(self.start, steps)
+        # The 31st falls on the last day of shorter months
+        return month.replace(day=min(self.start.day, month_end(month).day))
+
+    def save(self, *args, **kwargs):
+        # A changed rule replaces the occurrences that are still pending
+        latest = None
+        if self.pk:
+            self.occurrences.filter(implemented=False).delete()
+            latest = self.occurrences.order_by('-date').\
+                    values_list('date', flat=True).first()
+        self.next_number = 0
+        while latest and self.occurrence(self.next_number) <= latest:
+            self.next_number += 1
+        self.next_date = self.occurrence(self.next_number)
+        super(ScheduledTransaction, self).save(*args, **kwargs)
+
+class Job(models.Model):
+    """
+    Work queued for the run_worker command, see budget.jobs. Jobs with the
+    same ``key`` do the same work, only one of them waits at a time.
+    """
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATUS_NAMES = {PENDING: 'pending', RUNNING: 'running', DONE: 'done',
+                    FAILED: 'failed'}
+
+    name = models.CharField(max_length=32)
+    key = models.CharField(max_length=80)
+    # JSON keyword arguments of the task
+    arguments = models.TextField(default="{}")
+    user = models.ForeignKey(UserProfile, null=True, blank=True,
+                             related_name="jobs")
+    status = models.SmallIntegerField(default=PENDING,
+                                      choices=sorted(STATUS_NAMES.items()))
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [('status', 'run_after'), ('key', 'status')]
+
+    def __unicode__(self):
+        return u"{} #{} ({})".format(self.name, self.pk,
+                                     self.STATUS_NAMES[self.status])
+
+
+LedgerState = namedtuple('LedgerState', ['account_id', 'to_account_id', 
+                                         'date', 'category_id', 'inflow',
+                                         'outflow', 'cleared'])
+
+def ledger_state(transaction, to_account_id=None):
+    """
+    Returns the part of a transaction (or transfer) that counts towards the
+    account balances and the category months, None if it is pending.
+    """
+    if not transaction.implemented:
+        return None
+    if isinstance(transaction, Transfer):
+        to_account_id = transaction.to_account_id
+    return LedgerState(transaction.account_id, to_account_id,
+                       transaction.date, transaction.category_id,
+                       transaction.inflow, transaction.outflow,
+                       transaction.cleared)
+
+LEDGER_FIELDS = ('account_id', 'transfer__to_account_id', 'date',
+                 'category_id', 'inflow', 'outflow', 'cleared')
+
+def stored_ledger_state(pk):
+    if pk is None:
+        return None
+    for row in Transaction.objects.filter(pk=pk, implemented=True).\
+            values_list(*LEDGER_FIELDS):
+        return LedgerState(*row)
+    return None
+
+def reconciled_changes(transaction):
+    """
+    Returns the names of the fields saving ``transaction`` would change
+    although it is reconciled. Reconciled rows only take a new category.
+    """
+    model = type(transaction)
+    stored = model.objects.filter(pk=transaction.pk, reconciled=True).first() \
+            if transaction.pk is not None else None
+    if stored is None:
+        return []
+    return [field.name for field in model._meta.concrete_fields
+            if field.name != 'category' and
+            getattr(stored, field.attname) != getattr(transaction,
+                                                      field.attname)]
+
+def unbudgeted_categories():
+    """Returns the names of the categories that feed "to be budgeted" """
+    return set(Category.objects.filter(Q(budgeted=False) | 
+            Q(group__budgeted=False)).values_list('pk', flat=True))
+
+def category_month_changes(states, budgets, accounts, unbudgeted):
+    """
+    Sums how transactions and budgets change the category months.
+
+    ``states`` are (sign, LedgerState) pairs, ``budgets`` are (user_id,
+    month, category_id, amount) tuples and ``accounts`` maps the ids of the
+    involved accounts to (user_id, on_budget). Only money entering or
+    leaving the budget counts, so transfers between two on budget accounts
+    are ignored. Returns a dict (user_id, month, category_id) ->
+    [budgeted, inflow, outflow].
+    """
+    changes = defaultdict(lambda: [0, 0, 0])
+    for sign, state in states:
+        month = state.date.replace(day=1)
+        category_id = state.category_id
+        if category_id in unbudgeted:
+            category_id = None
+        account = accounts.get(state.account_id, (None, False))
+        to_account = accounts.get(state.to_account_id, (None, False))
+        if account[1] and not to_account[1]:
+            change = changes[(account[0], month, category_id)]
+            change[1] += sign * state.inflow
+            change[2] += sign * state.outflow
+        if to_account[1] and not account[1]:
+            change = changes[(to_account[0], month, category_id)]
+            change[1] += sign * state.outflow
+            change[2] += sign * state.inflow
+    for user_id, month, category_id, amount in budgets:
+        changes[(user_id, month, category_id)][0] += amount
+        changes[(user_id, month, None)][0] += amount
+    return changes
+
+def lock_users(user_ids=None):
+    """
+    Locks the UserProfile rows of ``user_ids`` (or of everybody) until the
+    end of the transaction, which serializes the writes to their category
+    months.
+    """
+    users = UserProfile.objects.select_for_update().order_by('pk')
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+    list(users.values_list('pk'))
+
+def apply_category_month_changes(changes):
+    if not changes:
+        return
+    lock_users(set(user_id for user_id, _, _ in changes))
+    for (user_id, month, category_id), (budgeted, inflow, outflow) in \
+            changes.items():
+        if not budgeted and not inflow and not outflow:
+            continue
+        rows = CategoryMonth.objects.filter(user=user_id, category=category_id)
+        updated = rows.filter(month=month).update(
+                budgeted=F('budgeted') + budgeted, inflow=F('inflow') + inflow,
+                outflow=F('outflow') + outflow)
+        if not updated:
+            previous = list(rows.filter(month__lt=month).order_by('-month')[:1])
+            CategoryMonth.objects.create(user_id=user_id, month=month,
+                    category_id=category_id, budgeted=budgeted, inflow=inflow,
+                    outflow=outflow,
+                    carried_over=previous[0].balance if previous else 0)
+        else:
+            # Rows without activity only carry over, which the grid does
+            rows.filter(month=month, budgeted=0, inflow=0, outflow=0).delete()
+        change = CategoryMonth.balance_change(category_id, budgeted, inflow,
+                                              outflow)
+        if change:
+            rows.filter(month__gt=month).update(
+                    carried_over=F('carried_over') + change)
+
+def compute_category_months(users=None):
+    """
+    Computes the CategoryMonth rows of the given users (or of everybody)
+    from scratch. Returns them unsaved.
+    """
+    accounts = dict((id, (user_id, on_budget)) for id, user_id, on_budget in
+            Account.objects.values_list('id', 'user_id', 'on_budget'))
+    transactions = Transaction.objects.filter(implemented=True)
+    budgets = CategoryBudget.objects.all()
+    if users is not None:
+        transactions = transactions.filter(Q(account__user__in=users) |
+                                           Q(transfer__to_account__user__in=users))
+        budgets = budgets.filter(budget__user__in=users)
+    states = ((1, LedgerState(*row)) for row in 
+              transactions.values_list(*LEDGER_FIELDS).iterator())
+    budgets = budgets.values_list('budget__user_id', 'budget__month', 
+                                  'category_id', 'amount').iterator()
+    changes = category_month_changes(states, budgets, accounts,
+                                     unbudgeted_categories())
+    user_ids = None
+    if users is not None:
+        user_ids = set(getattr(user, 'pk', user) for user in users)
+    carried = defaultdict(int)
+    rows = []
+    for (user_id, month, category_id), (budgeted, inflow, outflow) in \
+            sorted(changes.items()):
+        if user_ids is not None and user_id not in user_ids:
+            continue
+        if not budgeted and not inflow and not outflow:
+            # Only carries over, as apply_category_month_changes() leaves it
+            continue
+        row = CategoryMonth(user_id=user_id, month=month, 
+                            category_id=category_id, budgeted=budgeted,
+                            inflow=inflow, outflow=outflow,
+                            carried_over=carried[(user_id, category_id)])
+        carried[(user_id, category_id)] = row.balance
+        rows.append(row)
+    return rows
+
+def rebuild_category_months(users=None):
+    """
+    Replaces the CategoryMonth rows of the given users (or of everybody)
+    with computed ones. The users stay locked from reading the ledger
+    until the rows are written, so that apply_category_month_changes()
+    either waits and applies its changes to the new rows or commits
+    before the ledger is read.
+    """
+    with transaction.atomic():
+        lock_users(None if users is None else
+                   set(getattr(user, 'pk', user) for user in users))
+        rows = compute_category_months(users)
+        existing = CategoryMonth.objects.all()
+        if users is not None:
+            existing = existing.filter(user__in=users)
+        existing.delete()
+        CategoryMonth.objects.bulk_create(rows)
+
+class LedgerDelta(object):
+    """
+    Collects how a set of transaction rows and budgets changes the stored
+    account balances and category months and writes the result with one
+    UPDATE per account and category month.
+    """
+    def __init__(self):
+        self.balances = defaultdict(lambda: {True: 0, False: 0})
+        self.checkpoint_changes = defaultdict(int)
+        self.states = []
+        self.budgets = []
+
+    def add(self, state, sign=1):
+        if state is None:
+            return
+        amount = state.inflow - state.outflow
+        if state.account_id is not None:
+            self.balances[state.account_id][state.cleared] += sign * amount
+        if state.to_account_id is not None:
+            self.balances[state.to_account_id][state.cleared] -= sign * amount
+        if state.account_id is not None:
+            self.checkpoint_changes[(state.account_id, state.date)] += \
+                    sign * amount
+        if state.to_account_id is not None:
+            self.checkpoint_changes[(state.to_account_id, state.date)] -= \
+                    sign * amount
+        self.states.append((sign, state))
+
+    def remove(self, state):
+        self.add(state, sign=-1)
+
+    def add_budget(self, budget_id, category_id, amount, sign=1):
+        self.budgets.append((budget_id, category_id, sign * amount))
+
+    def apply(self):
+        for account_id, balance in self.balances.items():
+            if not balance[True] and not balance[False]:
+                continue
+            Account.objects.filter(pk=account_id).update(
+                    cleared_balance=F('cleared_balance') + balance[True],
+                    uncleared_balance=F('uncleared_balance') + balance[False])
+        changed_since = {}
+        for (account_id, day), amount in self.checkpoint_changes.items():
+            if amount:
+                changed_since[account_id] = min(day, 
+                        changed_since.get(account_id, day))
+        for account_id, day in changed_since.items():
+            BalanceCheckpoint.objects.filter(account=account_id, 
+                                             date__gte=day).delete()
+        self.apply_category_months()
+        self.__init__()
+
+    def apply_category_months(self):
+        if not self.states and not self.budgets:
+            return
+        account_ids = set()
+        for sign, state in self.states:
+            account_ids.update((state.account_id, state.to_account_id))
+        accounts = dict((id, (user_id, on_budget)) for id, user_id, on_budget
+                in Account.objects.filter(pk__in=account_ids).values_list(
+                    'id', 'user_id', 'on_budget'))
+        months = dict((id, (user_id, month)) for id, user_id, month in
+                Budget.objects.filter(pk__in=set(budget_id for budget_id, _, _
+                                                 in self.budgets)).\
+                values_list('id', 'user_id', 'month'))
+        budgets = [months[budget_id] + (category_id, amount) for
+                   budget_id, category_id, amount in self.budgets
+                   if budget_id in months]
+        apply_category_month_changes(category_month_changes(self.states,
+                budgets, accounts, unbudgeted_categories()))
+
+def bulk_create_transactions(transactions):
+    """
+    Inserts plain transactions with bulk_create and applies their changes
+    to the balances and category months, as bulk_create sends no signals.
+    """
+    delta = LedgerDelta()
+    for transaction in transactions:
+        delta.add(ledger_state(transaction))
+    Transaction.objects.bulk_create(transactions)
+    index_new_transactions()
+    delta.apply()
+    touch_users(UserProfile.objects.filter(accounts__in=set(
+            transaction.account_id for transaction in transactions)))
+
+LEDGER_CHANGES = {'account': 'account_id', 'category': 'category_id',
+                  'cleared': 'cleared'}
+
+def ledger_rows(transactions):
+    """
+    Returns (primary key, user id, ledger state or None if pending) of the
+    transactions in the ``transactions`` queryset.
+    """
+    rows = transactions.values_list('pk', 'account__user_id', 'implemented',
+                                    *LEDGER_FIELDS)
+    return [(row[0], row[1], LedgerState(*row[3:]) if row[2] else None)
+            for row in rows]
+
+def update_transactions(rows, **changes):
+    """
+    Sets the fields in ``changes`` (account, category or cleared, given as
+    primary keys and booleans) on the transactions of ``rows``, as
+    returned by ledger_rows(), with one UPDATE per 500 rows and applies the
+    difference to the stored balances and category months.
+    """
+    delta = LedgerDelta()
+    for pk, user_id, state in rows:
+        delta.remove(state)
+        if state is not None:
+            delta.add(state._replace(**dict((LEDGER_CHANGES[name], value)
+                                            for name, value
+                                            in changes.items())))
+    pks = [row[0] for row in rows]
+    with transaction.atomic():
+        for start in range(0, len(pks), 500):
+            Transaction.objects.filter(pk__in=pks[start:start + 500]).\
+                    update(**changes)
+        delta.apply()
+        users = Q(pk__in=set(row[1] for row in rows))
+        if 'account' in changes:
+            users |= Q(accounts=changes['account'])
+        touch_users(UserProfile.objects.filter(users))
+
+def delete_rows(model, pks):
+    """
+    Deletes the rows of ``model`` with the primary keys ``pks`` with one
+    plain DELETE. Unlike QuerySet.delete() this sends no signals and
+    follows no relations, so the callers take care of both.
+    """
+    if pks:
+        quote = connection.ops.quote_name
+        connection.cursor().execute("DELETE FROM {} WHERE {} IN ({})".format(
+                quote(model._meta.db_table), quote(model._meta.pk.column),
+                ", ".join(["%s"] * len(pks))), list(pks))
+
+def delete_transactions(rows):
+    """
+    Deletes the transactions (and transfers) of ``rows``, as returned by
+    ledger_rows(), with one DELETE per table and 500 rows, and takes them
+    off the stored balances and category months. No signals are sent, the
+    ledger changes are applied here and the rows taken out of the search
+    index; nothing else refers to transactions.
+    """
+    delta = LedgerDelta()
+    for pk, user_id, state in rows:
+        delta.remove(state)
+    pks = [row[0] for row in rows]
+    with transaction.atomic():
+        for start in range(0, len(pks), 500):
+            chunk = pks[start:start + 500]
+            delete_rows(Transfer, chunk)
+            delete_rows(Transaction, chunk)
+            unindex_transactions(chunk)
+        delta.apply()
+        touch_users(UserProfile.objects.filter(
+                pk__in=set(row[1] for row in rows)))
+
+def reconcile(account, day, balance):
+    """
+    Locks the cleared rows of the account, including the transfers to it,
+    with one UPDATE and records the reconciliation. Returns the number of
+    locked rows.
+    """
+    with transaction.atomic():
+        locked = Transaction.objects.filter(Q(account=account) |
+                Q(transfer__to_account=account), cleared=True,
+                reconciled=False, implemented=True).update(reconciled=True)
+        Reconciliation.objects.create(account=account, date=day,
+                                      balance=balance)
+        touch_users(UserProfile.objects.filter(pk=account.user_id))
+    return locked
+
+def materialize_schedules(today=None, days_ahead=0):
+    """
+    Creates the occurrences of all schedules up to ``days_ahead`` days
+    after ``today`` with bulk_create; those after today are pending. Then
+    implements the pending occurrences that have become due. Returns the
+    number of created and of implemented occurrences.
+    """
+    today = today or datetime.date.today()
+    until = today + datetime.timedelta(days=days_ahead)
+    delta = LedgerDelta()
+    occurrences, transfers, progress = [], [], []
+    with transaction.atomic():
+        schedules = ScheduledTransaction.objects.filter(
+                Q(end__isnull=True) | Q(end__gte=F('next_date')),
+                next_date__lte=until).select_for_update()
+        for schedule in schedules:
+            number, day = schedule.next_number, schedule.next_date
+            while day <= until and (schedule.end is None or 
+                                    day <= schedule.end):
+                occurrence = Transaction(account_id=schedule.account_id,
+                        date=day, payee=schedule.payee,
+                        category_id=schedule.category_id, memo=schedule.memo,
+                        inflow=schedule.inflow, outflow=schedule.outflow,
+                        implemented=day <= today, schedule=schedule)
+                occurrences.append(occurrence)
+                if schedule.to_account_id:
+                    transfers.append((schedule.pk, day,
+                                      schedule.to_account_id))
+                delta.add(ledger_state(occurrence, schedule.to_account_id))
+                number += 1
+                day = schedule.occurrence(number)
+            progress.append((schedule.pk, number, day))
+        Transaction.objects.bulk_create(occurrences, batch_size=500)
+        index_new_transactions()
+        for pk, number, day in progress:
+            ScheduledTransaction.objects.filter(pk=pk).update(
+                    next_number=number, next_date=day)
+        create_transfer_rows(transfers)
+        due = pending_occurrences(today)
+        implemented = []
+        for row in due.values_list('pk', *LEDGER_FIELDS):
+            implemented.append(row[0])
+            delta.add(LedgerState(*row[1:]))
+        for start in range(0, len(implemented), 500):
+            Transaction.objects.filter(pk__in=implemented[start:start + 500]).\
+                    update(implemented=True)
+        account_ids = set(account_id for account_id, _ 
+                          in delta.checkpoint_changes)
+        account_ids.update(occurrence.account_id
+                           for occurrence in occurrences)
+        delta.apply()
+        touch_users(UserProfile.objects.filter(accounts__in=account_ids))
+    return len(occurrences), len(implemented)
+
+def pending_occurrences(until):
+    """Returns the pending occurrences of all schedules up to ``until``"""
+    # Going through the schedules keeps the lookup on the schedule index
+    # instead of an index on ``implemented`` that would attract the
+    # register queries.
+    return Transaction.objects.filter(
+            schedule__in=ScheduledTransaction.objects.all(),
+            implemented=False, date__lte=until)
+
+def create_transfer_rows(transfers):
+    """
+    Adds the Transfer rows to occurrences inserted as plain transactions.
+    ``transfers`` are (schedule id, date, to_account id) tuples. bulk_create
+    cannot insert multi-table models, so the ids of the parents are looked
+    up by schedule and date and the child rows inserted directly.
+    """
+    if not transfers:
+        return
+    to_accounts = dict(((pk, day), to_account_id)
+                       for pk, day, to_account_id in transfers)
+    parents = Transaction.objects.filter(
+            schedule__in=set(pk for pk, _, _ in transfers),
+            date__in=set(day for _, day, _ in transfers),
+            transfer__isnull=True).values_list('pk', 'schedule_id', 'date')
+    insert_transfer_rows([(pk, to_accounts[(schedule_id, day)])
+                          for pk, schedule_id, day in parents
+                          if (schedule_id, day) in to_accounts])
+
+def insert_transfer_rows(rows):
+    """
+    Turns the existing transactions into transfers. ``rows`` are
+    (transaction id, to_account id) pairs. The ledger is not updated.
+    """
+    quote = connection.ops.quote_name
+    connection.cursor().executemany("INSERT INTO {0} ({1}, {2}, {3}, {4}) "
+                                    "SELECT {6}, %s, {7}, {8} FROM {5} "
+                                    "WHERE {6} = %s".format(
+            quote(Transfer._meta.db_table), quote(Transfer._meta.pk.column),
+            quote(Transfer._meta.get_field('to_account').column),
+            quote(Transfer._meta.get_field('to_date').column),
+            quote(Transfer._meta.get_field('to_added').column),
+            quote(Transaction._meta.db_table),
+            quote(Transaction._meta.pk.column),
+            quote(Transaction._meta.get_field('date').column),
+            quote(Transaction._meta.get_field('added').column)),
+            [(to_account_id, pk) for pk, to_account_id in rows])
+
+def sync_transfer_copies():
+    """
+    Sets the to_date and to_added copies of the transfers that differ from
+    their transactions, e.g. after a transfer was changed through its
+    Transaction. Returns the number of changed transfers.
+    """
+    quote = connection.ops.quote_name
+    table, pk = quote(Transaction._meta.db_table), \
+            quote(Transaction._meta.pk.column)
+    date, added = (quote(Transaction._meta.get_field(name).column)
+                   for name in ('date', 'added'))
+    source = "(SELECT {{}} FROM {} WHERE {}.{} = {}.{})".format(table, table,
+            pk, quote(Transfer._meta.db_table),
+            quote(Transfer._meta.pk.column))
+    to_date, to_added = (quote(Transfer._meta.get_field(name).column)
+                         for name in ('to_date', 'to_added'))
+    cursor = connection.cursor()
+    cursor.execute("UPDATE {0} SET {1} = {3}, {2} = {4} WHERE {1} IS NULL OR "
+                   "{2} IS NULL OR {1} != {3} OR {2} != {4}".format(
+            quote(Transfer._meta.db_table), to_date, to_added,
+            source.format(date), source.format(added)))
+    return cursor.rowcount
+
+SEARCH_TABLE = 'budget_transaction_search'
+
+def search_index_enabled(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'sqlite'
+
+def sync_search_index(using=DEFAULT_DB_ALIAS):
+    """
+    Creates the full-text index of the payees and memos, an SQLite FTS4
+    table whose docids are the transaction ids, and brings it up to date
+    with the transactions table.
+    """
+    if not search_index_enabled(using):
+        return
+    quote = connections[using].ops.quote_name
+    table = quote(Transaction._meta.db_table)
+    pk = quote(Transaction._meta.pk.column)
+    cursor = connections[using].cursor()
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts4("
+                   "payee, memo, tokenize=unicode61, prefix='2,3')".format(
+                           SEARCH_TABLE))
+    cursor.execute("DELETE FROM {} WHERE docid NOT IN (SELECT {} FROM {})".\
+            format(SEARCH_TABLE, pk, table))
+    cursor.execute("INSERT INTO {0} (docid, payee, memo) SELECT {1}, {2}, {3} "
+                   "FROM {4} WHERE {1} NOT IN (SELECT docid FROM {0})".format(
+                           SEARCH_TABLE, pk, quote('payee'), quote('memo'),
+                           table))
+
+def index_new_transactions():
+    """
+    Adds the transactions inserted with bulk_create, which sends no
+    signals, to the search index: those with a higher id than any indexed
+    transaction, as every other path indexes its rows.
+    """
+    if not search_index_enabled():
+        return
+    quote = connection.ops.quote_name
+    connection.cursor().execute(
+            "INSERT INTO {0} (docid, payee, memo) SELECT {1}, {2}, {3} "
+            "FROM {4} WHERE {1} > (SELECT COALESCE(MAX(docid), 0) FROM {0})".\
+            format(SEARCH_TABLE, quote(Transaction._meta.pk.column),
+                   quote('payee'), quote('memo'),
+                   quote(Transaction._meta.db_table)))
+
+def unindex_transactions(pks):
+    if search_index_enabled() and pks:
+        connection.cursor().execute("DELETE FROM {} WHERE docid IN ({})".\
+                format(SEARCH_TABLE, ", ".join(["%s"] * len(pks))), list(pks))
+
+def touch_users(profiles, choices=False):
+    """
+    Marks the data of the ``profiles`` as changed, which invalidates the
+    ETags and Last-Modified dates handed out by the API. ``choices`` tells
+    that their accounts or categories changed as well.
+    """
+    changes = {'data_version': F('data_version') + 1,
+               'data_modified': timezone.now()}
+    if choices:
+        changes['choices_version'] = F('choices_version') + 1
+    profiles.update(**changes)
+
+@receiver(pre_save, sender=Transaction)
+@receiver(pre_save, sender=Transfer)
+@receiver(pre_delete, sender=Transaction)
+def remember_ledger_state(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._stored_ledger_state = stored_ledger_state(instance.pk)
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_save, sender=Transfer)
+def update_ledger(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_stored_ledger_state', None)
+    # Saving the Transaction part of a transfer leaves its to_account as is
+    new = ledger_state(instance, old and old.to_account_id)
+    delta = LedgerDelta()
+    delta.remove(old)
+    delta.add(new)
+    delta.apply()
+    instance._stored_ledger_state = new
+
+@receiver(post_delete, sender=Transaction)
+def revert_ledger(sender, instance, **kwargs):
+    # Deleting a transfer always deletes its Transaction row as well, whose
+    # state was read including the to_account before the delete.
+    delta = LedgerDelta()
+    delta.remove(getattr(instance, '_stored_ledger_state', None))
+    delta.apply()
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_save, sender=Transfer)
+def index_transaction(sender, instance, **kwargs):
+    if search_index_enabled():
+        connection.cursor().execute("INSERT OR REPLACE INTO {} (docid, payee, "
+                                    "memo) VALUES (%s, %s, %s)".format(
+                                            SEARCH_TABLE),
+                                    [instance.pk, instance.payee,
+                                     instance.memo])
+
+@receiver(post_delete, sender=Transaction)
+def unindex_transaction(sender, instance, **kwargs):
+    unindex_transactions([instance.pk])
+
+@receiver(post_syncdb)
+def create_search_index(sender, db=DEFAULT_DB_ALIAS, **kwargs):
+    # Also sent after a flush, which empties the transactions table
+    if sender.__name__ == __name__:
+        sync_search_index(db)
+
+@receiver(post_save, sender=ExchangeRate)
+@receiver(post_delete, sender=ExchangeRate)
+def forget_rates(sender, instance, raw=False, **kwargs):
+    rates_changed()
+
+@receiver(pre_save, sender=CategoryBudget)
+def remember_category_budget(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._stored_amount = CategoryBudget.objects.filter(
+                pk=instance.pk).values_list('budget_id', 'category_id',
+                                            'amount').first()
+
+@receiver(post_save, sender=CategoryBudget)
+def update_budgeted(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    delta = LedgerDelta()
+    old = getattr(instance, '_stored_amount', None)
+    if old:
+        delta.add_budget(*old, sign=-1)
+    delta.add_budget(instance.budget_id, instance.category_id, instance.amount)
+    delta.apply()
+
+@receiver(post_delete, sender=CategoryBudget)
+def revert_budgeted(sender, instance, **kwargs):
+    delta = LedgerDelta()
+    delta.add_budget(instance.budget_id, instance.category_id, instance.amount,
+                     sign=-1)
+    delta.apply()
+
+@receiver(pre_save, sender=Account)
+def remember_on_budget(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._stored_on_budget = Account.objects.filter(
+                pk=instance.pk).values_list('on_budget', flat=True).first()
+
+@receiver(post_save, sender=Account)
+def rebuild_on_budget_change(sender, instance, raw=False, created=False,
+                             **kwargs):
+    stored = getattr(instance, '_stored_on_budget', None)
+    if not raw and stored is not None and stored != instance.on_budget:
+        # Every transaction of the user may move in or out of the budget
+        from budget.jobs import enqueue
+        enqueue('recompute_user', instance.user_id)
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+@receiver(post_save, sender=Budget)
+@receiver(post_delete, sender=Budget)
+def touch_owner(sender, instance, raw=False, **kwargs):
+    if not raw:
+        touch_users(UserProfile.objects.filter(pk=instance.user_id),
+                    choices=sender is Account)
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_save, sender=Transfer)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_save, sender=ScheduledTransaction)
+@receiver(post_delete, sender=ScheduledTransaction)
+def touch_account_owner(sender, instance, raw=False, **kwargs):
+    if not raw:
+        touch_users(UserProfile.objects.filter(accounts=instance.account_id))
+
+@receiver(post_save, sender=CategoryBudget)
+@receiver(post_delete, sender=CategoryBudget)
+def touch_budget_owner(sender, instance, raw=False, **kwargs):
+    if not raw:
+        touch_users(UserProfile.objects.filter(budgets=instance.budget_id))
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+@receiver(post_save, sender=CategoryGroup)
+@receiver(pre_delete, sender=CategoryGroup)
+def touch_category_users(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if instance.default:
+        # Default categories and groups are shown to everybody
+        touch_users(UserProfile.objects.all(), choices=True)
+    else:
+        touch_users(instance.user.all(), choices=True)
+
+@receiver(m2m_changed, sender=Category.user.through)
+@receiver(m2m_changed, sender=CategoryGroup.user.through)
+def touch_linked_users(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action.startswith('post_'):
+        touch_users(UserProfile.objects.filter(pk=instance.pk), choices=True)
+    elif action == 'pre_clear':
+        touch_users(instance.user.all(), choices=True)
+    elif action in ('post_add', 'post_remove'):
+        touch_users(UserProfile.objects.filter(pk__in=pk_set), choices=True)
+
+@receiver(pre_delete, sender=ScheduledTransaction)
+def delete_pending_occurrences(sender, instance, **kwargs):
+    instance.occurrences.filter(implemented=False).delete()
@@ -0,0 +1,192 @@
+"""
+Spending, income and net worth reports for charts
+
+Every report loads the columns it needs of the user's transactions with
+one query and aggregates them with NumPy: the rows are bucketed by month
+(and category or group) and summed with bincount, no matter how many
+months and categories the report spans. Amounts are summed in cents.
+
+Like the category months, spending and income only count money entering
+or leaving the budget; transfers between two on budget accounts are
+ignored. The net worth includes all accounts; it is read from the month
+end balance checkpoints, which the account balances use as well.
+"""
+import datetime
+
+import numpy as np
+from django.db import connection, connections
+from django.db.models import Q
+from django.utils.datastructures import SortedDict
+
+from budget.caching import cached
+from budget.models import Category, Transaction, Transfer, add_months
+
+BY = ('category', 'group')
+
+def column_sql(table, field, cast=None):
+    column = "{}.{}".format(connection.ops.quote_name(table),
+                            connection.ops.quote_name(field))
+    return "CAST({} AS {})".format(column, cast) if cast else column
+
+# Selected as expressions, the dates and amounts come as plain strings and
+# numbers instead of being converted to date and Decimal objects row by
+# row, which would take most of the time. The transfer table is joined by
+# the filter on the receiving account.
+COLUMNS = SortedDict([
+    ('day', column_sql(Transaction._meta.db_table, 'date', 'CHAR(10)')),
+    ('account', column_sql(Transaction._meta.db_table, 'account_id')),
+    ('to_account', column_sql(Transfer._meta.db_table, 'to_account_id')),
+    ('category', column_sql(Transaction._meta.db_table, 'category_id')),
+    ('inflow', "ROUND({} * 100)".format(column_sql(
+        Transaction._meta.db_table, 'inflow', 'REAL'))),
+    ('outflow', "ROUND({} * 100)".format(column_sql(
+        Transaction._meta.db_table, 'outflow', 'REAL'))),
+])
+
+def factorize(values):
+    """Returns the codes of ``values`` and the distinct values in code order"""
+    codes = {}
+    return (np.fromiter((codes.setdefault(value, len(codes))
+                         for value in values), np.int64, len(values)),
+            sorted(codes, key=codes.get))
+
+def load(user, last, first=None):
+    """
+    Returns the implemented transactions of the user up to the month
+    ``last`` (from the month ``first``) as a dict of NumPy columns, the
+    categories and groups as codes into the lists ``category_names`` and
+    ``group_names``.
+    """
+    rows = Transaction.objects.filter(Q(account__user=user) |
+            Q(transfer__to_account__user=user), implemented=True,
+            date__lt=add_months(last, 1))
+    if first is not None:
+        rows = rows.filter(date__gte=first)
+    # Read with a plain cursor, the rows do not pass through the ORM one
+    # by one. It is the one of the database the router picks for reading.
+    sql, params = rows.extra(select=COLUMNS).values_list(*COLUMNS).\
+            order_by().query.sql_with_params()
+    cursor = connections[rows.db].cursor()
+    cursor.execute(sql, params)
+    columns = zip(*cursor.fetchall()) or [()] * len(COLUMNS)
+    days, accounts, to_accounts, categories, inflows, outflows = columns
+    accounts = np.array(accounts, dtype=np.int64)
+    to_accounts = np.array([pk or 0 for pk in to_accounts], dtype=np.int64)
+    on_budget = dict(user.accounts.values_list('pk', 'on_budget'))
+    own = np.array(sorted(on_budget), dtype=np.int64)
+    budget_accounts = np.array([pk for pk in own if on_budget[pk]],
+                               dtype=np.int64)
+    categories, category_names = factorize(categories)
+    info = dict((pk, (group, budgeted and group_budgeted))
+                for pk, group, budgeted, group_budgeted in
+                Category.objects.filter(pk__in=category_names).values_list(
+                        'pk', 'group__name', 'budgeted', 'group__budgeted'))
+    groups, group_names = factorize([info.get(pk, (u"", False))[0]
+                                     for pk in category_names])
+    budgeted = np.array([info.get(pk, (u"", False))[1]
+                         for pk in category_names] or [False], dtype=bool)
+    months = np.array(days, dtype='datetime64[D]').astype('datetime64[M]')
+    return {
+        'month': months.astype(np.int64) + 1970 * 12,
+        'category': categories,
+        'category_names': category_names,
+        'group': (groups if len(groups) else np.zeros(1, np.int64))[
+                categories],
+        'group_names': group_names,
+        'budgeted': budgeted[categories],
+        'from_user': np.in1d(accounts, own),
+        'on_budget': np.in1d(accounts, budget_accounts),
+        'to_user': np.in1d(to_accounts, own),
+        'to_on_budget': np.in1d(to_accounts, budget_accounts),
+        'inflow': np.rint(np.array(inflows, dtype=float)).astype(np.int64),
+        'outflow': np.rint(np.array(outflows, dtype=float)).astype(np.int64),
+    }
+
+def budget_flows(rows):
+    """
+    Returns the inflows and outflows of the budget per row: the money of
+    rows leaving an on budget account for the outside and the reverse.
+    """
+    leaving = rows['from_user'] & rows['on_budget'] & \
+            ~(rows['to_user'] & rows['to_on_budget'])
+    entering = rows['to_user'] & rows['to_on_budget'] & \
+            ~(rows['from_user'] & rows['on_budget'])
+    inflow = np.where(leaving, rows['inflow'], 0) + \
+            np.where(entering, rows['outflow'], 0)
+    outflow = np.where(leaving, rows['outflow'], 0) + \
+            np.where(entering, rows['inflow'], 0)
+    return inflow, outflow
+
+def month_index(first, last):
+    first_index = first.year * 12 + first.month - 1
+    count = last.year * 12 + last.month - first_index
+    return first_index, count
+
+def month_labels(first, count):
+    return [add_months(first, i).strftime("%Y-%m") for i in range(count)]
+
+def money(values):
+    return [round(value / 100.0, 2) for value in values.tolist()]
+
+def spending(user, first, last, by='category'):
+    """
+    Returns the spending (outflow minus inflow) of the budgeted categories
+    or category groups per month from ``first`` to ``last``.
+    """
+    rows = load(user, last, first)
+    inflow, outflow = budget_flows(rows)
+    first_index, count = month_index(first, last)
+    keep = rows['budgeted'] & ((inflow != 0) | (outflow != 0))
+    keys, names = rows[by][keep], rows[by + '_names']
+    cells = keys * count + (rows['month'][keep] - first_index)
+    sums = np.bincount(cells, weights=(outflow - inflow)[keep],
+                       minlength=len(names) * count).reshape(len(names),
+                                                             count)
+    used = np.bincount(keys, minlength=len(names)) > 0
+    series = sorted((name, values) for name, values, use in
+                    zip(names, sums, used) if use)
+    return {'months': month_labels(first, count),
+            'series': [{'name': name, 'values': money(values),
+                        'total': round(values.sum() / 100.0, 2)}
+                       for name, values in series]}
+
+def income(user, first, last):
+    """Returns the money entering and leaving the budget per month"""
+    rows = load(user, last, first)
+    inflow, outflow = budget_flows(rows)
+    first_index, count = month_index(first, last)
+    months = rows['month'] - first_index
+    inflows = np.bincount(months, weights=inflow, minlength=count)
+    outflows = np.bincount(months, weights=outflow, minlength=count)
+    return {'months': month_labels(first, count),
+            'series': [{'name': "Income", 'values': money(inflows)},
+                       {'name': "Outflow", 'values': money(outflows)},
+                       {'name': "Net", 'values': money(inflows - outflows)}]}
+
+def net_worth(user, first, last):
+    """
+    Returns the sum of the balances of all accounts at the end of every
+    month, from the month end balance checkpoints of the accounts.
+    """
+    first_index, count = month_index(first, last)
+    return {'months': month_labels(first, count),
+            'series': [{'name': "Net worth",
+                        'values': [round(float(balance), 2) for _, balance
+                                   in user.net_worth_by_month(first, last)]}]}
+
+REPORTS = {'spending': spending, 'income': income, 'net_worth': net_worth}
+
+def cached_report(user, name, first, last, **options):
+    """Returns the report ``name``, cached until the user's data changes"""
+    return cached(user, 'report', lambda: REPORTS[name](user, first, last,
+                                                        **options),
+                  name, first, last, *options.values())
+
+def month_range(first=None, last=None, months=12):
+    """
+    Returns the first days of the ``first`` and ``last`` months, by default
+    the ``months`` months up to the current one.
+    """
+    last = (last or datetime.date.today()).replace(day=1)
+    first = (first or add_months(last, 1 - months)).replace(day=1)
+    return first, last
@@ -0,0 +1,91 @@
+"""
+Read replicas
+
+The views marked with @read_only read from one of the database aliases
+in BUDGET_READ_REPLICAS, picked per request; everything else, and every
+write, uses the primary ("default"). After a request with an unsafe
+method, which may have written, ReplicaMiddleware keeps the session on the
+primary for BUDGET_PRIMARY_STICKINESS seconds, so that users see their
+own changes. The stickiness has to outlast the replication delay.
+
+SQLite replicas are copies of the primary file made by the
+sync_replicas command, see copy_sqlite_database().
+"""
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+local = threading.local()
+
+PRIMARY_UNTIL = 'budget_primary_until'
+
+def read_only(view):
+    """Marks a view that only reads, so it may read from a replica"""
+    view.read_only = True
+    return view
+
+def replicas():
+    return list(getattr(settings, 'BUDGET_READ_REPLICAS', []))
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return getattr(local, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        # Also for instances read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set([DEFAULT_DB_ALIAS] + replicas())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        # The replicas are copies of the primary
+        return db not in replicas()
+
+class ReplicaMiddleware(object):
+    """Picks the database of the read_only views, must follow sessions"""
+    def process_request(self, request):
+        local.replica = None
+
+    def process_view(self, request, view, args, kwargs):
+        aliases = replicas()
+        if aliases and getattr(view, 'read_only', False) and \
+                request.session.get(PRIMARY_UNTIL, 0) < time.time():
+            local.replica = random.choice(aliases)
+        return None
+
+    def process_response(self, request, response):
+        stickiness = getattr(settings, 'BUDGET_PRIMARY_STICKINESS', 10)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE') and \
+                stickiness and hasattr(request, 'session'):
+            request.session[PRIMARY_UNTIL] = time.time() + stickiness
+        local.replica = None
+        return response
+
+def copy_sqlite_database(source, target):
+    """
+    Copies the SQLite database file ``source`` to ``target``. Writers of
+    the source wait during the copy, so the copy is consistent; it
+    replaces the target at once, which connections opened afterwards see.
+    """
+    connection = sqlite3.connect(source, isolation_level=None)
+    temporary = target + '.tmp'
+    try:
+        # No other connection can write until the rollback
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            shutil.copyfile(source, temporary)
+        finally:
+            connection.execute("ROLLBACK")
+    finally:
+        connection.close()
+    os.rename(temporary, target)
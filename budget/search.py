@@ -0,0 +1,84 @@
+"""
+Full-text search of the transactions and payee suggestions
+
+On SQLite the payees and memos are searched in the FTS4 table kept in
+sync by the signal handlers in budget.models, every word of the query
+matching the words starting with it. Other databases fall back to plain
+substring filters.
+
+The payee suggestions come from a sorted list of the user's payees that
+is cached until the data of the user changes, a prefix is looked up by
+bisection instead of querying the transactions.
+"""
+import bisect
+import re
+
+from django.db import connection
+from django.db.models import Max, Q
+
+from budget.caching import cached
+from budget.models import SEARCH_TABLE, Transaction, search_index_enabled
+
+WORD = re.compile(r'\w+', re.U)
+
+def match_query(text):
+    """Returns the FTS query for the words of ``text`` as prefixes"""
+    # Lowercase words are never taken for the AND, OR and NOT operators
+    return u" ".join(u"{}*".format(word)
+                     for word in WORD.findall(text.lower()))
+
+def search_transactions(user, text, limit=100):
+    """
+    Returns the newest ``limit`` implemented transactions of the user
+    whose payee or memo contain words starting with all words of ``text``.
+    """
+    query = match_query(text)
+    rows = Transaction.objects.filter(account__user=user, implemented=True)
+    if not query:
+        return rows.none()
+    if search_index_enabled():
+        quote = connection.ops.quote_name
+        rows = rows.extra(where=["{}.{} IN (SELECT docid FROM {} WHERE {} "
+                                 "MATCH %s)".format(
+                quote(Transaction._meta.db_table),
+                quote(Transaction._meta.pk.column), SEARCH_TABLE,
+                SEARCH_TABLE)], params=[query])
+    else:
+        for word in WORD.findall(text):
+            rows = rows.filter(Q(payee__icontains=word) |
+                               Q(memo__icontains=word))
+    return rows.select_related('account', 'category__group',
+            'transfer__to_account').order_by('-date', '-added', '-id')[:limit]
+
+def payee_index(user):
+    """
+    Returns the sorted (lowercase payee, payee, category id) tuples of the
+    payees of the user, with the category of the latest transaction of
+    each payee, cached until the data of the user changes.
+    """
+    def compute():
+        rows = Transaction.objects.filter(account__user=user,
+                                          implemented=True).exclude(payee="")
+        latest = rows.values('payee').annotate(latest=Max('id')).\
+                values('latest')
+        index = {}
+        for payee, category in Transaction.objects.filter(pk__in=latest).\
+                order_by('id').values_list('payee', 'category_id'):
+            index[payee.lower()] = (payee.lower(), payee, category)
+        return sorted(index.values())
+    return cached(user, 'payees', compute)
+
+def suggest_payees(user, prefix, limit=10):
+    """
+    Returns the payees of the user starting with ``prefix`` (ignoring
+    case) with their latest category as dicts.
+    """
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+    index = payee_index(user)
+    # The payees starting with the prefix follow each other
+    start = bisect.bisect_left(index, (prefix,))
+    return [{'payee': payee, 'category': category}
+            for key, payee, category in index[start:start + limit]
+            if key.startswith(prefix)]
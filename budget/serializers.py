@@ -0,0 +1,97 @@
+from rest_framework import serializers
+
+from budget.models import Account, Budget, Category, CategoryBudget, \
+        ScheduledTransaction, Transaction, Transfer, user_categories
+
+class BudgetSerializer(serializers.ModelSerializer):
+    """
+    Base of the API serializers. Reads of a list or object can be limited
+    to some fields with a comma separated ``fields`` query parameter, and
+    the related objects to choose from are those of the requesting user.
+    """
+    user_querysets = {}
+
+    def __init__(self, *args, **kwargs):
+        super(BudgetSerializer, self).__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None:
+            return
+        fields = request.QUERY_PARAMS.get('fields')
+        if fields and request.method == 'GET':
+            for name in set(self.fields) - set(fields.split(',')):
+                del self.fields[name]
+        user = request.user.budget_profile
+        for name, queryset in self.user_querysets.items():
+            if name in self.fields:
+                self.fields[name].queryset = queryset(user)
+
+class AccountSerializer(BudgetSerializer):
+    balance = serializers.Field(source='saldo')
+    cleared = serializers.Field(source='cleared_saldo')
+
+    class Meta:
+        model = Account
+        fields = ('id', 'name', 'note', 'type', 'line_of_credit',
+                  'starting_balance', 'on_budget', 'currency', 'balance',
+                  'cleared')
+
+class TransactionSerializer(BudgetSerializer):
+    user_querysets = {'account': lambda user: user.accounts.all(),
+                      'category': user_categories}
+
+    class Meta:
+        model = Transaction
+        fields = ('id', 'account', 'date', 'payee', 'category', 'memo',
+                  'check_nr', 'inflow', 'outflow', 'cleared', 'added',
+                  'implemented', 'schedule', 'reconciled')
+        read_only_fields = ('added', 'implemented', 'schedule', 'reconciled')
+
+class TransferSerializer(TransactionSerializer):
+    user_querysets = dict(TransactionSerializer.user_querysets,
+                          to_account=lambda user: user.accounts.all())
+
+    class Meta:
+        model = Transfer
+        fields = ('id', 'account', 'to_account', 'date', 'category', 'memo',
+                  'check_nr', 'inflow', 'outflow', 'cleared', 'added',
+                  'implemented', 'schedule', 'reconciled')
+        read_only_fields = ('added', 'implemented', 'schedule', 'reconciled')
+
+class ScheduledTransactionSerializer(TransferSerializer):
+    class Meta:
+        model = ScheduledTransaction
+        fields = ('id', 'account', 'to_account', 'payee', 'category', 'memo',
+                  'inflow', 'outflow', 'unit', 'interval', 'start', 'end',
+                  'next_date')
+        read_only_fields = ('next_date',)
+
+class CategorySerializer(BudgetSerializer):
+    group = serializers.Field(source='group.name')
+
+    class Meta:
+        model = Category
+        fields = ('name', 'group', 'default', 'budgeted')
+
+class BudgetMonthSerializer(BudgetSerializer):
+    class Meta:
+        model = Budget
+        fields = ('id', 'month')
+
+    def restore_object(self, attrs, instance=None):
+        budget = super(BudgetMonthSerializer, self).restore_object(attrs,
+                                                                   instance)
+        budget.user = self.context['request'].user.budget_profile
+        return budget
+
+    def get_validation_exclusions(self, instance=None):
+        # The user is set above, so that one budget per month is validated
+        return [name for name in super(BudgetMonthSerializer,
+                self).get_validation_exclusions(instance) if name != 'user']
+
+class CategoryBudgetSerializer(BudgetSerializer):
+    user_querysets = {'budget': lambda user: user.budgets.all(),
+                      'category': user_categories}
+
+    class Meta:
+        model = CategoryBudget
+        fields = ('id', 'budget', 'category', 'amount')
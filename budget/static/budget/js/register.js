@@ -0,0 +1,114 @@
+/*
+ * Clears transactions and adds transactions and transfers in the register
+ * without reloading the page. The server answers with the changed rows
+ * and the new balances, see budget.views.register_update(). Suggests
+ * payees from budget.views.payees and fills in their latest category.
+ */
+(function ($) {
+    function csrfToken() {
+        return $('[name=csrfmiddlewaretoken]').first().val();
+    }
+
+    function setLabel(label, value) {
+        var number = Number(value);
+        label.text(value)
+            .toggleClass('label-danger', number < 0)
+            .toggleClass('label-default', number === 0)
+            .toggleClass('label-success', number > 0);
+    }
+
+    function updateBalances(data) {
+        $.each(data.accounts, function (id, account) {
+            setLabel($('#balance-account-' + id), account.balance);
+        });
+        setLabel($('#balance-total'), data.totals.total);
+        setLabel($('#balance-budget'), data.totals.budget);
+        setLabel($('#balance-off-budget'), data.totals.off_budget);
+    }
+
+    function insertRows(body, data) {
+        var rows = $(data.rows.join('')),
+            all = body.children('tr[data-date]'),
+            newer = all.filter(function () {
+                return $(this).attr('data-date') > data.date;
+            });
+        newer.find('.register-balance').each(function () {
+            var cell = $(this),
+                balance = (Number(cell.attr('data-balance')) +
+                           Number(data.amount)).toFixed(2);
+            cell.attr('data-balance', balance).text(balance)
+                .toggleClass('text-danger', Number(balance) < 0);
+        });
+        if (!newer.length) {
+            body.append(rows);
+        } else if (!newer.first().is(all.first()) ||
+                   !body.children('.register-older').length) {
+            rows.insertBefore(newer.first());
+        }
+        // Otherwise the rows belong to an older page
+    }
+
+    var suggestions = {};
+
+    $(document).on('input', 'input[data-suggestions]', function () {
+        var input = $(this),
+            list = $('#' + input.attr('list')),
+            prefix = input.val();
+        if (!prefix) {
+            return;
+        }
+        $.getJSON(input.attr('data-suggestions'), {q: prefix},
+                  function (data) {
+            if (input.val() !== prefix) {
+                return;
+            }
+            list.empty();
+            $.each(data.payees, function (i, suggestion) {
+                suggestions[suggestion.payee] = suggestion.category;
+                list.append($('<option>').attr('value', suggestion.payee));
+            });
+        });
+    });
+
+    $(document).on('change', 'input[data-suggestions]', function () {
+        var category = suggestions[$(this).val()],
+            select = $(this.form).find('[name=category]');
+        if (category && !select.val()) {
+            select.val(category);
+        }
+    });
+
+    $(document).on('click', 'a.clear-transaction', function (event) {
+        var link = $(this);
+        event.preventDefault();
+        $.post(link.attr('href'), {csrfmiddlewaretoken: csrfToken()},
+               function (data) {
+            $('a.clear-transaction[data-id=' + data.id + '] .glyphicon')
+                .toggleClass('glyphicon-check', data.cleared)
+                .toggleClass('glyphicon-unchecked', !data.cleared);
+            updateBalances(data);
+        });
+    });
+
+    $(document).on('submit', 'form.add-transaction', function (event) {
+        var form = $(this);
+        event.preventDefault();
+        form.find('.register-errors').remove();
+        $.post(form.attr('action'), form.serialize()).done(function (data) {
+            insertRows(form.find('table > tbody'), data);
+            updateBalances(data);
+            form.find('[name=payee], [name=memo], [name=outflow], ' +
+                      '[name=inflow]').val('');
+            form.find('[name=cleared]').prop('checked', false);
+        }).fail(function (xhr) {
+            var errors = (xhr.responseJSON || {}).errors || {},
+                alert = $('<div class="alert alert-danger register-errors">');
+            $.each(errors, function (field, messages) {
+                alert.append($('<div>').text(
+                    (field === '__all__' ? '' : field + ': ') +
+                    messages.join(' ')));
+            });
+            form.prepend(alert);
+        });
+    });
+}(jQuery));
@@ -1,8 +1,11 @@
-import calendar, datetime
+import datetime
 
 from django import template
+from django.template.loader import render_to_string
 from django.template.defaulttags import TemplateIfParser
-from django.template.defaultfilters import add
+
+from budget import caching
+from budget.forms import BulkActionForm
 
 register = template.Library()
 
@@ -16,59 +19,19 @@ def sub(value, arg):
         except Exception:
             return ''
 
-@register.filter
-def month_sub(value, arg):
-    if isinstance(value, datetime.date):
-        try:
-            arg = int(arg)
-            months = value.month - arg
-            if months > 0:
-                return datetime.date(year=value.year,
-                                     month=months, 
-                                     day=value.day)
-            else:
-                years = months//12
-                months = months % 12 or 12
-                return datetime.date(year=value.year+years,
-                                     month=months, 
-                                     day=value.day)
-        except (ValueError, TypeError):
-            pass
-    result = sub(value, arg)
-    if isinstance(result, int):
-        return result % 12 or 12
-    else:
-        return result
+@register.simple_tag(takes_context=True)
+def account_sidebar(context):
+    """Renders the accounts of the sidebar, cached per user"""
+    user = context['user'].budget_profile
+    # The totals are converted with the rates of the day
+    return caching.cached(user, 'sidebar', lambda: render_to_string(
+            'budget/sidebar_accounts.html',
+            {'balances': user.account_balances()}),
+            caching.rates_generation(), datetime.date.today())
 
-@register.filter
-def month_add(value, arg):
-    if isinstance(value, datetime.date):
-        try:
-            arg = int(arg)
-            months = value.month + arg
-            if months <= 12:
-                return datetime.date(year=value.year,
-                                     month=months, 
-                                     day=value.day)
-            else:
-                years = months//12
-                months = months % 12 or 12
-                return datetime.date(year=value.year+years,
-                                     month=months, 
-                                     day=value.day)
-        except (ValueError, TypeError):
-            pass
-    result = add(value, arg)
-    if isinstance(result, int):
-        return result % 12 or 12
-    else:
-        return result
-
-@register.simple_tag
-def month_abbr(value):
-    try:
-        if isinstance(value, (datetime.date, datetime.datetime)):
-            return value.strftime("%b")
-        return calendar.month_abbr[int(value)]
-    except (ValueError, TypeError, IndexError):
-        return ''
+@register.simple_tag(takes_context=True)
+def register_actions(context):
+    """Renders the controls of the register bulk actions, cached per user"""
+    user = context['user'].budget_profile
+    return caching.cached(user, 'register_actions', lambda: render_to_string(
+            'budget/register_actions.html', {'form': BulkActionForm(user)}))
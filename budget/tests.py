@@ -1,3 +1,1332 @@
-from django.test import TestCase
+import csv
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import date
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.db.models.signals import post_save
+from django.http import Http404, HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.utils.six import StringIO
+
+from budget import caching, exporters, importers, jobs, middleware, \
+        models, reports, routers, search, views
+
+class BudgetTestCase(TestCase):
+    def setUp(self):
+        caching.budget_cache().clear()
+        self.user = User.objects.create_user('jane', password='secret')
+        self.profile = models.UserProfile.objects.create(user=self.user)
+        self.group = models.CategoryGroup.objects.create(name="Test Group")
+        self.category = models.Category.objects.create(name="Test Category",
+                                                       group=self.group)
+        self.checking = self.create_account("Checking")
+        self.savings = self.create_account("Savings", on_budget=False)
+
+    def create_account(self, name, **kwargs):
+        kwargs.setdefault('type', models.Account.TYPE_CHECKING)
+        return models.Account.objects.create(name=name, user=self.profile,
+                                             **kwargs)
+
+    def create_transaction(self, account=None, model=models.Transaction,
+                           **kwargs):
+        kwargs.setdefault('date', date(2014, 3, 1))
+        kwargs.setdefault('payee', "Shop")
+        kwargs.setdefault('category', self.category)
+        return model.objects.create(account=account or self.checking,
+                                    **kwargs)
+
+    def reload(self, account):
+        return models.Account.objects.get(pk=account.pk)
+
+class AccountBalanceTest(BudgetTestCase):
+    def assertBalances(self, account, cleared, uncleared):
+        account = self.reload(account)
+        self.assertEqual((account.cleared_balance, account.uncleared_balance),
+                         (Decimal(cleared), Decimal(uncleared)))
+        self.assertEqual(account.compute_balances(),
+                         (Decimal(cleared), Decimal(uncleared)))
+
+    def test_transaction_changes(self):
+        transaction = self.create_transaction(outflow=Decimal("12.50"))
+        self.assertBalances(self.checking, 0, "-12.50")
+        transaction.cleared = True
+        transaction.inflow = Decimal("2.50")
+        transaction.save()
+        self.assertBalances(self.checking, "-10.00", 0)
+        transaction.account = self.savings
+        transaction.save()
+        self.assertBalances(self.checking, 0, 0)
+        self.assertBalances(self.savings, "-10.00", 0)
+        transaction.delete()
+        self.assertBalances(self.savings, 0, 0)
+
+    def test_saving_keeps_balances(self):
+        stale = self.reload(self.checking)
+        self.create_transaction(outflow=Decimal(10))
+        stale.name = "Giro"
+        stale.save()
+        self.assertBalances(self.checking, 0, -10)
+        self.assertEqual(self.reload(self.checking).name, "Giro")
+
+    def test_transfer_changes(self):
+        transfer = self.create_transaction(model=models.Transfer,
+                                           to_account=self.savings,
+                                           outflow=Decimal("100"))
+        self.assertBalances(self.checking, 0, "-100")
+        self.assertBalances(self.savings, 0, "100")
+        # Clearing through the Transaction part keeps both sides in sync
+        transaction = models.Transaction.objects.get(pk=transfer.pk)
+        transaction.cleared = True
+        transaction.save()
+        self.assertBalances(self.checking, "-100", 0)
+        self.assertBalances(self.savings, "100", 0)
+        transaction.delete()
+        self.assertBalances(self.checking, 0, 0)
+        self.assertBalances(self.savings, 0, 0)
+
+    def test_saldo_includes_starting_balance(self):
+        account = self.create_account("Wallet", starting_balance=Decimal(20))
+        self.create_transaction(account, outflow=Decimal(5), cleared=True)
+        self.create_transaction(account, outflow=Decimal(3))
+        account = self.reload(account)
+        self.assertEqual(account.saldo, Decimal(12))
+        self.assertEqual(account.cleared_saldo, Decimal(15))
+
+    def test_rebuild_command(self):
+        self.create_transaction(outflow=Decimal(7))
+        models.Account.objects.filter(pk=self.checking.pk).update(
+                uncleared_balance=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_balances', check=True, stdout=StringIO())
+        call_command('rebuild_balances', stdout=StringIO())
+        self.assertBalances(self.checking, 0, "-7")
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_delete_account(self):
+        models.bulk_create_transactions([models.Transaction(
+                account=self.checking, date=date(2014, 3, 1), payee="Shop",
+                category=self.category, outflow=Decimal(1))
+                for _ in range(200)])
+        self.create_transaction(self.savings, model=models.Transfer,
+                                to_account=self.checking,
+                                outflow=Decimal(5))
+        # The same number of queries for any number of transactions
+        with self.assertNumQueries(35):
+            self.checking.delete()
+        self.assertEqual(models.Transaction.objects.count(), 1)
+        self.assertBalances(self.savings, 0, -5)
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+class LedgerTransactionTest(TransactionTestCase):
+    def test_ledger_failure_rolls_back(self):
+        user = models.UserProfile.objects.create(
+                user=User.objects.create_user('jane'))
+        account = models.Account.objects.create(name="Checking", user=user,
+                type=models.Account.TYPE_CHECKING)
+        def fail(sender, **kwargs):
+            raise RuntimeError("Crashed after the ledger update")
+        post_save.connect(fail, sender=models.Transaction)
+        try:
+            with self.assertRaises(RuntimeError):
+                models.Transaction.objects.create(account=account,
+                        date=date(2014, 3, 1), outflow=Decimal(10))
+        finally:
+            post_save.disconnect(fail, sender=models.Transaction)
+        self.assertFalse(models.Transaction.objects.exists())
+        self.assertEqual(models.Account.objects.get(pk=account.pk).
+                         uncleared_balance, 0)
+
+    def test_rebuild_reads_in_its_transaction(self):
+        compute = models.compute_category_months
+        atomic = []
+        def compute_category_months(users=None):
+            atomic.append(connection.in_atomic_block)
+            return compute(users)
+        models.compute_category_months = compute_category_months
+        self.addCleanup(setattr, models, 'compute_category_months', compute)
+        models.rebuild_category_months([])
+        self.assertEqual(atomic, [True])
+
+class AccountBalancesTest(BudgetTestCase):
+    def test_one_query_per_request(self):
+        self.create_transaction(outflow=Decimal(10))
+        self.create_transaction(self.savings, inflow=Decimal(50))
+        profile = models.UserProfile.objects.get(pk=self.profile.pk)
+        with self.assertNumQueries(1):
+            balances = profile.account_balances()
+            self.assertEqual(profile.total_accounts_sum, Decimal(40))
+            self.assertEqual(profile.budget_accounts_sum, Decimal(-10))
+            self.assertEqual(profile.off_budget_accounts_sum, Decimal(50))
+        self.assertEqual(balances['budget_accounts'], [self.checking])
+        self.assertEqual(balances['off_budget_accounts'], [self.savings])
+
+class RegisterTest(BudgetTestCase):
+    def setUp(self):
+        super(RegisterTest, self).setUp()
+        self.rows = [
+            self.create_transaction(date=date(2014, 1, day), 
+                                    outflow=Decimal(day))
+            for day in (3, 1, 2, 2)]
+        self.transfer = self.create_transaction(model=models.Transfer,
+                to_account=self.savings, date=date(2014, 1, 2),
+                outflow=Decimal(9))
+        # Rows added in the same instant are ordered by id
+        models.Transaction.objects.filter(date=date(2014, 1, 2)).update(
+                added=self.rows[2].added)
+        # The copies of the transfer's date for the register of savings
+        self.assertEqual(models.sync_transfer_copies(), 1)
+
+    def walk(self, account=None):
+        pages, before = [], None
+        while True:
+            page = views.get_transactions(self.profile, account, before, 
+                                          limit=2)
+            pages.insert(0, [(t.id, t.account_id, t.outflow, t.inflow)
+                             for t in page])
+            before = page.older
+            if not before:
+                return [row for page in pages for row in page]
+
+    def test_all_accounts(self):
+        rows = self.walk()
+        self.assertEqual(rows, [
+            (self.rows[1].id, self.checking.id, 1, 0),
+            (self.rows[2].id, self.checking.id, 2, 0),
+            (self.rows[3].id, self.checking.id, 2, 0),
+            (self.transfer.id, self.checking.id, 9, 0),
+            (self.transfer.id, self.savings.id, 0, 9),
+            (self.rows[0].id, self.checking.id, 3, 0)])
+
+    def test_single_account(self):
+        self.assertEqual(self.walk(self.savings), 
+                         [(self.transfer.id, self.savings.id, 0, 9)])
+        self.assertEqual(len(self.walk(self.checking)), 5)
+
+    def test_running_balance(self):
+        account = self.reload(self.checking)
+        balances, before = [], None
+        while True:
+            page = views.get_transactions(self.profile, account, before,
+                                          limit=2)
+            balances[:0] = [t.balance for t in page]
+            before = page.older
+            if not before:
+                break
+        self.assertEqual(balances, [-1, -3, -5, -14, -17])
+        self.assertEqual(balances[-1], account.saldo)
+
+    def test_pages_are_limited_in_the_database(self):
+        self.profile.account_balances()
+        # The accounts, the keys of the page and the rows of both sides
+        with self.assertNumQueries(4):
+            page = views.get_transactions(self.profile, limit=2)
+        self.assertEqual(len(page), 2)
+        self.assertRaises(Http404, views.get_transactions, self.profile,
+                          before="invalid")
+
+class ViewTest(BudgetTestCase):
+    def setUp(self):
+        super(ViewTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+
+    def test_pages(self):
+        self.create_transaction(outflow=Decimal(5))
+        self.create_transaction(model=models.Transfer, to_account=self.savings,
+                                outflow=Decimal(9))
+        for url in ('/ownbudget/', '/ownbudget/2014/3',
+                    '/ownbudget/accounts/',
+                    '/ownbudget/accounts/{}'.format(self.checking.id),
+                    '/ownbudget/accounts/add_transaction',
+                    '/ownbudget/accounts/{}/add_transaction'.format(
+                        self.checking.id),
+                    '/ownbudget/accounts/add_tranfer',
+                    '/ownbudget/accounts/{}/add_tranfer'.format(
+                        self.checking.id)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_load_older(self):
+        for day in range(1, 4):
+            self.create_transaction(date=date(2014, 1, day))
+        with self.settings(BUDGET_REGISTER_PAGE_SIZE=2):
+            response = self.client.get('/ownbudget/accounts/')
+            older = response.context['transactions'].older
+            self.assertContains(response, "Load older transactions")
+            response = self.client.get('/ownbudget/accounts/',
+                                       {'before': older})
+        self.assertEqual([t.date.day for t in response.context['transactions']],
+                         [1])
+
+    def test_register_queries_do_not_grow_with_the_page(self):
+        other = self.create_account("Other")
+        for day in range(1, 4):
+            self.create_transaction(date=date(2014, 1, day), 
+                                    outflow=Decimal(1))
+            self.create_transaction(model=models.Transfer, to_account=other,
+                                    date=date(2014, 1, day), outflow=Decimal(2))
+            self.create_transaction(other, model=models.Transfer,
+                                    to_account=self.checking,
+                                    date=date(2014, 1, day), outflow=Decimal(3))
+        # session, user, profile, account or account balances and ids, the
+        # keys of the page and the rows of both sides; the sidebar and the
+        # bulk action controls come from the cache
+        self.client.get('/ownbudget/accounts/')
+        for url, queries in (('/ownbudget/accounts/', 8),
+                ('/ownbudget/accounts/{}'.format(self.checking.id), 7)):
+            with self.settings(BUDGET_REGISTER_PAGE_SIZE=3):
+                with self.assertNumQueries(queries):
+                    response = self.client.get(url)
+            with self.assertNumQueries(queries):
+                response = self.client.get(url)
+            self.assertContains(response, "glyphicon-transfer text-muted")
+            self.assertContains(response, "Test Group: Test Category")
+
+    def test_transfer_form_choices(self):
+        other = User.objects.create_user('john', password='secret')
+        other = models.UserProfile.objects.create(user=other)
+        models.Account.objects.create(name="John's", user=other,
+                                      type=models.Account.TYPE_CHECKING)
+        url = '/ownbudget/accounts/{}/add_tranfer'.format(self.checking.id)
+        self.client.get(url)
+        # session, user, profile, account and the keys of the empty
+        # register; the choices come from the cache
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        form = response.context['form']
+        self.assertEqual([choice[1] for choice in form['to_account'].field.
+                          choices], [u"---------", u"Savings"])
+        self.assertContains(response, '<optgroup label=')
+        self.assertNotContains(response, '<optgroup label="New Group">')
+        group = models.CategoryGroup.objects.create(name="New Group")
+        category = models.Category.objects.create(name="New Category",
+                                                  group=group)
+        category.user.add(self.profile)
+        response = self.client.get(url)
+        self.assertContains(response, '<optgroup label="New Group">')
+        response = self.client.post(url, {'account': self.checking.id,
+                'to_account': self.savings.id, 'date': '2014-03-01',
+                'category': category.pk, 'outflow': '5', 'inflow': '0'})
+        self.assertEqual(response.status_code, 302)
+        transfer = models.Transfer.objects.get()
+        self.assertEqual(transfer.to_account, self.savings)
+
+    def ajax(self, url, data=None):
+        response = self.client.post(url, data or {},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return response.status_code, json.loads(response.content)
+
+    def test_ajax_clear(self):
+        transaction = self.create_transaction(outflow=Decimal(5))
+        status, data = self.ajax('/ownbudget/accounts/clear_transaction/{}'.\
+                                 format(transaction.id))
+        self.assertEqual(status, 200)
+        self.assertEqual((data['id'], data['cleared']), (transaction.id, True))
+        self.assertEqual(data['accounts'][str(self.checking.id)],
+                         {'balance': "-5.00", 'cleared': "-5.00"})
+        self.assertEqual(data['totals'], {'total': "-5.00",
+                                          'budget': "-5.00",
+                                          'off_budget': "0.00"})
+
+    def test_ajax_add(self):
+        self.create_transaction(date=date(2014, 3, 5), outflow=Decimal(5))
+        category = models.Category.objects.filter(default=True)[0]
+        row = {'account': self.checking.id, 'date': '2014-03-01',
+               'payee': "Bakery", 'category': category.pk, 'outflow': '3',
+               'inflow': '0'}
+        status, data = self.ajax('/ownbudget/accounts/{}/add_transaction'.\
+                                 format(self.checking.id), row)
+        self.assertEqual(status, 200)
+        # Older than the existing row, which moves down by the amount
+        self.assertEqual((data['date'], data['amount']),
+                         ('2014-03-01', "-3.00"))
+        self.assertEqual(len(data['rows']), 1)
+        self.assertIn('data-balance="-3.00"', data['rows'][0])
+        self.assertEqual(data['totals']['total'], "-8.00")
+        # Both sides of a transfer are rows of the register of all accounts
+        del row['payee']
+        row.update(to_account=self.savings.id, date='2014-03-06')
+        status, data = self.ajax('/ownbudget/accounts/add_tranfer', row)
+        self.assertEqual((status, data['amount']), (200, "0.00"))
+        self.assertEqual(len(data['rows']), 2)
+        self.assertIn('data-balance="-11.00"', data['rows'][0])
+        self.assertIn('data-balance="-8.00"', data['rows'][1])
+        del row['to_account']
+        status, data = self.ajax('/ownbudget/accounts/add_transaction', row)
+        self.assertEqual(status, 400)
+        self.assertIn('payee', data['errors'])
+
+class CategoryMonthTest(BudgetTestCase):
+    def setUp(self):
+        super(CategoryMonthTest, self).setUp()
+        self.income = models.CategoryGroup.objects.create(name="Test Income",
+                                                          budgeted=False)
+        self.salary = models.Category.objects.create(name="Test Salary",
+                                                     group=self.income)
+
+    def budget(self, month, amount):
+        budget, _ = models.Budget.objects.get_or_create(user=self.profile,
+                                                        month=month)
+        return models.CategoryBudget.objects.create(budget=budget,
+                category=self.category, amount=Decimal(amount))
+
+    def rows(self):
+        return sorted((row.month, row.category_id, row.budgeted, row.inflow,
+                       row.outflow, row.carried_over)
+                      for row in models.CategoryMonth.objects.all())
+
+    def test_incremental_rows_match_rebuild(self):
+        self.create_transaction(date=date(2014, 1, 5), inflow=Decimal(1000),
+                                category=self.salary)
+        spent = self.create_transaction(date=date(2014, 3, 2),
+                                        outflow=Decimal(80))
+        budget = self.budget(date(2014, 1, 1), 100)
+        self.budget(date(2014, 2, 1), 50)
+        # Transfers off budget are outflows, between budget accounts not
+        self.create_transaction(model=models.Transfer, to_account=self.savings,
+                                date=date(2014, 2, 3), outflow=Decimal(30))
+        self.create_transaction(model=models.Transfer,
+                                to_account=self.create_account("Cash"),
+                                date=date(2014, 2, 3), outflow=Decimal(20))
+        spent.date = date(2014, 1, 20)
+        spent.save()
+        budget.amount = Decimal(120)
+        budget.save()
+        incremental = self.rows()
+        cat = self.category.pk
+        self.assertEqual(incremental, [
+            (date(2014, 1, 1), None, 120, 1000, 0, 0),
+            (date(2014, 1, 1), cat, 120, 0, 80, 0),
+            (date(2014, 2, 1), None, 50, 0, 0, 880),
+            (date(2014, 2, 1), cat, 50, 0, 30, 40)])
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+        models.rebuild_category_months()
+        self.assertEqual(self.rows(), incremental)
+
+    def test_rows_without_activity(self):
+        self.create_transaction(date=date(2014, 1, 5), outflow=Decimal(10))
+        budget = self.budget(date(2014, 2, 1), 50)
+        budget.amount = Decimal(0)
+        budget.save()
+        self.create_transaction(date=date(2014, 3, 5), outflow=Decimal(0))
+        incremental = self.rows()
+        self.assertEqual(incremental,
+                         [(date(2014, 1, 1), self.category.pk, 0, 0, 10, 0)])
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+        models.rebuild_category_months()
+        self.assertEqual(self.rows(), incremental)
+
+    def test_on_budget_change_rebuilds(self):
+        self.create_transaction(self.savings, outflow=Decimal(5))
+        self.assertEqual(self.rows(), [])
+        self.savings.on_budget = True
+        self.savings.save()
+        # The rebuild is a background job
+        self.assertEqual(self.rows(), [])
+        jobs.run_pending()
+        self.assertEqual(self.rows(), 
+                         [(date(2014, 3, 1), self.category.pk, 0, 0, 5, 0)])
+
+    def test_budget_grid(self):
+        self.category.user.add(self.profile)
+        self.budget(date(2013, 12, 1), 40)
+        self.create_transaction(date=date(2014, 2, 1), outflow=Decimal(15))
+        grid = views.budget_grid(self.profile, [date(2014, 1, 1), 
+                                                date(2014, 2, 1)])
+        self.assertEqual([(month['budgeted'], month['outflows'],
+                           month['balance'], month['available'])
+                          for month in grid],
+                         [(0, 0, 40, -40), (0, 15, 25, -40)])
+        self.client.login(username='jane', password='secret')
+        # session, user, profile, categories, category months, sidebar
+        with self.assertNumQueries(6):
+            self.client.get('/ownbudget/2014/2')
+
+    def test_year_grid(self):
+        self.category.user.add(self.profile)
+        for number in range(59):
+            models.Category.objects.create(name="Category {}".format(number),
+                    group=self.group).user.add(self.profile)
+        self.budget(date(2014, 5, 1), 40)
+        self.create_transaction(date=date(2014, 2, 1), outflow=Decimal(15))
+        self.client.login(username='jane', password='secret')
+        with self.assertNumQueries(6):
+            response = self.client.get('/ownbudget/2014')
+        self.assertEqual(len(response.context['budget']), 12)
+        groups = response.context['budget'][0]['groups']
+        self.assertEqual(len(response.context['rows']), len(groups) +
+                         sum(len(group['categories']) for group in groups))
+        self.assertGreaterEqual(len(response.context['rows']), 61)
+        self.assertEqual(response.context['budget'][4]['key'], '2014-05')
+        self.assertContains(response, 'id="budget-2014-12"')
+        caching.budget_cache().clear()
+        with self.assertNumQueries(6):
+            response = self.client.get('/ownbudget/2014/11?months=6')
+        self.assertEqual([month['label'] for month in
+                          response.context['budget']][-1], "April 2015")
+        self.assertEqual(response.context['previous']['key'], '2014-10')
+        for months in ('0', '13', 'x'):
+            self.assertEqual(self.client.get('/ownbudget/2014/2?months=' +
+                                             months).status_code, 400)
+
+class BalanceCheckpointTest(BudgetTestCase):
+    def setUp(self):
+        super(BalanceCheckpointTest, self).setUp()
+        self.checking.starting_balance = Decimal(100)
+        self.checking.save()
+        for month, outflow in ((1, 10), (1, 5), (3, 20)):
+            self.create_transaction(date=date(2013, month, 10),
+                                    outflow=Decimal(outflow))
+        self.create_transaction(model=models.Transfer, to_account=self.savings,
+                                date=date(2013, 2, 1), outflow=Decimal(30))
+
+    def checkpoints(self, account):
+        return list(account.checkpoints.order_by('date').values_list('date',
+                                                                     'amount'))
+
+    def test_balance_at(self):
+        checking = self.reload(self.checking)
+        self.assertEqual(checking.balance_at(date(2012, 12, 31)), 100)
+        self.assertEqual(checking.balance_at(date(2013, 1, 31)), 85)
+        self.assertEqual(checking.balance_at(date(2013, 3, 9)), 55)
+        self.assertEqual(checking.balance_at(date(2014, 1, 1)), 35)
+        self.assertEqual(self.checkpoints(checking)[:3],
+                         [(date(2013, 1, 31), -15), (date(2013, 2, 28), -45),
+                          (date(2013, 3, 31), -65)])
+        # Served from the December checkpoint and one month of changes
+        with self.assertNumQueries(3):
+            self.assertEqual(checking.balance_at(date(2014, 1, 5)), 35)
+
+    def test_back_dated_edit_keeps_earlier_checkpoints(self):
+        checking = self.reload(self.checking)
+        checking.balance_at(date(2013, 12, 31))
+        self.create_transaction(date=date(2013, 2, 15), inflow=Decimal(8))
+        self.assertEqual([day for day, _ in self.checkpoints(checking)],
+                         [date(2013, 1, 31)])
+        self.assertEqual(checking.balance_at(date(2013, 2, 28)), 63)
+
+    def test_net_worth_by_month(self):
+        self.assertEqual(self.profile.net_worth_by_month(date(2012, 12, 1),
+                                                         date(2013, 3, 1)),
+                         [(date(2012, 12, 31), 100), (date(2013, 1, 31), 85),
+                          (date(2013, 2, 28), 85), (date(2013, 3, 31), 65)])
+
+    def test_net_worth_from_checkpoints(self):
+        expected = self.profile.net_worth_by_month(date(2012, 12, 1),
+                                                   date(2013, 4, 1))
+        self.assertFalse(models.BalanceCheckpoint.objects.exists())
+        self.reload(self.savings).update_checkpoints(date(2013, 2, 28))
+        self.reload(self.checking).update_checkpoints(date(2013, 1, 31))
+        # The accounts, their checkpoints and the sums of both tables
+        with self.assertNumQueries(4):
+            self.assertEqual(self.profile.net_worth_by_month(
+                    date(2012, 12, 1), date(2013, 4, 1)), expected)
+        self.create_account("Cash")
+        with self.assertNumQueries(4):
+            self.profile.net_worth_by_month(date(2012, 12, 1),
+                                            date(2013, 4, 1))
+
+class ImportTest(BudgetTestCase):
+    CSV = (b"Date,Payee,Memo,Amount\n"
+           b"2014-03-01,Bakery,,\"-2,50\"\n"
+           b"2014-03-01,Bakery,,\"-2,50\"\n"
+           b"2014-03-02,Employer,Salary,1000.00\n")
+
+    def test_overlapping_statements(self):
+        rows = importers.parse_csv(self.CSV.splitlines(True))
+        self.assertEqual(importers.import_transactions(self.checking, rows,
+                                                       batch_size=2), (3, 0))
+        overlapping = self.CSV + b"2014-03-03,Bakery,,-2.50\n"
+        rows = importers.parse_csv(overlapping.splitlines(True))
+        self.assertEqual(importers.import_transactions(self.checking, rows),
+                         (1, 3))
+        self.assertEqual(self.reload(self.checking).saldo, Decimal("992.50"))
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_unsorted_statement(self):
+        unsorted = (b"Date,Payee,Memo,Amount\n"
+                    b"2014-03-01,Bakery,,-2.50\n"
+                    b"2014-03-02,Employer,Salary,1000.00\n"
+                    b"2014-03-01,Bakery,,-2.50\n")
+        rows = importers.parse_csv(unsorted.splitlines(True))
+        self.assertEqual(importers.import_transactions(self.checking, rows),
+                         (3, 0))
+        rows = importers.parse_csv(self.CSV.splitlines(True))
+        self.assertEqual(importers.import_transactions(self.checking, rows),
+                         (0, 3))
+
+    def test_qif_and_ofx(self):
+        qif = (b"!Type:Bank\nD03/01/2014\nT-12.00\nPShop\nN101\n^\n"
+               b"D03/02'2014\nT1,234.56\nPEmployer\n^\n")
+        ofx = (b"<OFX><BANKTRANLIST>\n<STMTTRN><TRNTYPE>DEBIT\n"
+               b"<DTPOSTED>20140301120000<TRNAMT>-12.00<NAME>Shop\n"
+               b"</STMTTRN><STMTTRN><DTPOSTED>20140302<TRNAMT>1234.56\n"
+               b"<NAME>Employer<MEMO>Salary</STMTTRN></BANKTRANLIST></OFX>\n")
+        for parse, statement in ((importers.parse_qif, qif),
+                                 (importers.parse_ofx, ofx)):
+            rows = [row for line, row in parse(statement.splitlines(True))]
+            self.assertEqual([(row['date'], row['amount'], row['payee']) 
+                              for row in rows],
+                             [(date(2014, 3, 1), Decimal("-12.00"), "Shop"),
+                              (date(2014, 3, 2), Decimal("1234.56"), 
+                               "Employer")])
+
+    def test_invalid_row(self):
+        rows = importers.parse_csv([b"date,payee,amount\n", b"2014-03-01,A,1\n",
+                                    b"tomorrow,B,2\n"])
+        with self.assertRaises(importers.StatementError) as e:
+            importers.import_transactions(self.checking, rows)
+        self.assertEqual(e.exception.line, 3)
+
+    def test_upload(self):
+        self.client.login(username='jane', password='secret')
+        url = '/ownbudget/accounts/{}/import'.format(self.checking.id)
+        self.assertContains(self.client.get(url), '>0.00</span>')
+        statement = SimpleUploadedFile("statement.csv", self.CSV)
+        response = self.client.post(url, {'file': statement, 'format': 'csv',
+                                          'encoding': 'utf-8'})
+        self.assertContains(response, "Imported 3 transaction(s)")
+        # The sidebar shows the new balances, not the cached ones
+        self.assertContains(response, '>995.00</span>')
+
+class ExportTest(BudgetTestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        for day in range(1, 6):
+            self.create_transaction(date=date(2014, 3, 6 - day),
+                                    outflow=Decimal(day))
+        self.create_transaction(model=models.Transfer, account=self.savings,
+                                to_account=self.checking, category=None,
+                                outflow=Decimal("100"))
+
+    def test_rows_in_chunks(self):
+        with self.assertNumQueries(4):
+            rows = list(exporters.transaction_rows(self.profile, 
+                                                   self.checking, 2))
+        self.assertEqual([row['outflow'] for row in rows],
+                         [5, 0, 4, 3, 2, 1])
+        self.assertEqual(rows[1]['inflow'], 100)
+        self.assertEqual(rows[1]['account'], "Checking")
+        self.assertEqual(rows[1]['transfer_account'], "Savings")
+        self.assertEqual(len(list(exporters.transaction_rows(self.profile))),
+                         6)
+
+    def test_same_day_rows(self):
+        for outflow in range(10, 15):
+            self.create_transaction(date=date(2014, 3, 1),
+                                    outflow=Decimal(outflow))
+            self.create_transaction(model=models.Transfer,
+                                    account=self.savings,
+                                    to_account=self.checking, category=None,
+                                    date=date(2014, 3, 1),
+                                    outflow=Decimal(outflow + 10))
+        expected = list(exporters.transaction_rows(self.profile,
+                                                   self.checking))
+        self.assertEqual(len(expected), 16)
+        self.assertEqual(list(exporters.transaction_rows(self.profile,
+                                                         self.checking, 2)),
+                         expected)
+        self.assertEqual([row['outflow'] + row['inflow'] for row in expected
+                          if row['date'] == date(2014, 3, 1)],
+                         [5, 100] + [Decimal(amount) for outflow in
+                                     range(10, 15) for amount in
+                                     (outflow, outflow + 10)])
+
+    def test_views(self):
+        self.client.login(username='jane', password='secret')
+        response = self.client.get('/ownbudget/accounts/{}/export.csv'.format(
+                self.checking.id))
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b"".join(response.streaming_content)
+                               .splitlines()))
+        self.assertEqual(tuple(rows[0]), exporters.TRANSACTION_FIELDS)
+        self.assertEqual(len(rows), 7)
+        response = self.client.get('/ownbudget/export.json')
+        months = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([(row['category'], row['balance']) for row in months],
+                         [("Test Category", "-15.00"), (None, "100.00")])
+        other = models.UserProfile.objects.create(
+                user=User.objects.create_user('joe'))
+        account = self.create_account("Other")
+        account.user = other
+        account.save()
+        response = self.client.get('/ownbudget/accounts/{}/export.json'.format(
+                account.id))
+        self.assertEqual(response.status_code, 403)
+
+    def test_command(self):
+        output = StringIO()
+        call_command('export', 'transactions', user='jane', format='json',
+                     stdout=output)
+        self.assertEqual(len(json.loads(output.getvalue())), 6)
+        with self.assertRaises(CommandError):
+            call_command('export', 'budget', stdout=StringIO())
+
+class APITest(BudgetTestCase):
+    def setUp(self):
+        super(APITest, self).setUp()
+        for day in range(1, 6):
+            self.create_transaction(date=date(2014, 3, day),
+                                    outflow=Decimal(day))
+        self.client.login(username='jane', password='secret')
+
+    def get(self, url, **headers):
+        return self.client.get('/ownbudget/api/' + url, HTTP_ACCEPT=
+                               'application/json', **headers)
+
+    def test_cursor_pages(self):
+        ids, url = [], 'transactions/?limit=2&fields=id,outflow'
+        while url:
+            response = self.get(url)
+            ids += [row['id'] for row in response.data['results']]
+            self.assertEqual(set(response.data['results'][0]),
+                             set(['id', 'outflow']))
+            url = response.data['next'] and response.data['next'].split(
+                    '/api/', 1)[1]
+        self.assertEqual(ids, sorted(models.Transaction.objects.values_list(
+                'id', flat=True)))
+
+    def test_conditional_get(self):
+        response = self.get('accounts/')
+        etag = response['ETag']
+        with self.assertNumQueries(3):
+            response = self.get('accounts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.get('accounts/', HTTP_IF_MODIFIED_SINCE=
+                            response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.create_transaction(outflow=Decimal(1))
+        response = self.get('accounts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['balance'],
+                         Decimal("-16"))
+
+    def test_bulk_create(self):
+        rows = [{'account': self.checking.id, 'date': '2014-04-0{}'.format(i),
+                 'payee': 'Shop', 'outflow': '1.50'} for i in range(1, 4)]
+        response = self.client.post('/ownbudget/api/transactions/bulk/',
+                                    json.dumps(rows),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'created': 3})
+        self.assertEqual(self.reload(self.checking).saldo, Decimal("-19.50"))
+        other = self.create_account("Other")
+        other.user = models.UserProfile.objects.create(
+                user=User.objects.create_user('joe'))
+        other.save()
+        rows[0]['account'] = other.id
+        response = self.client.post('/ownbudget/api/transactions/bulk/',
+                                    json.dumps(rows),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_update(self):
+        transaction = models.Transaction.objects.order_by('pk').first()
+        category = models.Category.objects.create(name="Other",
+                                                  group=self.group)
+        category.user.add(self.profile)
+        response = self.client.patch('/ownbudget/api/transactions/{}/'.format(
+                transaction.pk), json.dumps({'outflow': '99.00',
+                                             'date': '2014-02-01',
+                                             'category': category.pk}),
+                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.reload(self.checking).saldo, Decimal(-113))
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_reconciled_rows_are_locked(self):
+        transaction = models.Transaction.objects.order_by('pk').first()
+        models.Transaction.objects.filter(pk=transaction.pk).update(
+                cleared=True, reconciled=True)
+        category = models.Category.objects.create(name="Other",
+                                                  group=self.group)
+        category.user.add(self.profile)
+        url = '/ownbudget/api/transactions/{}/'.format(transaction.pk)
+        response = self.client.patch(url, json.dumps({'outflow': '99.00',
+                                                      'cleared': False}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.delete(url).status_code, 403)
+        response = self.client.patch(url, json.dumps({'category':
+                                                      category.pk}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        transaction = models.Transaction.objects.get(pk=transaction.pk)
+        self.assertEqual((transaction.outflow, transaction.cleared,
+                          transaction.category), (1, True, category))
+
+    def test_one_budget_per_month(self):
+        for status_code in (201, 400):
+            response = self.client.post('/ownbudget/api/budgets/',
+                                        {'month': '2014-03-01'})
+            self.assertEqual(response.status_code, status_code)
+        self.assertEqual(self.get('').status_code, 200)
+
+class CacheTest(BudgetTestCase):
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+
+    def test_month_navigation(self):
+        self.client.get('/ownbudget/2014/3')
+        # session, user, profile
+        with self.assertNumQueries(3):
+            response = self.client.get('/ownbudget/2014/3')
+        self.assertEqual(caching.stats(), (2, 2))
+        self.create_transaction(outflow=Decimal("12.34"))
+        response = self.client.get('/ownbudget/2014/3')
+        self.assertContains(response, "-12.34")
+        self.assertEqual(caching.stats(), (2, 4))
+
+    def test_file_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        with self.settings(CACHES={'default': {'BACKEND': 
+                'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': location}}):
+            for i in range(2):
+                self.assertEqual(caching.cached(self.profile, 'test',
+                                                lambda: [i]), [0])
+            self.assertEqual(caching.stats(), (1, 1))
+            output = StringIO()
+            call_command('cache_stats', stdout=output)
+            self.assertIn("hit rate 50%", output.getvalue())
+
+class ScheduleTest(BudgetTestCase):
+    def schedule(self, **kwargs):
+        kwargs.setdefault('start', date(2014, 1, 31))
+        kwargs.setdefault('category', self.category)
+        return models.ScheduledTransaction.objects.create(
+                account=self.checking, payee="Rent", outflow=Decimal(500),
+                **kwargs)
+
+    def test_occurrences(self):
+        schedule = self.schedule(end=date(2014, 5, 1))
+        self.assertEqual([schedule.occurrence(i) for i in range(3)],
+                         [date(2014, 1, 31), date(2014, 2, 28),
+                          date(2014, 3, 31)])
+        schedule = self.schedule(unit=models.ScheduledTransaction.WEEKS,
+                                 interval=2)
+        self.assertEqual(schedule.occurrence(2), date(2014, 2, 28))
+
+    def test_pending_occurrences(self):
+        self.schedule(end=date(2014, 5, 1))
+        self.assertEqual(models.materialize_schedules(date(2014, 2, 15), 45),
+                         (3, 0))
+        self.assertEqual(self.reload(self.checking).saldo, Decimal(-500))
+        self.assertEqual(self.checking.transactions.filter(
+                implemented=False).count(), 2)
+        # Nothing new is due, the next run only implements February
+        self.assertEqual(models.materialize_schedules(date(2014, 3, 1)),
+                         (0, 1))
+        self.assertEqual(models.materialize_schedules(date(2014, 6, 1)),
+                         (1, 1))
+        self.assertEqual(self.reload(self.checking).saldo, Decimal(-2000))
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_scheduled_transfers(self):
+        self.schedule(to_account=self.savings, category=None)
+        self.assertEqual(models.materialize_schedules(date(2014, 3, 5), 30),
+                         (3, 0))
+        self.assertEqual(models.Transfer.objects.filter(
+                to_account=self.savings).count(), 3)
+        self.assertEqual(self.reload(self.savings).saldo, Decimal(1000))
+        self.assertEqual(models.materialize_schedules(date(2014, 4, 1)),
+                         (0, 1))
+        self.assertEqual(self.reload(self.savings).saldo, Decimal(1500))
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_changed_rule_replaces_pending(self):
+        schedule = self.schedule()
+        models.materialize_schedules(date(2014, 2, 1), 60)
+        schedule.outflow = Decimal(600)
+        schedule.save()
+        self.assertEqual(schedule.next_date, date(2014, 2, 28))
+        models.materialize_schedules(date(2014, 3, 1))
+        self.assertEqual(self.reload(self.checking).saldo, Decimal(-1100))
+
+class BulkActionTest(BudgetTestCase):
+    def setUp(self):
+        super(BulkActionTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+        self.ids = [self.create_transaction(outflow=Decimal(i)).id
+                    for i in range(1, 4)]
+        self.ids.append(self.create_transaction(model=models.Transfer,
+                to_account=self.savings, category=None,
+                outflow=Decimal(10)).id)
+
+    def post(self, action, ids=None, **data):
+        data.update({'action': action, 'ids': ids or self.ids,
+                     'next': '/ownbudget/accounts/'})
+        return self.client.post('/ownbudget/accounts/bulk', data)
+
+    def test_clear_and_move(self):
+        other = self.create_account("Other")
+        response = self.client.get('/ownbudget/accounts/')
+        self.assertContains(response, 'form="register-actions"', 5)
+        self.assertRedirects(self.post('clear'), '/ownbudget/accounts/')
+        self.assertEqual(self.reload(self.checking).cleared_balance,
+                         Decimal(-16))
+        self.assertEqual(self.reload(self.savings).cleared_balance,
+                         Decimal(10))
+        # Transfers are not moved, not even to their own counter account
+        for account in (other, self.savings):
+            self.assertEqual(self.post('move', self.ids[2:],
+                                       account=account.id).status_code, 400)
+        self.assertEqual(self.reload(self.savings).saldo, Decimal(10))
+        self.post('move', self.ids[:2], account=other.id)
+        self.assertEqual(self.reload(other).saldo, Decimal(-3))
+        self.assertEqual(self.reload(self.checking).saldo, Decimal(-13))
+        self.post('categorize', self.ids[3:], category=self.category.pk)
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_delete(self):
+        self.post('delete')
+        self.assertFalse(models.Transaction.objects.exists())
+        self.assertEqual(self.reload(self.checking).saldo, 0)
+        self.assertEqual(self.reload(self.savings).saldo, 0)
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_foreign_rows(self):
+        other = models.UserProfile.objects.create(
+                user=User.objects.create_user('joe'))
+        account = self.create_account("Other")
+        account.user = other
+        account.save()
+        foreign = self.create_transaction(account=account).id
+        self.assertEqual(self.post('clear', [foreign]).status_code, 403)
+        self.assertEqual(self.post('move', account=account.id).status_code,
+                         400)
+        self.assertEqual(self.post('categorize').status_code, 400)
+
+class ReconcileTest(BudgetTestCase):
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+        self.rows = [self.create_transaction(outflow=Decimal(i))
+                     for i in range(1, 4)]
+        self.url = '/ownbudget/accounts/{}/reconcile'.format(self.checking.id)
+        self.statement = {'date': '2014-03-31', 'balance': '-3.00'}
+
+    def toggle(self, transaction, cleared=True):
+        data = dict(self.statement, id=transaction.id)
+        if cleared:
+            data['cleared'] = 'on'
+        return json.loads(self.client.post(self.url + '/toggle', data).content)
+
+    def test_reconcile(self):
+        response = self.client.get(self.url, self.statement)
+        self.assertEqual(response.context['difference'], Decimal(-3))
+        self.assertEqual(len(response.context['transactions']), 3)
+        self.assertEqual(self.toggle(self.rows[0]), {'cleared': '-1.00',
+                         'uncleared': '-5.00', 'difference': '-2.00'})
+        self.assertEqual(self.toggle(self.rows[1])['difference'], '0.00')
+        # Not finished while the difference is not zero
+        self.toggle(self.rows[1], False)
+        self.client.post(self.url, self.statement)
+        self.assertFalse(models.Transaction.objects.filter(
+                reconciled=True).exists())
+        self.toggle(self.rows[1])
+        response = self.client.post(self.url, self.statement)
+        self.assertRedirects(response, '/ownbudget/accounts/{}'.format(
+                self.checking.id))
+        self.assertEqual(sorted(models.Transaction.objects.filter(
+                reconciled=True).values_list('pk', flat=True)),
+                [self.rows[0].pk, self.rows[1].pk])
+        self.assertEqual(len(self.client.get(self.url, self.statement).\
+                context['transactions']), 1)
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+    def test_reconciled_rows_are_locked(self):
+        self.toggle(self.rows[0])
+        models.reconcile(self.checking, date(2014, 3, 31), Decimal(-1))
+        response = self.client.get('/ownbudget/accounts/clear_transaction/{}'.\
+                format(self.rows[0].id))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post('/ownbudget/accounts/bulk', {
+                'action': 'unclear', 'ids': [self.rows[0].id]})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(self.url + '/toggle', dict(self.statement,
+                                    id=self.rows[0].id))
+        self.assertEqual(response.status_code, 404)
+        for id in ('abc', ''):
+            response = self.client.post(self.url + '/toggle',
+                                        dict(self.statement, id=id))
+            self.assertEqual(response.status_code, 400)
+
+class InstrumentationTest(BudgetTestCase):
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+
+    def test_server_timing(self):
+        self.client.get('/ownbudget/2014/3')
+        response = self.client.get('/ownbudget/2014/3')
+        self.assertRegexpMatches(response['Server-Timing'],
+                r'^db;dur=[\d.]+;desc="3 queries", tpl;dur=[\d.]+, '
+                r'total;dur=[\d.]+$')
+        response = self.client.get('/ownbudget/login')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_budgets(self):
+        budgets = {'budget.views.budget': {'queries': 2}}
+        with self.settings(BUDGET_VIEW_BUDGETS=budgets,
+                           BUDGET_VIEW_BUDGETS_STRICT=True):
+            with self.assertRaises(middleware.ViewBudgetExceeded):
+                self.client.get('/ownbudget/2014/3')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        self.addCleanup(setattr, middleware.logger, 'handlers',
+                        middleware.logger.handlers)
+        middleware.logger.handlers = [handler]
+        with self.settings(BUDGET_VIEW_BUDGETS=budgets,
+                           BUDGET_VIEW_BUDGETS_STRICT=False):
+            self.assertEqual(self.client.get('/ownbudget/2014/3').status_code,
+                             200)
+        self.assertEqual(records[-1].getMessage(),
+                         "budget.views.budget ran 3 queries, the budget is 2")
+
+    def test_opt_in(self):
+        with self.settings(BUDGET_INSTRUMENTATION=False):
+            self.assertRaises(MiddlewareNotUsed,
+                              middleware.InstrumentationMiddleware)
+        with self.settings(BUDGET_INSTRUMENTATION=True):
+            middleware.InstrumentationMiddleware()
+
+class GenerateDataTest(TestCase):
+    def test_generate_data(self):
+        call_command('generate_data', users=2, accounts=2, transactions=30,
+                     transfer_ratio=0.5, months=3, stdout=StringIO())
+        profile = models.UserProfile.objects.get(user__username='bench1')
+        self.assertTrue(self.client.login(username='bench1',
+                                          password='bench1'))
+        self.assertEqual(profile.accounts.count(), 2)
+        self.assertEqual(profile.budgets.count(), 3)
+        transfers = models.Transfer.objects.filter(account__user=profile)
+        self.assertTrue(transfers.exists())
+        self.assertFalse(transfers.exclude(
+                memo__startswith="Generated transfer ").exists())
+        self.assertFalse(models.Transaction.objects.filter(
+                import_hash__isnull=False).exists())
+        self.assertEqual(models.Transaction.objects.filter(
+                account__user=profile, transfer__isnull=True).count() +
+                transfers.count(), 60)
+        call_command('rebuild_balances', check=True, stdout=StringIO())
+
+class QueryPlanTest(BudgetTestCase):
+    def test_check_query_plans(self):
+        output = StringIO()
+        call_command('check_query_plans', stdout=output)
+        self.assertIn("All query plans use indexes", output.getvalue())
+        # Without the index in register order the transfers are sorted
+        cursor = connection.cursor()
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = "
+                       "'index' AND tbl_name = 'budget_transfer' AND sql LIKE "
+                       "'%to_date%'")
+        name, sql = cursor.fetchone()
+        cursor.execute("DROP INDEX {}".format(name))
+        self.addCleanup(cursor.execute, sql)
+        with self.assertRaisesRegexp(CommandError,
+                                     "register transfers: sort"):
+            call_command('check_query_plans', stdout=StringIO())
+
+class ReportTest(BudgetTestCase):
+    def setUp(self):
+        super(ReportTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+        self.create_transaction(outflow=Decimal(10))
+        self.create_transaction(date=date(2014, 4, 2), outflow=Decimal(5))
+        self.create_transaction(category=None, inflow=Decimal(100))
+        # Leaves the budget for the off budget account
+        self.create_transaction(model=models.Transfer,
+                                to_account=self.savings, outflow=Decimal(20))
+
+    def report(self, name, **params):
+        params.update({'from': '2014-03', 'to': '2014-04'})
+        response = self.client.get('/ownbudget/reports/{}.json'.format(name),
+                                   params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_spending(self):
+        expected = {'months': ['2014-03', '2014-04'],
+                    'series': [{'name': 'Test Category', 'values': [30, 5],
+                                'total': 35}]}
+        self.assertEqual(self.report('spending'), expected)
+        expected['series'][0]['name'] = 'Test Group'
+        self.assertEqual(self.report('spending', by='group'), expected)
+
+    def test_income_and_net_worth(self):
+        self.assertEqual(self.report('income')['series'],
+                         [{'name': 'Income', 'values': [100, 0]},
+                          {'name': 'Outflow', 'values': [30, 5]},
+                          {'name': 'Net', 'values': [70, -5]}])
+        self.assertEqual(self.report('net_worth')['series'],
+                         [{'name': 'Net worth', 'values': [90, 85]}])
+        # Reading a report never writes checkpoints
+        self.assertFalse(models.BalanceCheckpoint.objects.exists())
+        response = self.client.get('/ownbudget/reports/income.json',
+                                   {'from': '2014-13'})
+        self.assertEqual(response.status_code, 400)
+
+class SearchTest(BudgetTestCase):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+        self.bakery = self.create_transaction(payee="Corner Bakery",
+                                              memo="Birthday cake")
+        self.create_transaction(payee="Supermarket", memo="Weekly shopping")
+
+    def found(self, text):
+        return set(transaction.pk for transaction in
+                   search.search_transactions(self.profile, text))
+
+    def test_search(self):
+        self.assertEqual(self.found("bak"), set([self.bakery.pk]))
+        self.assertEqual(self.found("corner CAKE"), set([self.bakery.pk]))
+        self.assertEqual(self.found("bakery shopping"), set())
+        self.assertEqual(self.found(" AND "), set())
+        self.bakery.payee = "Butcher"
+        self.bakery.save()
+        self.assertEqual(self.found("bak"), set())
+        imported = models.Transaction(account=self.checking, payee="Bakery",
+                                      date=date(2014, 3, 2))
+        models.bulk_create_transactions([imported])
+        self.assertEqual(len(self.found("bak")), 1)
+        rows = models.ledger_rows(models.Transaction.objects.filter(
+                payee="Bakery"))
+        models.delete_transactions(rows)
+        self.assertEqual(self.found("bak"), set())
+        response = self.client.get('/ownbudget/search/', {'q': "cake"})
+        self.assertContains(response, "Butcher")
+
+    def test_payee_suggestions(self):
+        self.create_transaction(payee="Supermarket", category=None)
+        response = self.client.get('/ownbudget/payees.json', {'q': "SU"})
+        self.assertEqual(json.loads(response.content)['payees'],
+                         [{'payee': "Supermarket", 'category': None}])
+        self.assertEqual(search.suggest_payees(self.profile, "x"), [])
+        profile = models.UserProfile.objects.get(pk=self.profile.pk)
+        search.suggest_payees(profile, "c")
+        with self.assertNumQueries(0):
+            search.suggest_payees(profile, "c")
+        self.create_transaction(payee="Cinema")
+        profile = models.UserProfile.objects.get(pk=self.profile.pk)
+        self.assertEqual([row['payee'] for row in search.suggest_payees(
+                profile, "c")], ["Cinema", "Corner Bakery"])
+
+class CurrencyTest(BudgetTestCase):
+    def setUp(self):
+        super(CurrencyTest, self).setUp()
+        self.rates = tempfile.NamedTemporaryFile(suffix='.csv')
+        self.rates.write("Date,USD,CHF,\n"
+                         "2014-03-03,1.25,N/A,\n"
+                         "2014-03-01,1.5,1.2,\n")
+        self.rates.flush()
+        call_command('load_exchange_rates', self.rates.name, stdout=StringIO())
+        self.profile.currency_id = 'EUR'
+        self.profile.save()
+
+    def tearDown(self):
+        self.rates.close()
+
+    def test_load(self):
+        self.assertEqual(unicode(models.Currency.objects.get(pk='USD')),
+                         u"USD (USD)")
+        self.assertEqual(models.exchange_rates(['EUR', 'USD', 'CHF'],
+                                               date(2014, 3, 2)),
+                         {'EUR': 1, 'USD': Decimal('1.5'),
+                          'CHF': Decimal('1.2')})
+        self.assertEqual(models.exchange_rates(['USD', 'CHF'],
+                                               date(2014, 3, 5)),
+                         {'USD': Decimal('1.25'), 'CHF': Decimal('1.2')})
+
+    def test_totals(self):
+        self.checking.currency_id = 'USD'
+        self.checking.starting_balance = Decimal(125)
+        self.checking.save()
+        self.create_account("Swiss", currency_id='CHF',
+                            starting_balance=Decimal(12))
+        self.create_account("Cash", starting_balance=Decimal(5))
+        self.create_account("Stocks", currency_id='USD', on_budget=False,
+                            starting_balance=Decimal(250))
+        profile = models.UserProfile.objects.get(pk=self.profile.pk)
+        # The accounts and the rates of all currencies at once
+        with self.assertNumQueries(2):
+            self.assertEqual(profile.budget_accounts_sum, Decimal('115.00'))
+            self.assertEqual(profile.off_budget_accounts_sum,
+                             Decimal('200.00'))
+            self.assertEqual(profile.total_accounts_sum, Decimal('315.00'))
+        with self.assertNumQueries(1):
+            models.UserProfile(pk=self.profile.pk,
+                               currency_id='EUR').account_balances()
+        self.create_account("Pounds", currency_id='GBP')
+        profile = models.UserProfile.objects.get(pk=self.profile.pk)
+        self.assertIsNone(profile.total_accounts_sum)
+
+    def test_sidebar_follows_the_rates(self):
+        self.create_account("Pounds", currency_id='GBP',
+                            starting_balance=Decimal(100))
+        self.client.login(username='jane', password='secret')
+        response = self.client.get('/ownbudget/accounts/')
+        self.assertRegexpMatches(response.content,
+                                 r'id="balance-total"[^>]*></span>')
+        rates = tempfile.NamedTemporaryFile(suffix='.csv')
+        self.addCleanup(rates.close)
+        rates.write("Date,GBP\n2014-03-01,0.8\n")
+        rates.flush()
+        call_command('load_exchange_rates', rates.name, stdout=StringIO())
+        response = self.client.get('/ownbudget/accounts/')
+        self.assertRegexpMatches(response.content,
+                                 r'id="balance-total"[^>]*>125.00</span>')
+
+class JobTest(BudgetTestCase):
+    def setUp(self):
+        super(JobTest, self).setUp()
+        self.client.login(username='jane', password='secret')
+
+    def test_coalescing(self):
+        job = jobs.enqueue('recompute_user', self.profile.pk)
+        self.assertEqual(jobs.enqueue('recompute_user', self.profile.pk), job)
+        self.assertNotEqual(jobs.enqueue('recompute_user', self.savings.pk),
+                            job)
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(models.Job.objects.get(pk=job.pk).status,
+                         models.Job.DONE)
+        self.assertNotEqual(jobs.enqueue('recompute_user', self.profile.pk),
+                            job)
+        self.assertRaises(ValueError, jobs.enqueue, 'unknown')
+
+    def test_retries(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        self.addCleanup(setattr, jobs.logger, 'handlers', jobs.logger.handlers)
+        jobs.logger.handlers = [handler]
+        job = jobs.enqueue('refresh_user', user_id=0)
+        with self.settings(BUDGET_JOB_ATTEMPTS=2, BUDGET_JOB_BACKOFF=0):
+            self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(len(records), 2)
+        job = models.Job.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.attempts),
+                         (models.Job.FAILED, 2))
+        self.assertIn("DoesNotExist", job.error)
+
+    def test_failed_report_keeps_checkpoints(self):
+        self.create_transaction(date=date(2014, 1, 10), outflow=Decimal(5))
+        def fail(*args, **kwargs):
+            raise RuntimeError("Report failed")
+        self.addCleanup(setattr, reports, 'cached_report',
+                        reports.cached_report)
+        reports.cached_report = fail
+        self.addCleanup(setattr, jobs.logger, 'disabled', False)
+        jobs.logger.disabled = True
+        jobs.enqueue('refresh_user', self.profile.pk)
+        job = jobs.run_job(jobs.claim())
+        self.assertIn("Report failed", job.error)
+        self.assertTrue(self.checking.checkpoints.filter(
+                date=date(2014, 1, 31)).exists())
+
+    def test_views_enqueue(self):
+        row = {'account': self.checking.pk, 'date': '2014-03-01',
+               'payee': "Shop", 'outflow': '5', 'inflow': '0',
+               'category': models.Category.objects.filter(default=True)[0].pk}
+        response = self.client.post('/ownbudget/accounts/add_transaction',
+                                    row,
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        url = '/ownbudget/jobs/{}.json'.format(
+                json.loads(response.content)['job'])
+        self.assertEqual(json.loads(self.client.get(url).content)['status'],
+                         'pending')
+        row['date'] = '2014-03-02'
+        self.client.post('/ownbudget/accounts/add_transaction', row)
+        self.assertEqual(models.Job.objects.count(), 1)
+        models.Job.objects.update(run_after=models.Job.objects.get().created)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(json.loads(self.client.get(url).content)['status'],
+                         'done')
+        self.assertEqual(len(json.loads(self.client.get(
+                '/ownbudget/jobs.json').content)['jobs']), 1)
+        self.client.logout()
+        User.objects.create_user('joe', password='secret')
+        self.client.login(username='joe', password='secret')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+class ReplicaTest(BudgetTestCase):
+    def request(self, method, view, session):
+        request = getattr(RequestFactory(), method)('/')
+        request.session = session
+        self.middleware.process_request(request)
+        self.middleware.process_view(request, view, (), {})
+        return request
+
+    def test_routing(self):
+        router = routers.ReplicaRouter()
+        self.middleware = routers.ReplicaMiddleware()
+        session = {}
+        with self.settings(BUDGET_READ_REPLICAS=['replica']):
+            request = self.request('get', views.accounts, session)
+            self.assertEqual(router.db_for_read(models.Account), 'replica')
+            self.assertEqual(router.db_for_write(models.Account), 'default')
+            self.middleware.process_response(request, HttpResponse())
+            self.assertIsNone(router.db_for_read(models.Account))
+            request = self.request('get', views.add_transaction, session)
+            self.assertIsNone(router.db_for_read(models.Account))
+            self.middleware.process_response(request, HttpResponse())
+            self.assertNotIn(routers.PRIMARY_UNTIL, session)
+            request = self.request('post', views.add_transaction, session)
+            self.middleware.process_response(request, HttpResponse())
+            self.request('get', views.accounts, session)
+            self.assertIsNone(router.db_for_read(models.Account))
+            with self.settings(BUDGET_PRIMARY_STICKINESS=0):
+                session[routers.PRIMARY_UNTIL] = 0
+                self.request('get', views.account, session)
+                self.assertEqual(router.db_for_read(models.Account),
+                                 'replica')
+        self.assertEqual(self.client.get('/ownbudget/accounts/').status_code,
+                         302)
+
+    def test_reports_read_from_the_replica(self):
+        default = connections['default']
+        replica = type(default)(default.settings_dict, 'replica')
+        # The test database lives in the memory of its connection
+        replica.connection = default.connection
+        setattr(connections._connections, 'replica', replica)
+        self.addCleanup(delattr, connections._connections, 'replica')
+        self.create_transaction(outflow=Decimal(5))
+        self.middleware = routers.ReplicaMiddleware()
+        with self.settings(BUDGET_READ_REPLICAS=['replica']):
+            request = self.request('get', views.report, {})
+            self.addCleanup(self.middleware.process_response, request,
+                            HttpResponse())
+            # The transactions, accounts and categories
+            with self.assertNumQueries(3, using='replica'):
+                rows = reports.load(self.profile, date(2014, 3, 1))
+        self.assertEqual(list(rows['outflow']), [500])
+
+    def test_copy(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source, target = [os.path.join(directory, name)
+                          for name in ('primary.sqlite3', 'replica.sqlite3')]
+        primary = sqlite3.connect(source)
+        primary.execute("CREATE TABLE t (x INTEGER)")
+        primary.execute("INSERT INTO t VALUES (1)")
+        primary.commit()
+        routers.copy_sqlite_database(source, target)
+        primary.execute("INSERT INTO t VALUES (2)")
+        self.assertEqual(sqlite3.connect(target).execute(
+                "SELECT x FROM t").fetchall(), [(1,)])
+        primary.close()
@@ -1,22 +1,52 @@
 from django.conf.urls import patterns, include, url
+from rest_framework import routers
 
-from budget import views
+from budget import api, views
+
+router = routers.DefaultRouter()
+router.register(r'accounts', api.AccountViewSet, base_name='account')
+router.register(r'transactions', api.TransactionViewSet,
+                base_name='transaction')
+router.register(r'transfers', api.TransferViewSet, base_name='transfer')
+router.register(r'schedules', api.ScheduledTransactionViewSet,
+                base_name='schedule')
+router.register(r'categories', api.CategoryViewSet, base_name='category')
+router.register(r'budgets', api.BudgetMonthViewSet, base_name='budget')
+router.register(r'category_budgets', api.CategoryBudgetViewSet,
+                base_name='categorybudget')
 
 urlpatterns = patterns('',
     url(r'^/?$', views.budget, name='index'),
     url(r'^(?P<year>\d{4})/(?P<month>\d{1,2})/?$', views.budget),
+    url(r'^(?P<year>\d{4})/?$', views.budget),
     url(r'^accounts/?$', views.accounts),
     url(r'^accounts/add/?$', views.add_account),
     url(r'^accounts/delete_transaction/(?P<id>\d+)/?$', views.delete_transaction),
     url(r'^accounts/clear_transaction/(?P<id>\d+)/?$', views.clear_transaction),
+    url(r'^accounts/bulk/?$', views.bulk_transactions),
     url(r'^accounts/add_transaction/?$', views.add_transaction),
     url(r'^accounts/add_tranfer/?$', views.add_transfer),
     url(r'^accounts/(?P<id>\d+)/?$', views.account),
     url(r'^accounts/(?P<id>\d+)/delete/?$', views.delete_account),
     url(r'^accounts/(?P<account_id>\d+)/add_transaction/?$', views.add_transaction),
     url(r'^accounts/(?P<account_id>\d+)/add_tranfer/?$', views.add_transfer),
+    url(r'^accounts/(?P<account_id>\d+)/import/?$', views.import_transactions),
+    url(r'^accounts/(?P<account_id>\d+)/reconcile/?$', views.reconcile),
+    url(r'^accounts/(?P<account_id>\d+)/reconcile/toggle$',
+        views.reconcile_toggle),
+    url(r'^accounts/(?P<account_id>\d+)/export\.(?P<format>csv|json)$',
+        views.export_transactions),
+    url(r'^accounts/export\.(?P<format>csv|json)$', views.export_transactions),
+    url(r'^export\.(?P<format>csv|json)$', views.export_budget),
+    url(r'^search/?$', views.search_transactions),
+    url(r'^payees\.json$', views.payees),
+    url(r'^jobs\.json$', views.job_status),
+    url(r'^jobs/(?P<id>\d+)\.json$', views.job_status),
+    url(r'^reports/(?P<name>spending|income|net_worth)\.json$',
+        views.report),
     url(r'^api/auth/', include('rest_framework.urls', 
         namespace='rest_framework')),
+    url(r'^api/', include(router.urls)),
     url(r'^login', 'django.contrib.auth.views.login', 
         {'template_name': 'budget/login.html'}),
     url(r'^logout', 'django.contrib.auth.views.logout',
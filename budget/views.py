@@ -1,19 +1,33 @@
+import json
+from collections import defaultdict
 from datetime import date
+from decimal import Decimal, InvalidOperation
+from functools import wraps
+from itertools import groupby
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
+from django.core import signing
 from django.core.urlresolvers import reverse
-from django.db.models import Q
-from django.forms import ModelChoiceField, HiddenInput 
-from django.http import HttpResponseRedirect, HttpResponseForbidden
+from django.db import connections
+from django.db.models import Q, Sum
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, \
+        HttpResponseRedirect, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.http import require_POST
 
-from budget import models, forms
+from budget import models, forms, caching, exporters, importers, jobs, \
+        reports, search
+from budget.routers import read_only
 from budget.widgets import *
 
 def ensure_budget_profile(view, *args, **kwargs):
     @login_required(*args, **kwargs)
+    @wraps(view)
     def check(request, *args, **kwargs):
         try:
             request.user.budget_profile
@@ -35,63 +49,296 @@ def register(request):
         'form': form,
     })
 
+MAX_GRID_MONTHS = 12
+
+@read_only
 @ensure_budget_profile
 def budget(request, year=None, month=None):
+    """
+    Shows the budget of BUDGET_GRID_MONTHS months from the given month, of
+    ?months=N months (at most MAX_GRID_MONTHS), or of the whole year when
+    only the year is given.
+    """
     today = date.today()
     user = request.user.budget_profile
-    if year == None:
-        year = today.year
-    else:
-        year = int(year)
-    if month == None:
-        month = today.month
-    else:
-        month = int(month)
-    today = date.today()
-    first_month = date(year, month, 1)
-    second_month = date(year, month % 12 + 1, 1)
-    third_month = date(year, (month + 1) % 12 + 1, 1)
-    budget = user.budgets.filter(month__range=(first_month, third_month))
-    if budget.count() < 3:
-        if budget.count() == 0:
-            budget = [models.Budget(month=first_month, user=user)]
-        else:
-            budget = list(budget)
-        if len(budget) < 2:
-            budget.append(models.Budget(month=second_month, user=user))
-        if len(budget) < 3:
-            budget.append(models.Budget(month=third_month, user=user))
+    default = MAX_GRID_MONTHS if year and not month else \
+            getattr(settings, 'BUDGET_GRID_MONTHS', 3)
+    try:
+        count = int(request.GET.get('months') or default)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid number of months")
+    if not 1 <= count <= MAX_GRID_MONTHS:
+        return HttpResponseBadRequest("Invalid number of months")
+    try:
+        first_month = date(int(year) if year else today.year,
+                           int(month or 1) if year else today.month, 1)
+    except ValueError:
+        raise Http404
+    months = [models.add_months(first_month, i) for i in range(count)]
+    budget = caching.cached(user, 'grid', lambda: budget_grid(user, months),
+                            *months)
+    for month_budget in budget:
+        month_budget.update(month_labels(month_budget['month'], today))
+    previous, following = (models.add_months(first_month, -1),
+                           models.add_months(first_month, 1))
     return render(request, 'budget/budget.html', 
-            {'year': year, 'month': month, 'budget': budget, 'today': today})
+            {'year': first_month.year, 'month': first_month.month,
+             'budget': budget, 'rows': grid_rows(budget), 'today': today,
+             'months': count,
+             'query': "?months={}".format(count) if count != default else "",
+             'previous': month_labels(previous, today),
+             'next': month_labels(following, today),
+             'navigation': [dict(month_labels(day, today),
+                                 shown=months[0] <= day <= months[-1])
+                            for day in (date(first_month.year, number, 1)
+                                        for number in range(1, 13))],
+             'lengths': sorted(set([1, 3, 6, MAX_GRID_MONTHS, default]))})
+
+def month_labels(month, today):
+    """Returns the key and labels the templates show for ``month``"""
+    previous = models.add_months(month, -1)
+    return {'key': month.strftime("%Y-%m"), 'year': month.year,
+            'number': month.month, 'label': month.strftime("%B %Y"),
+            'abbr': month.strftime("%b"),
+            'previous_abbr': previous.strftime("%b"),
+            'current': (month.year, month.month) == (today.year, today.month)}
+
+def grid_rows(grid):
+    """
+    Returns the rows of the budget grid, one per group and category, with
+    the cells of every month of ``grid``.
+    """
+    rows = []
+    for index, group in enumerate(grid[0]['groups']):
+        rows.append({'group': group['group'],
+                     'cells': [month['groups'][index] for month in grid]})
+        for position, row in enumerate(group['categories']):
+            rows.append({'category': row.category,
+                         'cells': [month['groups'][index]['categories']\
+                                   [position] for month in grid]})
+    return rows
+
+def budget_grid(user, months):
+    """
+    Returns the budget of the given months as one dict per month with the
+    totals and the category months ordered by group and category.
+
+    All values come from the CategoryMonth rows, which are loaded with one
+    query. Categories without a row in a month carry over the balance of
+    their last row before it.
+    """
+    categories = list(models.Category.objects.filter(Q(user=user) | 
+            Q(default=True), budgeted=True, group__budgeted=True).\
+            select_related('group').distinct().order_by('group__name', 'name'))
+    latest, by_month = {}, defaultdict(dict)
+    for row in user.category_months_between(months[0], months[-1]):
+        if row.month < months[0]:
+            latest[row.category_id] = row
+        else:
+            by_month[row.month][row.category_id] = row
+    grid = []
+    for month in months:
+        cells = {}
+        for category in categories + [None]:
+            category_id = category and category.pk
+            row = by_month[month].get(category_id)
+            if row is None:
+                previous = latest.get(category_id)
+                row = models.CategoryMonth(user=user, month=month,
+                        carried_over=previous.balance if previous else 0)
+            row.category = category
+            cells[category_id] = latest[category_id] = row
+        groups = []
+        for group, group_categories in groupby(categories, lambda c: c.group):
+            rows = [cells[category.pk] for category in group_categories]
+            groups.append({'group': group, 'categories': rows,
+                           'budgeted': sum(row.budgeted for row in rows),
+                           'outflows': sum(row.outflows for row in rows),
+                           'balance': sum(row.balance for row in rows)})
+        pool = cells[None]
+        grid.append({'month': month, 'groups': groups,
+                     'income': pool.inflow,
+                     'not_budgeted': pool.carried_over,
+                     'overspent': sum(min(cells[category.pk].carried_over, 0)
+                                      for category in categories),
+                     'budgeted': pool.budgeted,
+                     'available': pool.balance,
+                     'outflows': sum(group['outflows'] for group in groups),
+                     'balance': sum(group['balance'] for group in groups)})
+    return grid
+
+class RegisterPage(list):
+    """
+    One page of the register, oldest transaction first. ``older`` is the
+    cursor of the next older page, or None if there are no older
+    transactions.
+    """
+    older = None
 
-def get_transactions(user, account=None):
+def register_key(transaction):
+    return (transaction.date, transaction.added, transaction.id,
+            transaction.register_side)
+
+def dump_register_cursor(transaction, balance):
+    return signing.dumps([transaction.date.isoformat(),
+                          transaction.added.isoformat(), transaction.id,
+                          transaction.register_side, str(balance)], 
+                         salt="budget.register")
+
+def load_register_cursor(cursor):
+    """
+    Returns the (date, added, id, side) key of the cursor and the balance
+    after the last row of the page it points to.
+    """
+    try:
+        day, added, id, side, balance = signing.loads(cursor,
+                                                      salt="budget.register")
+        return ((parse_date(day), parse_datetime(added), int(id), int(side)),
+                Decimal(balance))
+    except (signing.BadSignature, ValueError, TypeError, InvalidOperation):
+        raise Http404("Invalid register cursor")
+
+# The register order of the transactions and of the transfers to an
+# account, whose own date and added copies have the to_account index
+REGISTER_FIELDS = (('date', 'added', 'id'), ('to_date', 'to_added', 'pk'))
+
+def older_than(cursor, side):
+    """
+    Returns a filter for the rows of one register side that come before the
+    cursor in (date, added, id, side) order.
+    """
+    day, added, id, cursor_side = cursor
+    date_field, added_field, id_field = REGISTER_FIELDS[side]
+    same_id = Q(**{id_field + ('__lte' if side < cursor_side else '__lt'): id})
+    return Q(**{date_field + '__lt': day}) | \
+            Q(**{date_field: day, added_field + '__lt': added}) | \
+            (same_id & Q(**{date_field: day, added_field: added}))
+
+def as_incoming(transfer):
+    """Shows a transfer from the point of view of its receiving account"""
+    transfer.account, transfer.to_account = transfer.to_account, transfer.account
+    transfer.inflow, transfer.outflow = transfer.outflow, transfer.inflow
+    return transfer
+
+def register_rows(user, account=None):
+    """
+    Returns the querysets of the transactions of the user or account and
+    of the transfers to them, with what rendering them needs.
+    """
     if account:
-        transfers = models.Transfer.objects.filter(to_account__user=user, 
-                                                   to_account=account)
-        transactions = list(account.transactions.all())
+        outgoing = account.implemented_transactions
+        incoming = account.implemented_transfers_to
     else:
-        transfers = models.Transfer.objects.filter(to_account__user=user)
-        transactions = list(models.Transaction.objects.filter(account__user=user))
-    transactions.extend(transfers.extra(
-            select={'account_id': 'to_account_id', 'to_account_id': 'account_id',
-                    'inflow': 'outflow', 'outflow': 'inflow'}))
-    transactions.sort(key=lambda t: (t.date, t.added))
-    return transactions
+        outgoing = models.Transaction.objects.filter(account__user=user,
+                                                     implemented=True)
+        incoming = models.Transfer.objects.filter(to_account__user=user,
+                                                  implemented=True)
+    return (outgoing.select_related('account', 'category__group',
+                                    'transfer__to_account'),
+            incoming.select_related('account', 'to_account',
+                                    'category__group'))
+
+def register_querysets(user, account=None, cursor=None, limit=None):
+    """
+    Returns (side, queryset) pairs of the (date, added, id) keys of the
+    newest ``limit`` transactions of, and transfers to, the account or
+    each account of the user before the (date, added, id, side)
+    ``cursor``. Every queryset walks the index of one account in register
+    order and stops at its limit.
+    """
+    if account:
+        accounts = [account.pk]
+    else:
+        accounts = list(user.accounts.values_list('pk', flat=True))
+    querysets = []
+    for pk in accounts:
+        for side, rows in ((0, models.Transaction.objects.filter(account=pk)),
+                           (1, models.Transfer.objects.filter(
+                                   to_account=pk))):
+            rows = rows.filter(implemented=True)
+            if cursor:
+                rows = rows.filter(older_than(cursor, side))
+            fields = REGISTER_FIELDS[side]
+            querysets.append((side, rows.order_by(*('-' + field for field
+                                                     in fields)).\
+                    values_list(*fields)[:limit]))
+    return querysets
+
+def newest_register_keys(querysets, limit):
+    """
+    Returns the (date, added, id, side) keys of the newest ``limit`` rows
+    of the register_querysets() with one query, a UNION ALL of them.
+    """
+    parts, params = [], []
+    for number, (side, queryset) in enumerate(querysets):
+        sql, queryset_params = queryset.query.sql_with_params()
+        parts.append("SELECT *, {} FROM ({}) AS arm{}".format(side, sql,
+                                                              number))
+        params.extend(queryset_params)
+    if not parts:
+        return []
+    cursor = connections[queryset.db].cursor()
+    cursor.execute("{} ORDER BY 1 DESC, 2 DESC, 3 DESC, 4 DESC LIMIT {}".\
+            format(" UNION ALL ".join(parts), int(limit)), params)
+    return cursor.fetchall()
 
+def get_transactions(user, account=None, before=None, limit=None):
+    """
+    Returns a RegisterPage with the newest transactions of the user or
+    account that come before the ``before`` cursor.
+
+    The register consists of the transactions of the accounts and the
+    transfers to the accounts. The keys of the page are found with one
+    query over the indexes of the accounts, whatever the length of their
+    history; only the rows of the page are loaded then. The rows come
+    with their accounts, category and transfer, so rendering them needs
+    no further queries.
+
+    Every row carries the running ``balance`` after it. The first page
+    starts from the stored account balances, older pages from the balance
+    kept in the cursor, so no page has to aggregate the rows after it.
+    """
+    limit = limit or getattr(settings, 'BUDGET_REGISTER_PAGE_SIZE', 50)
+    cursor = None
+    if before:
+        cursor, balance = load_register_cursor(before)
+    elif account:
+        balance = account.saldo
+    else:
+        balance = user.account_balances()['native_sum']
+    keys = newest_register_keys(register_querysets(user, account, cursor,
+                                                   limit + 1), limit + 1)
+    rows = []
+    for side, queryset in enumerate(register_rows(user, account)):
+        ids = [key[2] for key in keys if key[3] == side]
+        for transaction in queryset.filter(pk__in=ids) if ids else ():
+            transaction.register_side = side
+            rows.append(as_incoming(transaction) if side else transaction)
+    rows.sort(key=register_key, reverse=True)
+    for transaction in rows[:limit]:
+        transaction.balance = balance
+        balance -= transaction.inflow - transaction.outflow
+    page = RegisterPage(reversed(rows[:limit]))
+    if len(rows) > limit:
+        page.older = dump_register_cursor(page[0], balance)
+    return page
+
+@read_only
 @ensure_budget_profile
 def accounts(request):
     user = request.user.budget_profile
-    transactions = get_transactions(user)
+    transactions = get_transactions(user, before=request.GET.get('before'))
     return render(request, "budget/account.html",
                   {'transactions': transactions})
 
+@read_only
 @ensure_budget_profile
 def account(request, id):
     user = request.user.budget_profile
     account = get_object_or_404(models.Account, pk=id)
-    transactions = get_transactions(user, account)
-    if account.user.user != request.user:
+    if account.user_id != user.id:
         return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    transactions = get_transactions(user, account, request.GET.get('before'))
     return render(request, "budget/account.html", {'account': account,
             'transactions': transactions})
 
@@ -105,8 +352,10 @@ def delete_account(request, id):
     if request.method == "POST":
         account.delete()
         return HttpResponseRedirect(request.POST['next'])
+    next = request.GET.get('next', request.META.get('HTTP_REFERER',
+            reverse('budget.views.accounts')))
     return render(request, "budget/delete_account.html", 
-                  {'account': account, 'next': request.GET['next']})
+                  {'account': account, 'next': next})
 
 @ensure_budget_profile
 def add_account(request):
@@ -128,15 +377,96 @@ def get_account(account_id=None):
         return account
     return None
 
+def json_response(data, response_class=HttpResponse):
+    return response_class(json.dumps(data), content_type='application/json')
+
+def current_balances(user):
+    # The profile of the request may hold the balances from before the
+    # change, a bare one loads them afresh
+    return models.UserProfile(pk=user.pk, currency_id=user.currency_id).\
+            account_balances()
+
+def register_update(balances, **data):
+    """
+    Returns the JSON answer to a change made in the register: ``data``
+    plus the new ``balances`` of the user's accounts and the sidebar
+    totals.
+    """
+    data['accounts'] = dict((account.pk, {
+            'balance': "{:.2f}".format(account.saldo),
+            'cleared': "{:.2f}".format(account.cleared_saldo)})
+            for account in balances['accounts'])
+    data['totals'] = dict((name, "" if balances[name + '_sum'] is None else
+                           "{:.2f}".format(balances[name + '_sum']))
+                          for name in ('total', 'budget', 'off_budget'))
+    return json_response(data)
+
+def added_rows(request, user, account, transaction, job=None):
+    """
+    Returns the JSON answer to a transaction added in the register of the
+    user or account: its rows, rendered with their running balance, how
+    much they change the balance of the newer rows and the follow-up
+    ``job``.
+    """
+    outgoing, incoming = register_rows(user, account)
+    rows = [outgoing.get(pk=transaction.pk)]
+    if not account and transaction.is_transfer():
+        rows.append(as_incoming(incoming.get(pk=transaction.pk)))
+    # The new rows are the newest of their date, the rows dated later
+    # were already part of the balance
+    newer = 0
+    for queryset, sign in ((outgoing, 1), (incoming, -1)):
+        sums = queryset.filter(date__gt=transaction.date).order_by().\
+                aggregate(Sum('inflow'), Sum('outflow'))
+        newer += sign * ((sums['inflow__sum'] or 0) -
+                         (sums['outflow__sum'] or 0))
+    balances = current_balances(user)
+    if account:
+        balance = next(other.saldo for other in balances['accounts']
+                       if other.pk == account.pk)
+    else:
+        balance = balances['native_sum']
+    balance -= newer
+    amount = 0
+    for row in reversed(rows):
+        row.balance = balance
+        balance -= row.inflow - row.outflow
+        amount += row.inflow - row.outflow
+    context = RequestContext(request, {'account': account})
+    return register_update(balances, date=transaction.date.isoformat(),
+            amount="{:.2f}".format(amount), job=job and job.pk,
+            rows=[render_to_string("budget/register_row.html",
+                                   {'transaction': row}, context)
+                  for row in rows])
+
+def refresh_later(user):
+    """Queues the refresh_user job after a change to the user's data"""
+    return jobs.enqueue('refresh_user', user.pk,
+                        delay=getattr(settings, 'BUDGET_JOB_DELAY', 5))
+
+def form_errors(form):
+    return json_response({'errors': dict((field, [unicode(error)
+                                                  for error in errors])
+                                         for field, errors in
+                                         form.errors.items())},
+                         HttpResponseBadRequest)
+
 @ensure_budget_profile
 def clear_transaction(request, id):
+    """
+    Toggles the cleared flag of a transaction. AJAX requests get the flag
+    and the new balances instead of a redirect.
+    """
     user = request.user.budget_profile
     transaction = get_object_or_404(models.Transaction, pk=id)
 
-    if user != transaction.account.user:
+    if user != transaction.account.user or transaction.reconciled:
         return HttpResponseForbidden("<h1>403 Forbidden</h1>")
     transaction.cleared = not transaction.cleared
     transaction.save()
+    if request.is_ajax():
+        return register_update(current_balances(user), id=transaction.pk,
+                               cleared=transaction.cleared)
     return HttpResponseRedirect(request.GET.get('next', reverse(accounts)))
 
 @ensure_budget_profile
@@ -144,7 +474,7 @@ def delete_transaction(request, id):
     user = request.user.budget_profile
     transaction = get_object_or_404(models.Transaction, pk=id)
 
-    if user != transaction.account.user:
+    if user != transaction.account.user or transaction.reconciled:
         return HttpResponseForbidden("<h1>403 Forbidden</h1>")
     if request.method == "POST":
         transaction.delete()
@@ -152,36 +482,78 @@ def delete_transaction(request, id):
     return render(request, "budget/delete_transaction.html", 
                   {'transaction': transaction, 'next': request.GET['next']})
 
+@ensure_budget_profile
+@require_POST
+def bulk_transactions(request):
+    """
+    Clears, unclears, recategorizes, moves or deletes the transactions
+    selected in the register with one UPDATE or DELETE.
+    """
+    user = request.user.budget_profile
+    form = forms.BulkActionForm(user, request.POST)
+    try:
+        ids = set(int(id) for id in request.POST.getlist('ids'))
+    except ValueError:
+        ids = None
+    if not form.is_valid() or ids is None:
+        return HttpResponseBadRequest("<h1>400 Bad Request</h1>")
+    rows = models.ledger_rows(models.Transaction.objects.filter(pk__in=ids))
+    if any(user_id != user.id for pk, user_id, state in rows):
+        return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    action = form.cleaned_data['action']
+    if action != 'categorize' and models.Transaction.objects.filter(
+            pk__in=ids, reconciled=True).exists():
+        # Reconciled rows keep their amounts, accounts and cleared state
+        return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    if action == 'move' and models.Transfer.objects.filter(
+            pk__in=ids).exists():
+        # A transfer moves with its form, which shows both accounts
+        return HttpResponseBadRequest("<h1>400 Bad Request</h1>")
+    if action == 'delete':
+        models.delete_transactions(rows)
+    elif action == 'categorize':
+        models.update_transactions(rows,
+                category=form.cleaned_data['category'].pk)
+    elif action == 'move':
+        models.update_transactions(rows,
+                account=form.cleaned_data['account'].pk)
+    else:
+        models.update_transactions(rows, cleared=action == 'clear')
+    refresh_later(user)
+    return HttpResponseRedirect(form.cleaned_data['next'] or 
+                                reverse('budget.views.accounts'))
+
 @ensure_budget_profile
 def add_transaction(request, account_id=None):
     user = request.user.budget_profile
     account = get_account(account_id)
 
-    if account and account.user.user != request.user:
+    if account and account.user_id != user.id:
         return HttpResponseForbidden("<h1>403 Forbidden</h1>")
 
-    transactions = get_transactions(user, account)
     if account:
         Form = forms.TransactionToAccountForm
     else:
         Form = forms.TransactionForm
 
-    Form.base_fields['category'] = ModelChoiceField(
-            queryset=models.Category.objects.filter(Q(user=user)|Q(default=True)))
-
     if request.method == "POST":
         if account and unicode(account.id) not in request.POST['account']:
             return HttpResponseForbidden("<h1>403 Forbidden</h1>")
-        form = Form(request.POST)
+        form = Form(user, request.POST)
         if form.is_valid():
             transaction = form.save()
+            job = refresh_later(user)
+            if request.is_ajax():
+                return added_rows(request, user, account, transaction, job)
             if account:
                 return HttpResponseRedirect(reverse('budget.views.account', kwargs={'id': account_id}))
             else:
                 return HttpResponseRedirect(reverse('budget.views.accounts'))
+        if request.is_ajax():
+            return form_errors(form)
     else:
-        form = Form(initial={'account': account, 'date': date.today()})
-    print account
+        form = Form(user, initial={'account': account, 'date': date.today()})
+    transactions = get_transactions(user, account, request.GET.get('before'))
     return render(request, "budget/add_transaction.html", 
             {'form': form, 'account': account, 'transactions': transactions}) 
      
@@ -190,31 +562,215 @@ def add_transfer(request, account_id=None):
     user = request.user.budget_profile
     account = get_account(account_id)
 
-    if account and account.user.user != request.user:
+    if account and account.user_id != user.id:
         return HttpResponseForbidden("<h1>403 Forbidden</h1>")
 
-    transactions = get_transactions(user, account)
     if account:
         Form = forms.TransferToAccountForm
     else:
         Form = forms.TransferForm
 
-    Form.base_fields['to_account'] = ModelChoiceField(
-            queryset=models.Account.objects.filter(user=user).exclude(pk=account_id))
-    Form.base_fields['category'] = ModelChoiceField(
-            queryset=models.Category.objects.filter(Q(user=user)|Q(default=True)))
-
     if request.method == "POST":
         if account and unicode(account.id) not in request.POST['account']:
             return HttpResponseForbidden("<h1>403 Forbidden</h1>")
-        form = Form(request.POST)
+        form = Form(user, request.POST, account=account)
         if form.is_valid():
             transaction = form.save()
+            job = refresh_later(user)
+            if request.is_ajax():
+                return added_rows(request, user, account, transaction, job)
             if account:
                 return HttpResponseRedirect(reverse('budget.views.account', kwargs={'id': account_id}))
             else:
                 return HttpResponseRedirect(reverse('budget.views.accounts'))
+        if request.is_ajax():
+            return form_errors(form)
     else:
-        form = Form(initial={'account': account, 'date': date.today()})
+        form = Form(user, initial={'account': account, 'date': date.today()},
+                    account=account)
+    transactions = get_transactions(user, account, request.GET.get('before'))
     return render(request, "budget/add_transfer.html", 
             {'form': form, 'account': account, 'transactions': transactions}) 
+
+@ensure_budget_profile
+def import_transactions(request, account_id):
+    user = request.user.budget_profile
+    account = get_object_or_404(models.Account, pk=account_id)
+
+    if account.user_id != user.id:
+        return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    result = None
+    if request.method == "POST":
+        form = forms.ImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            parse = importers.PARSERS[form.cleaned_data['format']]
+            rows = parse(form.cleaned_data['file'], 
+                         form.cleaned_data['date_format'] or None,
+                         form.cleaned_data['encoding'])
+            try:
+                result = importers.import_transactions(account, rows)
+            except (importers.StatementError, LookupError,
+                    UnicodeDecodeError) as e:
+                form.errors['file'] = form.error_class([unicode(e)])
+            else:
+                # The import bumped the data version in the database, the
+                # sidebar of the page below is cached under the new one
+                user.data_version = models.UserProfile.objects.filter(
+                        pk=user.pk).values_list('data_version', flat=True)[0]
+                refresh_later(user)
+    else:
+        form = forms.ImportForm()
+    return render(request, "budget/import_transactions.html",
+                  {'form': form, 'account': account, 'result': result})
+
+def export_response(format, filename, fields, rows):
+    response = StreamingHttpResponse(
+            exporters.WRITERS[format](fields, rows),
+            content_type=exporters.CONTENT_TYPES[format])
+    response['Content-Disposition'] = \
+            'attachment; filename="{}.{}"'.format(filename, format)
+    return response
+
+@ensure_budget_profile
+def export_transactions(request, format, account_id=None):
+    user = request.user.budget_profile
+    account = None
+    if account_id:
+        account = get_object_or_404(models.Account, pk=account_id)
+        if account.user_id != user.id:
+            return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    return export_response(format, "account-{}".format(account_id)
+                                   if account else "transactions",
+                           exporters.TRANSACTION_FIELDS,
+                           exporters.transaction_rows(user, account))
+
+@ensure_budget_profile
+def export_budget(request, format):
+    user = request.user.budget_profile
+    return export_response(format, "budget", exporters.BUDGET_MONTH_FIELDS,
+                           exporters.budget_month_rows(user))
+
+def report_month(value):
+    """Parses a YYYY-MM month parameter, None if it is empty"""
+    if not value:
+        return None
+    day = parse_date(value + '-01')
+    if day is None:
+        raise ValueError(value)
+    return day
+
+@read_only
+@ensure_budget_profile
+def report(request, name):
+    """
+    Answers a report of budget.reports as JSON for charts, for the months
+    ``from`` to ``to`` (YYYY-MM, by default the last twelve months).
+    Spending can be reported ``by`` category or group.
+    """
+    user = request.user.budget_profile
+    try:
+        first, last = reports.month_range(
+                report_month(request.GET.get('from')),
+                report_month(request.GET.get('to')))
+    except ValueError:
+        return HttpResponseBadRequest("<h1>400 Bad Request</h1>")
+    if first > last:
+        return HttpResponseBadRequest("<h1>400 Bad Request</h1>")
+    options = {}
+    if name == 'spending':
+        options['by'] = request.GET.get('by', 'category')
+        if options['by'] not in reports.BY:
+            return HttpResponseBadRequest("<h1>400 Bad Request</h1>")
+    return json_response(reports.cached_report(user, name, first, last,
+                                               **options))
+
+@ensure_budget_profile
+def search_transactions(request):
+    user = request.user.budget_profile
+    query = request.GET.get('q', u"").strip()
+    return render(request, "budget/search.html", {'query': query,
+            'transactions': search.search_transactions(user, query)})
+
+@ensure_budget_profile
+def payees(request):
+    """
+    Answers the payees starting with ``q`` and their latest category as
+    JSON for the payee field of the transaction form.
+    """
+    user = request.user.budget_profile
+    return json_response({'payees': search.suggest_payees(user,
+            request.GET.get('q', u""))})
+
+@ensure_budget_profile
+def job_status(request, id=None):
+    """
+    Answers the status of the user's job ``id``, or of the user's latest
+    jobs, as JSON.
+    """
+    user = request.user.budget_profile
+    if id is None:
+        return json_response({'jobs': [jobs.describe(job) for job in
+                                       user.jobs.order_by('-pk')[:20]]})
+    job = get_object_or_404(models.Job, pk=id, user=user)
+    return json_response(jobs.describe(job))
+
+def reconcile_totals(account, balance):
+    return {'cleared': account.cleared_saldo,
+            'uncleared': account.uncleared_balance,
+            'difference': balance - account.cleared_saldo}
+
+@ensure_budget_profile
+def reconcile(request, account_id):
+    """
+    Reconciles the account against a statement: shows the rows that are
+    not reconciled yet and the cleared balance, and locks the cleared rows
+    once the cleared balance matches the statement balance.
+    """
+    user = request.user.budget_profile
+    account = get_object_or_404(models.Account, pk=account_id)
+    if account.user_id != user.id:
+        return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    form = forms.ReconcileForm(request.POST or request.GET or None)
+    context = {'account': account, 'form': form,
+               'last': account.reconciliations.order_by('-date').first()}
+    if form.is_valid():
+        day, balance = form.cleaned_data['date'], form.cleaned_data['balance']
+        totals = reconcile_totals(account, balance)
+        if request.method == "POST" and not totals['difference']:
+            models.reconcile(account, day, balance)
+            return HttpResponseRedirect(reverse('budget.views.account',
+                                                kwargs={'id': account.id}))
+        outgoing = account.implemented_transactions.filter(reconciled=False).\
+                select_related('category__group', 'transfer__to_account')
+        incoming = account.implemented_transfers_to.filter(reconciled=False).\
+                select_related('account', 'to_account', 'category__group')
+        rows = list(outgoing) + [as_incoming(transfer) for transfer in incoming]
+        rows.sort(key=lambda row: (row.date, row.added, row.id))
+        context.update(totals)
+        context['transactions'] = rows
+    return render(request, "budget/reconcile.html", context)
+
+@ensure_budget_profile
+@require_POST
+def reconcile_toggle(request, account_id):
+    """
+    Sets the cleared flag of one row while reconciling and answers with the
+    new totals, read from the stored balances of the account.
+    """
+    user = request.user.budget_profile
+    account = get_object_or_404(models.Account, pk=account_id)
+    form = forms.ReconcileToggleForm(request.POST)
+    if account.user_id != user.id:
+        return HttpResponseForbidden("<h1>403 Forbidden</h1>")
+    if not form.is_valid():
+        return HttpResponseBadRequest("<h1>400 Bad Request</h1>")
+    rows = models.ledger_rows(models.Transaction.objects.filter(
+            Q(account=account) | Q(transfer__to_account=account),
+            pk=form.cleaned_data['id'], reconciled=False))
+    if not rows:
+        raise Http404
+    models.update_transactions(rows, cleared=form.cleaned_data['cleared'])
+    account = models.Account.objects.get(pk=account.pk)
+    totals = reconcile_totals(account, form.cleaned_data['balance'])
+    return json_response(dict((name, "{:.2f}".format(value))
+                              for name, value in totals.items()))
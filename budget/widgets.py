@@ -2,12 +2,23 @@ from django.forms.models import ModelChoiceField
 from django.utils.encoding import force_text
 
 class PrefixedModelChoiceField(ModelChoiceField):
+    """
+    A ModelChoiceField that renders the given ``choices``, e.g. cached
+    ones grouped as (group, [(pk, label), ...]), with ``prefix`` before
+    every label. The queryset is only queried to validate a submitted
+    choice.
+    """
     def __init__(self, prefix="", *args, **kwargs):
+        choices = kwargs.pop('choices', None)
         self.prefix = force_text(prefix)
         super(PrefixedModelChoiceField, self).__init__(*args, **kwargs)
+        if choices is not None:
+            empty = [] if self.empty_label is None else \
+                    [(u"", self.empty_label)]
+            self.choices = empty + self.prefixed(choices)
 
-    def render_option(self, selected_choices, option_value, option_label):
-        option_label = self.prefix+force_text(option_label)
-        return super(PrefixedModelChoiceField, self).render_option(
-                selected_choices, option_value, option_label)
-
+    def prefixed(self, choices):
+        return [(value, self.prefixed(label)
+                 if isinstance(label, (list, tuple))
+                 else self.prefix + force_text(label))
+                for value, label in choices]
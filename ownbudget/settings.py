@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import sys
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -48,8 +49,70 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'budget.routers.ReplicaMiddleware',
+    'budget.middleware.InstrumentationMiddleware',
 )
 
+# Per view limits checked by budget.middleware.InstrumentationMiddleware,
+# the query limits fail the tests when exceeded. The query counts of these
+# views do not grow with the data; the limits are the counts measured with
+# the tests and 'manage.py benchmark', plus room for a few more.
+BUDGET_VIEW_BUDGETS = {
+    'budget.views.budget': {'queries': 6, 'ms': 300},
+    'budget.views.accounts': {'queries': 10, 'ms': 300},
+    'budget.views.account': {'queries': 10, 'ms': 300},
+    # Saving updates the ledger, AJAX requests get the new rows rendered
+    'budget.views.add_transaction': {'queries': 30, 'ms': 500},
+    'budget.views.add_transfer': {'queries': 32, 'ms': 500},
+    # Besides the changed rows, the ledger and the queued refresh job
+    'budget.views.bulk_transactions': {'queries': 30, 'ms': 1000},
+    # One batch of rows and its ledger update per 500 statement lines
+    'budget.views.import_transactions': {'queries': 30, 'ms': 5000},
+    # Changing an amount, date or category updates the ledger
+    'budget.api.TransactionViewSet': {'queries': 30, 'ms': 500},
+    'budget.api.TransferViewSet': {'queries': 32, 'ms': 500},
+    '*': {'queries': 25, 'ms': 1000},
+}
+
+BUDGET_VIEW_BUDGETS_STRICT = 'test' in sys.argv
+
+# The instrumentation middleware only runs with this set, it makes every
+# request keep its queries in memory
+BUDGET_INSTRUMENTATION = DEBUG or BUDGET_VIEW_BUDGETS_STRICT
+
+# Months the budget page shows by default, ?months=N shows up to 12 and
+# /<year> the whole year with the same queries
+BUDGET_GRID_MONTHS = 3
+
+# Background jobs, see budget.jobs. The views queue the rebuilds of the
+# category months and balance checkpoints as jobs, so a deployment needs a
+# 'manage.py run_worker' process; without one, set BUDGET_JOBS_EAGER to
+# run the jobs within the requests.
+BUDGET_JOBS_EAGER = False
+BUDGET_JOB_ATTEMPTS = 3
+# Seconds a job queued by a view waits, repeated changes share the job
+BUDGET_JOB_DELAY = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'budget.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO' if DEBUG and 'test' not in sys.argv else 'WARNING',
+        },
+        'budget.jobs': {
+            'handlers': ['console'],
+            'level': 'ERROR',
+        },
+    },
+}
+
 TEMPLATE_CONTEXT_PROCESSORS = (
     'django.contrib.auth.context_processors.auth',
     'django.core.context_processors.debug',
@@ -76,6 +139,32 @@ DATABASES = {
     }
 }
 
+# Read replicas for the views marked with budget.routers.read_only. To try
+# them locally with two SQLite files, add
+#     'replica': {'ENGINE': 'django.db.backends.sqlite3',
+#                 'NAME': os.path.join(BASE_DIR, 'replica.sqlite3')}
+# to DATABASES, list 'replica' here and run 'manage.py sync_replicas
+# --interval 5'. Sessions read from the primary for
+# BUDGET_PRIMARY_STICKINESS seconds after writing.
+
+DATABASE_ROUTERS = ['budget.routers.ReplicaRouter']
+BUDGET_READ_REPLICAS = []
+BUDGET_PRIMARY_STICKINESS = 10
+
+# Cache
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+# With several worker processes, point BUDGET_CACHE to a shared cache,
+# e.g. 'django.core.cache.backends.filebased.FileBasedCache' with a
+# LOCATION directory.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+BUDGET_CACHE = 'default'
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 